@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Micro-benchmark for HTML escaping.
+
+Times _escape_string() and htmlescape() from each available htmltext
+implementation over a few mixes of input: short values with nothing to
+escape (the common case in templates), longer plain text, user text
+with the occasional special character, and heavily marked-up text.  The
+four-pass replace() escaping used before is included for comparison.
+
+    python bench/bench_escape.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+MIXES = [
+    ('short plain', ['42', 'hello', 'John Smith', 'item 1234', 'odd']),
+    ('long plain', ['Lorem ipsum dolor sit amet, consectetur adipiscing '
+                    'elit, sed do eiusmod tempor incididunt ut labore. ' * 8]),
+    ('user text', ['Tom & Jerry', 'say "hi"', 'plain words here',
+                   'a < b', 'nothing special']),
+    ('markup', ['<a href="/x?a=1&b=2">&lt;link&gt;</a>' * 10]),
+]
+
+def replace_escape(s):
+    # the escaping code before single-pass escaping
+    s = s.replace("&", "&amp;")
+    s = s.replace("<", "&lt;")
+    s = s.replace(">", "&gt;")
+    s = s.replace('"', "&quot;")
+    return s
+
+def run(func, values, number):
+    def loop():
+        for value in values:
+            func(value)
+    return min(timeit.repeat(loop, number=number, repeat=3))
+
+def main():
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    else:
+        number = 100000
+    funcs = [('four replace() calls', replace_escape)]
+    for name in ['quixote._py_htmltext', 'quixote._c_htmltext']:
+        try:
+            module = __import__(name, {}, {}, ['htmlescape'])
+        except ImportError:
+            continue
+        funcs.append(('%s._escape_string' % name, module._escape_string))
+        funcs.append(('%s.htmlescape' % name, module.htmlescape))
+    for label, values in MIXES:
+        print label
+        for name, func in funcs:
+            best = run(func, values, number)
+            print "  %-40s %6.3f usec/value" % (name,
+                                                best * 1e6 / number /
+                                                len(values))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Micro-benchmark for HTTPResponse header generation.
+
+Builds a response with 10 headers and times generate_headers() and
+generate_header_block(), along with the straightforward formatting
+that generate_headers() used to do, for comparison.
+
+    python bench/bench_headers.py [iterations]
+"""
+
+import os
+import sys
+import time
+import timeit
+from rfc822 import formatdate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quixote.http_response import HTTPResponse
+
+
+def make_response():
+    response = HTTPResponse()
+    response.set_body('x' * 1000)
+    response.set_header('Content-Type', 'text/html; charset=utf-8')
+    response.set_header('Cache-Control', 'private')
+    response.set_header('X-Frame-Options', 'SAMEORIGIN')
+    response.set_header('X-Content-Type-Options', 'nosniff')
+    response.set_header('Vary', 'Accept-Encoding')
+    response.set_header('Last-Modified', formatdate(0))
+    return response
+
+def naive_headers(response):
+    # generate_headers() as it was before the per-second and
+    # per-status caches
+    headers = []
+    headers.append(("Status", "%03d %s" % (response.status_code,
+                                           response.reason_phrase)))
+    for name, value in response.headers.items():
+        headers.append((name.title(), value))
+    now = time.time()
+    if not response.headers.has_key("date"):
+        headers.append(("Date", formatdate(now)))
+    if not response.headers.has_key("expires"):
+        headers.append(("Expires", "-1"))
+    return headers
+
+def main():
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    else:
+        number = 100000
+    response = make_response()
+    assert len(response.generate_headers()) == 10
+    for label, func in [
+            ('naive formatting', lambda: naive_headers(response)),
+            ('generate_headers', response.generate_headers),
+            ('generate_header_block', response.generate_header_block)]:
+        best = min(timeit.repeat(func, number=number, repeat=3))
+        print "%-24s %6.2f usec/call" % (label, best * 1e6 / number)
+
+if __name__ == '__main__':
+    main()
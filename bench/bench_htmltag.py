@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Micro-benchmark for htmltag() and href().
+
+Builds the tags of a typical form -- inputs with a handful of attributes,
+some needing escaping, a few valueless ones -- and a list of links, with
+each htmltext implementation that is available.
+
+    python bench/bench_htmltag.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_tags(module):
+    tags = []
+    for i in range(200):
+        tags.append(('input', {'type': 'text', 'name': 'field%d' % i,
+                               'value': 'Tom & "Jerry" %d' % i,
+                               'size': 30, 'css_class': 'text',
+                               'xml_end': 1}))
+        if i % 10 == 0:
+            tags[-1][1]['disabled'] = module.ValuelessAttr
+    return tags
+
+def run_tags(module, tags):
+    htmltag = module.htmltag
+    for tag, attrs in tags:
+        htmltag(tag, **attrs)
+
+def run_links(module):
+    href = module.href
+    for i in range(200):
+        href('/item/%d?a=1&b=2' % i, 'Item <%d>' % i, title='Item')
+
+def main():
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    else:
+        number = 200
+    for name in ['quixote._py_htmltext', 'quixote._c_htmltext']:
+        try:
+            module = __import__(name, {}, {}, ['htmltag'])
+        except ImportError:
+            continue
+        tags = make_tags(module)
+        for label, func in [('htmltag', lambda: run_tags(module, tags)),
+                            ('href', lambda: run_links(module))]:
+            best = min(timeit.repeat(func, number=number, repeat=3))
+            print "%-24s %-8s %6.2f usec/tag" % (name, label,
+                                                 best * 1e6 / number / 200)
+
+if __name__ == '__main__':
+    main()
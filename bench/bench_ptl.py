@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Benchmark for rendering a large table with a PTL template.
+
+Compiles a small [html] template that renders a 10,000 row table (five
+cells per row, a mix of htmltext and strings that need escaping) and
+times it, compiled both with "+=" and with fast_append, then times
+filling a TemplateIO with the same pieces directly for each htmltext
+implementation that is available.
+
+    python bench/bench_ptl.py [rows]
+"""
+
+import os
+import sys
+import timeit
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quixote import ptl_compile
+
+TEMPLATE = '''
+def table [html] (rows):
+    '<table>\\n'
+    for row in rows:
+        '<tr class="%s">' % (row[0] % 2 and 'odd' or 'even')
+        for cell in row:
+            '<td>'
+            cell
+            '</td>'
+        '</tr>\\n'
+    '</table>\\n'
+'''
+
+def load_template(fast_append=0):
+    code = ptl_compile.compile_template(StringIO(TEMPLATE), '<bench_ptl>',
+                                        fast_append=fast_append)
+    namespace = {}
+    exec code in namespace
+    return namespace['table']
+
+def make_rows(n):
+    return [(i, 'item %d' % i, 'Tom & Jerry', '<none>', i * 1.5)
+            for i in range(n)]
+
+def fill(TemplateIO, htmltext, rows):
+    r = TemplateIO(html=1)
+    for row in rows:
+        r += htmltext('<tr>')
+        for cell in row:
+            r += htmltext('<td>')
+            r += cell
+            r += htmltext('</td>')
+        r += htmltext('</tr>\n')
+    return r.getvalue()
+
+def main():
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    else:
+        n = 10000
+    rows = make_rows(n)
+    table = load_template()
+    print "%d rows, %d bytes of output" % (n, len(table(rows)))
+    implementations = ['quixote._py_htmltext']
+    try:
+        from quixote import _c_htmltext
+    except ImportError:
+        label = 'PTL template (Python htmltext)'
+    else:
+        implementations.append('quixote._c_htmltext')
+        label = 'PTL template (C htmltext)'
+    fast_table = load_template(fast_append=1)
+    tests = [(label, lambda: table(rows)),
+             (label + ', fast_append', lambda: fast_table(rows))]
+    for name in implementations:
+        module = __import__(name, {}, {}, ['TemplateIO'])
+        tests.append(('TemplateIO (%s)' % name,
+                      lambda m=module: fill(m.TemplateIO, m.htmltext, rows)))
+    for label, func in tests:
+        best = min(timeit.repeat(func, number=5, repeat=3)) / 5
+        print "%-48s %8.2f msec/render" % (label, best * 1e3)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Benchmark for PTL constant folding.
+
+Compiles a static-heavy [html] template (a page layout where most of the
+output is literal markup) and the table template from bench_ptl.py with
+and without constant folding, and times a call of each.
+
+    python bench/bench_ptl_fold.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quixote import ptl_compile
+
+TEMPLATE = '''
+def layout [html] (title, user):
+    '<!DOCTYPE html>\\n'
+    '<html>\\n'
+    '<head>\\n'
+    '<meta charset="utf-8" />\\n'
+    '<title>'
+    title
+    '</title>\\n'
+    '<link rel="stylesheet" href="/css/site.css" />\\n'
+    '<script src="/js/site.js"></script>\\n'
+    '</head>\\n'
+    '<body>\\n'
+    '<div id="header">\\n'
+    '<ul class="nav">\\n'
+    '<li><a href="/">Home</a></li>\\n'
+    '<li><a href="/about">About</a></li>\\n'
+    '<li><a href="/help">Help</a></li>\\n'
+    '</ul>\\n'
+    '<p class="user">Signed in as '
+    user
+    '</p>\\n'
+    '</div>\\n'
+    '<div id="footer">\\n'
+    '<p>Copyright</p>\\n'
+    '</div>\\n'
+    '</body>\\n'
+    '</html>\\n'
+
+def table [html] (rows):
+    '<table>\\n'
+    for row in rows:
+        '<tr class="%s">' % (row[0] % 2 and 'odd' or 'even')
+        for cell in row:
+            '<td>'
+            cell
+            '</td>'
+        '</tr>\\n'
+    '</table>\\n'
+'''
+
+def load_templates(fold):
+    saved = ptl_compile.TemplateTransformer.fold_constants
+    ptl_compile.TemplateTransformer.fold_constants = fold
+    try:
+        code = ptl_compile.compile_template(StringIO(TEMPLATE),
+                                            '<bench_ptl_fold>')
+    finally:
+        ptl_compile.TemplateTransformer.fold_constants = saved
+    namespace = {}
+    exec code in namespace
+    return namespace
+
+def main():
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    else:
+        number = 20000
+    rows = [(i, 'item %d' % i, 'Tom & Jerry', '<none>', i * 1.5)
+            for i in range(10)]
+    tests = [('layout', ('Page & title', 'someone')),
+             ('table (10 rows)', (rows,))]
+    for label, args in tests:
+        name = label.split()[0]
+        for fold in (0, 1):
+            func = load_templates(fold)[name]
+            best = min(timeit.repeat(lambda: func(*args), number=number,
+                                     repeat=3))
+            print "%-16s %-12s %7.2f usec/call" % (
+                label, fold and 'folded' or 'not folded', best * 1e6 / number)
+
+if __name__ == '__main__':
+    main()
@@ -21,15 +21,20 @@ from quixote.publish import Publisher, \
      get_session, get_session_manager, get_user
 
 # Can't think of anywhere better to put this, so here it is.
-def enable_ptl():
+def enable_ptl(archive=None, watch=0):
     """
-    Installs the import hooks needed to import PTL modules.  This must
+    Installs the import hook needed to import PTL modules.  This must
     be done explicitly because not all Quixote applications need to use
     PTL, and import hooks are deep magic that can cause all sorts of
     mischief and deeply confuse innocent bystanders.  Thus, we avoid
-    invoking them behind the programmer's back.  One known problem is
-    that, if you use ZODB, you must import ZODB before calling this
-    function.
+    invoking them behind the programmer's back.  The hook only handles
+    PTL modules; other imports are left to Python.  'archive' is an
+    optional archive of compiled templates; see ptl_import.  If 'watch'
+    is true, PTL modules are reloaded when their source changes (for
+    development only; see ptl_reload).
     """
     from quixote import ptl_import
-    ptl_import.install()
+    ptl_import.install(archive)
+    if watch:
+        from quixote import ptl_reload
+        ptl_reload.start()
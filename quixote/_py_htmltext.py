@@ -1,5 +1,8 @@
 """Python implementation of the htmltext type, the htmlescape function and
 TemplateIO.
+
+An htmltext object holds either a str or a unicode object; unicode is kept
+as it is until the response is encoded for output.
 """
 
 #$HeadURL: svn+ssh://svn/repos/trunk/quixote/_py_htmltext.py $
@@ -24,17 +27,61 @@ if sys.hexversion < 0x20200b1:
 else:
     classof = type
 
-_format_codes = 'diouxXeEfFgGcrs%'
-_format_re = re.compile(r'%%[^%s]*[%s]' % (_format_codes, _format_codes))
+_string_types = (StringType, UnicodeType)
+
+# matches a format specification: the optional mapping key, flags, width,
+# precision and length modifier, and the conversion
+_format_re = re.compile(r'%(\([^)]*\))?[-+ #0-9.*hlL]*([diouxXeEfFgGcrs%])')
+
+# format string -> (usedict, single, quote_repr); see _analyze_format()
+_format_cache = {}
+_FORMAT_CACHE_SIZE = 1000
+
+def _analyze_format(fmt):
+    # Templates format the same few literals over and over, so the
+    # result of scanning them is remembered.
+    try:
+        return _format_cache[fmt]
+    except KeyError:
+        pass
+    codes = []
+    usedict = 0
+    for key, code in _format_re.findall(fmt):
+        if code != '%':
+            if key:
+                usedict = 1
+            codes.append(code)
+    result = (usedict, len(codes) == 1, 'r' in codes)
+    if len(_format_cache) >= _FORMAT_CACHE_SIZE:
+        _format_cache.clear()
+    _format_cache[fmt] = result
+    return result
+
+def _escape(s):
+    # Most strings need no escaping at all, and for short strings the
+    # 'in' tests are much cheaper than replace() calls.  Long strings are
+    # better off with replace(), which scans using memchr().  Either way
+    # the original object is returned when nothing needs to change.
+    if len(s) > 200:
+        s = s.replace("&", "&amp;") # must be done first
+        s = s.replace("<", "&lt;")
+        s = s.replace(">", "&gt;")
+        s = s.replace('"', "&quot;")
+        return s
+    if '&' in s:
+        s = s.replace("&", "&amp;")
+    if '<' in s:
+        s = s.replace("<", "&lt;")
+    if '>' in s:
+        s = s.replace(">", "&gt;")
+    if '"' in s:
+        s = s.replace('"', "&quot;")
+    return s
 
 def _escape_string(s):
-    if not isinstance(s, StringType):
+    if not isinstance(s, _string_types):
         raise TypeError, 'string required'
-    s = s.replace("&", "&amp;")
-    s = s.replace("<", "&lt;")
-    s = s.replace(">", "&gt;")
-    s = s.replace('"', "&quot;")
-    return s
+    return _escape(s)
 
 class htmltext(object):
     """The htmltext string-like type.  This type serves as a tag
@@ -45,7 +92,12 @@ class htmltext(object):
     __slots__ = ['s']
 
     def __init__(self, s):
-        self.s = str(s)
+        if classof(s) is htmltext:
+            self.s = s.s
+        elif isinstance(s, UnicodeType):
+            self.s = unicode(s)
+        else:
+            self.s = str(s)
 
     # XXX make read-only
     #def __setattr__(self, name, value):
@@ -58,7 +110,10 @@ class htmltext(object):
         return '<htmltext %r>' % self.s
 
     def __str__(self):
-        return self.s
+        return str(self.s)
+
+    def __unicode__(self):
+        return unicode(self.s)
 
     def __len__(self):
         return len(self.s)
@@ -70,23 +125,17 @@ class htmltext(object):
         return hash(self.s)
 
     def __mod__(self, args):
-        codes = []
-        usedict = 0
-        for format in _format_re.findall(self.s):
-            if format[-1] != '%':
-                if format[1] == '(':
-                    usedict = 1
-                codes.append(format[-1])
+        usedict, single, quote_repr = _analyze_format(self.s)
         if usedict:
-            args = _DictWrapper(args)
+            args = _DictWrapper(args, quote_repr)
         else:
-            if len(codes) == 1 and not isinstance(args, TupleType):
+            if single and not isinstance(args, TupleType):
                 args = (args,)
-            args = tuple([_wraparg(arg) for arg in args])
+            args = tuple([_wraparg(arg, quote_repr) for arg in args])
         return self.__class__(self.s % args)
 
     def __add__(self, other):
-        if isinstance(other, StringType):
+        if isinstance(other, _string_types):
             return self.__class__(self.s + _escape_string(other))
         elif classof(other) is self.__class__:
             return self.__class__(self.s + other.s)
@@ -94,7 +143,7 @@ class htmltext(object):
             return NotImplemented
 
     def __radd__(self, other):
-        if isinstance(other, StringType):
+        if isinstance(other, _string_types):
             return self.__class__(_escape_string(other) + self.s)
         else:
             return NotImplemented
@@ -106,8 +155,8 @@ class htmltext(object):
         quoted_items = []
         for item in items:
             if classof(item) is self.__class__:
-                quoted_items.append(str(item))
-            elif isinstance(item, StringType):
+                quoted_items.append(item.s)
+            elif isinstance(item, _string_types):
                 quoted_items.append(_escape_string(item))
             else:
                 raise TypeError(
@@ -160,19 +209,34 @@ class _QuoteWrapper(object):
     def __str__(self):
         return self.escape(str(self.value))
 
+    def __unicode__(self):
+        # used when the format string is unicode
+        return self.escape(unicode(self.value))
+
     def __repr__(self):
         return self.escape(`self.value`)
 
 class _DictWrapper(object):
-    def __init__(self, value):
+    def __init__(self, value, quote_repr=1):
         self.value = value
+        self.quote_repr = quote_repr
 
     def __getitem__(self, key):
-        return _wraparg(self.value[key])
-
-def _wraparg(arg):
-    if (classof(arg) is htmltext or
-        isinstance(arg, IntType) or
+        return _wraparg(self.value[key], self.quote_repr)
+
+def _wraparg(arg, quote_repr=1):
+    if classof(arg) is htmltext:
+        # pass unicode along as such, so that the result becomes unicode
+        # too (str() of the htmltext would try to encode it)
+        if isinstance(arg.s, UnicodeType):
+            return arg.s
+        return arg
+    elif not quote_repr and isinstance(arg, _string_types):
+        # escape strings right away rather than creating a wrapper that
+        # does it later; but repr() must be escaped after the fact, so
+        # that is left to the wrapper
+        return _escape(arg)
+    elif (isinstance(arg, IntType) or
         isinstance(arg, LongType) or
         isinstance(arg, FloatType)):
         # ints, longs, floats, and htmltext are okay
@@ -186,37 +250,59 @@ def htmlescape(s):
 
     Return an 'htmltext' object using the argument.  If the argument is not
     already a 'htmltext' object then the HTML markup characters \", <, >,
-    and & are first escaped.
+    and & are first escaped.  Unicode stays unicode.
     """
     if classof(s) is htmltext:
         return s
-    elif isinstance(s,  UnicodeType):
-        s = s.encode('iso-8859-1')
+    elif isinstance(s, UnicodeType):
+        s = unicode(s)
     else:
         s = str(s)
-    # inline _escape_string for speed
-    s = s.replace("&", "&amp;") # must be done first
-    s = s.replace("<", "&lt;")
-    s = s.replace(">", "&gt;")
-    s = s.replace('"', "&quot;")
-    return htmltext(s)
+    return htmltext(_escape(s))
 
 
 class TemplateIO(object):
     """Collect output for PTL scripts.
+
+    Items are converted to strings (and escaped, for html=1) as they are
+    added, so getvalue() only has to join them.  'size' is a hint of the
+    expected output size; it lets the C implementation preallocate its
+    buffer and is ignored here.
     """
 
     __slots__ = ['html', 'data']
 
-    def __init__(self, html=0):
+    def __init__(self, html=0, size=0):
         self.html = html
         self.data = []
 
     def __iadd__(self, other):
-        if other is not None:
-            self.data.append(other)
+        self.append(other)
         return self
 
+    def append(self, other):
+        """Add 'other' to the output; the same as "self += other".
+        """
+        if other is None:
+            return
+        if classof(other) is htmltext:
+            s = other.s
+        elif isinstance(other, TemplateIO):
+            s = other._join()
+            if self.html and not other.html:
+                s = _escape_string(s)
+        elif self.html:
+            # what htmlescape() does, without the htmltext object
+            if isinstance(other, UnicodeType):
+                s = _escape(unicode(other))
+            else:
+                s = _escape(str(other))
+        elif isinstance(other, UnicodeType):
+            s = other
+        else:
+            s = str(other)
+        self.data.append(s)
+
     def __repr__(self):
         return ("<%s at %x: %d chunks>" %
                 (self.__class__.__name__, id(self), len(self.data)))
@@ -224,8 +310,45 @@ class TemplateIO(object):
     def __str__(self):
         return str(self.getvalue())
 
+    def _join(self):
+        # a mix of str and unicode gives unicode, as with ''.join()
+        s = ''.join(self.data)
+        # keep the joined string, so that calling getvalue() again (or
+        # adding more output) doesn't redo the work
+        self.data = [s]
+        return s
+
     def getvalue(self):
+        s = self._join()
         if self.html:
-            return htmltext('').join(map(htmlescape, self.data))
+            return htmltext(s)
         else:
-            return ''.join(map(str, self.data))
+            return s
+
+
+ValuelessAttr = ["valueless_attr"] # magic singleton object
+
+def htmltag(tag, xml_end=0, css_class=None, **attrs):
+    """Create a HTML tag.
+    """
+    r = ["<%s" % tag]
+    if css_class is not None:
+        attrs['class'] = css_class
+    for (attr, val) in attrs.items():
+        if val is ValuelessAttr:
+            val = attr
+        if val is not None:
+            if not isinstance(val, UnicodeType):
+                val = str(val)
+            r.append(' %s="%s"' % (attr, _escape(val)))
+    if xml_end:
+        r.append(" />")
+    else:
+        r.append(">")
+    return htmltext("".join(r))
+
+
+def href(url, text, title=None, **attrs):
+    return (htmltag("a", href=url, title=title, **attrs) +
+            htmlescape(text) +
+            htmltext("</a>"))
@@ -0,0 +1,518 @@
+"""quixote.cache
+$HeadURL: svn+ssh://svn/repos/trunk/quixote/cache.py $
+$Id$
+
+Caching of rendered template fragments and of whole responses.
+
+Decorate a PTL template (or any function returning a string or
+htmltext) with cached() to keep its output for a while:
+
+    from quixote.cache import cached, invalidate
+
+    @cached(ttl=3600, tags=['nav'], key=lambda request, section: section)
+    def navbar [html] (request, section):
+        ...
+
+    invalidate('nav')   # eg. after the menu was edited
+
+Output is kept per template, per key and per version: the key is made
+from the template's arguments (all of them, or what the 'key' function
+returns), and 'version' lets you throw everything away at once, eg. on
+each deploy.  A hit returns the same type the template returned, so
+cached htmltext is never escaped again, and cached plain strings are
+still escaped when they are added to an [html] template.
+
+The cache used is the publisher's (see Publisher.get_fragment_cache()),
+configured by FRAGMENT_CACHE_SIZE and FRAGMENT_CACHE_DIR.  Each process
+keeps up to FRAGMENT_CACHE_SIZE fragments, least recently used first
+out.  If FRAGMENT_CACHE_DIR is set, fragments are also stored there,
+so they are shared by every process of the application.  Invalidating
+a tag then applies to all of them too.
+
+Whole pages are cached by the publisher when their handler sets a cache
+policy on the response (see HTTPResponse.set_cache_policy() and
+ResponseCache), using RESPONSE_CACHE_SIZE and RESPONSE_CACHE_DIR the
+same way.
+"""
+
+__revision__ = "$Id$"
+
+import os
+import time
+import marshal
+import tempfile
+import threading
+from hashlib import sha1
+from types import StringType, UnicodeType, IntType, LongType, \
+     FloatType, BooleanType, NoneType, TupleType
+from collections import OrderedDict
+
+from quixote.html import htmltext
+
+
+class MemoryStore:
+    """
+    A bounded, thread-safe mapping that forgets the least recently used
+    items when full.  Also keeps the versions of invalidation tags.
+    """
+
+    def __init__(self, max_items=1000):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            value = self._items.pop(key, None)
+            if value is not None:
+                # move it to the end, as the most recently used
+                self._items[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._items.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def get_tag(self, tag):
+        return self._tags.get(tag, 0)
+
+    def invalidate(self, tag):
+        self._lock.acquire()
+        try:
+            self._tags[tag] = self._tags.get(tag, 0) + 1
+        finally:
+            self._lock.release()
+
+
+class FileStore:
+    """
+    A store kept in a directory, that can be shared by processes.  Each
+    item is a file named after the SHA-1 digest of its key, holding a
+    marshalled value, so values must be marshallable.  Files are
+    replaced atomically and nothing is ever locked.
+
+    Expired and invalidated entries are removed when they are read, but
+    nothing removes the entries that are never asked for again: call
+    prune() now and then (eg. from cron) to keep the directory bounded.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, prefix, key):
+        if isinstance(key, UnicodeType):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, prefix + sha1(key).hexdigest())
+
+    def _read(self, path):
+        try:
+            return marshal.loads(open(path, 'rb').read())
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+    def _write(self, path, value):
+        fd, tempname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            os.write(fd, marshal.dumps(value))
+            os.close(fd)
+            os.rename(tempname, path)
+        except:
+            os.unlink(tempname)
+            raise
+
+    def get(self, key):
+        return self._read(self._path('item-', key))
+
+    def set(self, key, value):
+        self._write(self._path('item-', key), value)
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path('item-', key))
+        except OSError:
+            pass
+
+    def prune(self, max_age):
+        """prune(max_age : int | float) -> int
+
+        Remove the items, and the temporary files left by interrupted
+        writes, that were last written more than 'max_age' seconds ago.
+        Tag versions are kept.  Return the number of files removed.
+        """
+        limit = time.time() - max_age
+        count = 0
+        for name in os.listdir(self.directory):
+            if not (name.startswith('item-') or name.endswith('.tmp')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < limit:
+                    os.unlink(path)
+                    count += 1
+            except OSError:
+                # removed by another process meanwhile
+                pass
+        return count
+
+    def get_tag(self, tag):
+        return self._read(self._path('tag-', tag)) or 0
+
+    def invalidate(self, tag):
+        # A random token rather than a counter or a time, so that two
+        # processes invalidating at once never write the same version.
+        self._write(self._path('tag-', tag), os.urandom(8).encode('hex'))
+
+
+class FragmentCache:
+    """
+    Rendered fragments kept in a MemoryStore, in front of an optional
+    shared store (a FileStore).  Tag versions come from the shared
+    store when there is one, so invalidate() reaches every process.
+
+    Entries are (expires, tag versions, is_html, text) tuples; 'expires'
+    is 0 for entries that don't expire.
+    """
+
+    def __init__(self, max_items=1000, store=None):
+        self.memory = MemoryStore(max_items)
+        self.store = store
+
+    def _tags(self):
+        return self.store or self.memory
+
+    def _delete(self, key):
+        self.memory.delete(key)
+        if self.store is not None:
+            self.store.delete(key)
+
+    def get(self, key):
+        """get(key : string) -> string | htmltext | None
+
+        Return the cached value for 'key', or None if it isn't cached,
+        has expired, or one of its tags was invalidated since.
+        """
+        entry = self.memory.get(key)
+        if entry is None and self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None:
+                self.memory.set(key, entry)
+        if entry is None:
+            return None
+        expires, versions, is_html, text = entry
+        if expires and expires < time.time():
+            self._delete(key)
+            return None
+        tags = self._tags()
+        for tag, version in versions.items():
+            if tags.get_tag(tag) != version:
+                self._delete(key)
+                return None
+        if is_html:
+            return htmltext(text)
+        return text
+
+    def get_versions(self, tags):
+        """get_versions(tags : [string]) -> {string : any}
+
+        Return the current versions of 'tags', to pass to set() when
+        the value is rendered after this call.
+        """
+        store = self._tags()
+        versions = {}
+        for tag in tags:
+            versions[tag] = store.get_tag(tag)
+        return versions
+
+    def set(self, key, value, ttl=None, tags=(), versions=None):
+        """Cache 'value' (a string or htmltext) under 'key' for 'ttl'
+        seconds (None for as long as it stays in the cache), until one
+        of 'tags' is invalidated.  'versions', from get_versions(), are
+        the tag versions read before 'value' was rendered; without it,
+        an invalidation made while rendering would go unnoticed.
+        """
+        if isinstance(value, htmltext):
+            is_html = 1
+            text = value.s
+        elif isinstance(value, (StringType, UnicodeType)):
+            is_html = 0
+            text = value
+        else:
+            raise TypeError, "can only cache strings and htmltext"
+        if ttl:
+            expires = time.time() + ttl
+        else:
+            expires = 0
+        if versions is None:
+            versions = self.get_versions(tags)
+        entry = (expires, versions, is_html, text)
+        self.memory.set(key, entry)
+        if self.store is not None:
+            self.store.set(key, entry)
+
+    def invalidate(self, tag):
+        """Drop every fragment cached with 'tag'."""
+        self._tags().invalidate(tag)
+
+
+_default_cache = None
+
+def get_cache():
+    """get_cache() -> FragmentCache
+
+    Return the current publisher's fragment cache, or a cache of the
+    default size when there is no publisher.
+    """
+    global _default_cache
+    from quixote.publish import get_publisher
+    try:
+        return get_publisher().get_fragment_cache()
+    except AttributeError:
+        # no publisher in this thread
+        if _default_cache is None:
+            _default_cache = FragmentCache()
+        return _default_cache
+
+def invalidate(tag, cache=None):
+    """Drop every fragment cached with 'tag'."""
+    (cache or get_cache()).invalidate(tag)
+
+_simple_types = (StringType, UnicodeType, IntType, LongType, FloatType,
+                 BooleanType, NoneType)
+
+def _check_simple(value):
+    # Make sure 'value' has a repr() that identifies it, unlike objects
+    # whose repr() holds their address (eg. a request).
+    if isinstance(value, TupleType):
+        for item in value:
+            _check_simple(item)
+    elif not isinstance(value, _simple_types):
+        raise TypeError, ("can't make a cache key from %r: pass key= to "
+                          "cached()" % (value,))
+
+def cached(ttl=None, tags=(), key=None, version=None, cache=None):
+    """Decorator that caches the output of a template.
+
+    ttl : int | float
+      seconds to keep the output for; None to keep it until it is
+      pushed out of the cache or invalidated
+    tags : [string] | function
+      tags to invalidate the output by; a function is called with the
+      template's arguments and returns the tags
+    key : function
+      called with the template's arguments, returns what identifies the
+      output (a string or tuple of simple values); output is not cached
+      when it returns None.  By default, all the arguments are used,
+      and TypeError is raised unless they are all strings, numbers,
+      None or tuples of these; templates taking a request need 'key'.
+    version : string | function
+      part of every key; change it to drop everything cached before
+    cache : FragmentCache
+      the cache to use instead of get_cache()
+    """
+    def decorate(func):
+        name = '%s.%s' % (func.__module__, func.__name__)
+        def wrapper(*args, **kwargs):
+            if key is None:
+                items = kwargs.items()
+                items.sort()
+                k = (args, tuple(items))
+                _check_simple(k)
+            else:
+                k = key(*args, **kwargs)
+                if k is None:
+                    return func(*args, **kwargs)
+            v = version
+            if callable(v):
+                v = v()
+            cache_key = '%s\0%s\0%r' % (name, v, k)
+            c = cache or get_cache()
+            value = c.get(cache_key)
+            if value is None:
+                if callable(tags):
+                    t = tags(*args, **kwargs)
+                else:
+                    t = tags
+                versions = c.get_versions(t)
+                value = func(*args, **kwargs)
+                c.set(cache_key, value, ttl, versions=versions)
+            return value
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__module__ = func.__module__
+        return wrapper
+    return decorate
+
+
+class ResponseCache:
+    """
+    Complete responses to GET requests, kept for handlers that ask for
+    it with HTTPResponse.set_cache_policy().  Used by the publisher,
+    which looks up responses before traversing the URL.
+
+    The policy a handler sets is remembered for its URL, so that the
+    next request knows which headers and cookies to build the key from
+    and whether it may be served at all.  Responses that set cookies,
+    and responses to requests made with a logged in session when the
+    policy is for anonymous users only, are never stored.
+
+    When a response known to be cacheable is missing, the first thread
+    to ask for it renders it while the others asking for the same key
+    wait up to 'fill_timeout' seconds for it, instead of rendering the
+    same page concurrently.  If that response turns out not to be
+    cacheable, the waiting threads render their own and the URL's policy
+    is forgotten until a response for it is stored again.  This is only
+    done within a process.
+
+    Entries are (expires, status, reason, headers, cache, body,
+    gzip_body) tuples, where 'cache' is the response's cache attribute
+    and 'gzip_body' is None if the body was not compressed.
+    """
+
+    fill_timeout = 10.0
+
+    def __init__(self, max_items=1000, store=None):
+        self.memory = MemoryStore(max_items)
+        self.store = store
+        self._lock = threading.Lock()
+        self._filling = {} # key -> threading.Event
+
+    def _get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.store is not None:
+            value = self.store.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return value
+
+    def _set(self, key, value):
+        self.memory.set(key, value)
+        if self.store is not None:
+            self.store.set(key, value)
+
+    def _delete(self, key):
+        self.memory.delete(key)
+        if self.store is not None:
+            self.store.delete(key)
+
+    def _url_key(self, request):
+        environ = request.environ
+        return 'policy\0%s%s%s?%s' % (
+            environ.get('HTTP_HOST') or environ.get('SERVER_NAME', ''),
+            environ.get('SCRIPT_NAME', ''),
+            environ.get('PATH_INFO', ''),
+            environ.get('QUERY_STRING', ''))
+
+    def _key(self, request, url_key, policy):
+        ttl, headers, cookies, anonymous_only = policy
+        parts = ['response', url_key]
+        for name in headers:
+            parts.append(request.get_header(name) or '')
+        for name in cookies:
+            parts.append(request.get_cookie(name) or '')
+        return '\0'.join(parts)
+
+    def _allowed(self, request, policy):
+        if request.get_method() != 'GET':
+            return 0
+        if policy[3] and request.session is not None and request.session.user:
+            return 0
+        return 1
+
+    def lookup(self, request):
+        """lookup(request : HTTPRequest) -> (entry | None, key | None)
+
+        Return the cached entry for 'request', if any.  On a miss for a
+        URL known to be cacheable, 'key' is returned: the caller must
+        render the response, pass the key to save() and then call
+        release(key), even if rendering fails.
+        """
+        url_key = self._url_key(request)
+        policy = self._get(url_key)
+        if policy is None or not self._allowed(request, policy):
+            return None, None
+        key = self._key(request, url_key, policy)
+        while 1:
+            entry = self._get(key)
+            if entry is not None:
+                if entry[0] >= time.time():
+                    return entry, None
+                self._delete(key)
+            self._lock.acquire()
+            try:
+                event = self._filling.get(key)
+                if event is None:
+                    event = self._filling[key] = threading.Event()
+                    event.stored = 0
+                    return None, key
+            finally:
+                self._lock.release()
+            event.wait(self.fill_timeout)
+            if not event.isSet() or not event.stored:
+                # Give up waiting and render it ourselves: the response
+                # is slow to come, or was not cacheable after all.
+                return None, None
+
+    def save(self, request, body, gzip_body=None, key=None):
+        """Store the response of 'request', whose encoded body is 'body',
+        if its handler set a cache policy that allows it.  'key' is the
+        key returned by lookup(), if any.
+        """
+        response = request.response
+        policy = response.cache_policy
+        url_key = self._url_key(request)
+        if (policy is None or not self._allowed(request, policy) or
+            response.status_code != 200 or response.cookies):
+            if key is not None:
+                # Forget the policy, so that requests for the URL stop
+                # waiting for each other until a response is stored again.
+                self._delete(url_key)
+            return
+        fill_key = key
+        if key is None or self._get(url_key) != policy:
+            self._set(url_key, policy)
+            key = self._key(request, url_key, policy)
+        headers = response.headers.copy()
+        headers.pop('content-length', None)
+        self._set(key, (time.time() + policy[0],
+                        response.status_code, response.reason_phrase,
+                        headers, response.cache, body, gzip_body))
+        if fill_key is not None:
+            self._lock.acquire()
+            try:
+                event = self._filling.get(fill_key)
+                if event is not None:
+                    event.stored = 1
+            finally:
+                self._lock.release()
+
+    def release(self, key):
+        """Wake up the threads waiting for 'key' (see lookup())."""
+        self._lock.acquire()
+        try:
+            event = self._filling.pop(key, None)
+        finally:
+            self._lock.release()
+        if event is not None:
+            event.set()
@@ -33,10 +33,74 @@ __revision__ = "$Id$"
 ERROR_EMAIL = None
 #ERROR_EMAIL = 'webmaster@example.com'
 
+# Error reports are mailed from a background thread.  Repeats of the
+# same error (same exception type and traceback) within
+# ERROR_EMAIL_WINDOW seconds are collapsed into one message with a
+# count, and at most ERROR_EMAIL_LIMIT messages are sent per window.  Set
+# ERROR_EMAIL_WINDOW to 0 to send every report synchronously from the
+# failing request instead.
+ERROR_EMAIL_WINDOW = 60
+ERROR_EMAIL_LIMIT = 10
+
 # Filename for writing the Quixote access log; None for no access log.
 ACCESS_LOG = None
 #ACCESS_LOG = "/www/log/quixote-access.log"
 
+# If non-zero, access log lines are collected in memory and written out
+# by a background thread once ACCESS_LOG_BUFFER bytes are waiting or
+# every ACCESS_LOG_FLUSH_INTERVAL seconds, instead of one write per
+# request.  When the writer falls behind, ACCESS_LOG_OVERFLOW decides
+# whether requests wait for it ('block') or lines are thrown away
+# ('drop').
+ACCESS_LOG_BUFFER = 0
+#ACCESS_LOG_BUFFER = 65536
+ACCESS_LOG_FLUSH_INTERVAL = 1.0
+ACCESS_LOG_OVERFLOW = 'block'
+
+# Format of access log lines.  'common' is Quixote's traditional
+# space-separated line.  'json' and 'logfmt' write one structured record
+# per request that also includes the time spent in each phase of request
+# processing, request and response sizes, and any fields the application
+# added to request.log_fields.
+ACCESS_LOG_FORMAT = 'common'
+
+# Directory for request profiles; None disables profiling.  When set,
+# one request in every PROFILE_EVERY (0 for none) is run under cProfile,
+# as is any request carrying an X-Quixote-Profile header signed with
+# PROFILE_SECRET (see quixote.profiler.make_token()).  Profiles are
+# grouped by handler and only the newest PROFILE_KEEP (at least 1) are
+# kept for each.
+# Use "python -m quixote.profiler report PROFILE_DIR" to read them.
+PROFILE_DIR = None
+#PROFILE_DIR = "/var/tmp/quixote-profile"
+PROFILE_EVERY = 0
+PROFILE_SECRET = None
+PROFILE_KEEP = 100
+
+# If true, the publisher collects request metrics (see quixote.metrics)
+# that a MetricsExporter can publish in Prometheus text format.  Set
+# METRICS_DIR to a directory shared by all worker processes of the
+# application to have the numbers added up across them.
+METRICS = 0
+METRICS_DIR = None
+
+# Number of rendered fragments each process keeps for templates
+# decorated with quixote.cache.cached().  If FRAGMENT_CACHE_DIR is set,
+# fragments are also stored in that directory, to be shared by all
+# worker processes of the application.  Entries that are never read
+# again stay in the directory: prune it regularly, eg. with
+# quixote.cache.FileStore(dir).prune(max_age) run from cron.
+FRAGMENT_CACHE_SIZE = 1000
+FRAGMENT_CACHE_DIR = None
+#FRAGMENT_CACHE_DIR = "/var/tmp/quixote-fragments"
+
+# Number of complete responses each process keeps for handlers that
+# call request.response.set_cache_policy(); 0 disables response caching.
+# If RESPONSE_CACHE_DIR is set, responses are also stored there and
+# shared by all worker processes; prune that directory the same way.
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_DIR = None
+
 # Filename for logging error messages; if None, everything will be sent
 # to standard error, so it should wind up in the Web server's error log
 # file.
@@ -84,9 +148,29 @@ RUN_ONCE = 0
 # latency links like dialup lines.
 FIX_TRAILING_SLASH = 1
 
+# The encoding used for text (unicode) output: templates, htmltext and
+# strings may produce unicode, which HTTPResponse.set_body() encodes once
+# with this charset.  It is also named in the default Content-Type.
+OUTPUT_ENCODING = 'iso-8859-1'
+
+# If true, Publisher.publish() writes complete HTTP responses, starting
+# with a status line, rather than CGI output with a "Status" header for
+# the web server to parse.  Use this for "non-parsed header" CGI
+# scripts (usually named nph-*) and servers that pass the output through
+# untouched.  Streams of unknown length are sent with chunked encoding to
+# HTTP/1.1 clients.
+NPH = 0
+
 # Compress large pages using gzip if the client accepts that encoding.
 COMPRESS_PAGES = 0
 
+# If true, successful responses to GET and HEAD requests get an ETag
+# header computed from a hash of the body (unless the handler set one),
+# and requests whose If-None-Match header lists it get an empty 304 (Not
+# Modified) response.  Handlers that can tell cheaply whether a page
+# changed can also use request.not_modified() to avoid rendering it.
+GENERATE_ETAGS = 0
+
 # If true, then a cryptographically secure token will be inserted into forms
 # as a hidden field.  The token will be checked when the form is submitted.
 # This prevents cross-site request forgeries (CSRF).  It is off by default
@@ -149,6 +233,17 @@ MAIL_SERVER = "localhost"
 # single, bare e-mail address.
 MAIL_DEBUG_ADDR = None   # eg. "developers@example.com"
 
+# Up to MAIL_POOL_SIZE connections to MAIL_SERVER are kept open between
+# messages and reused if they have been idle for less than
+# MAIL_IDLE_TIMEOUT seconds.
+MAIL_POOL_SIZE = 2
+MAIL_IDLE_TIMEOUT = 60
+
+# If true, sendmail() queues messages and returns immediately; a
+# background thread delivers them, and delivery errors are written to
+# stderr rather than raised.
+MAIL_OUTBOX = 0
+
 
 # HTTP file upload variables
 # ==========================
@@ -197,7 +292,23 @@ class Config:
 
     config_vars = [
         'error_email',
+        'error_email_window',
+        'error_email_limit',
         'access_log',
+        'access_log_buffer',
+        'access_log_flush_interval',
+        'access_log_overflow',
+        'access_log_format',
+        'profile_dir',
+        'profile_every',
+        'profile_secret',
+        'profile_keep',
+        'metrics',
+        'metrics_dir',
+        'fragment_cache_size',
+        'fragment_cache_dir',
+        'response_cache_size',
+        'response_cache_dir',
         'debug_log',
         'display_exceptions',
         'debug_propagate_exceptions',
@@ -205,7 +316,10 @@ class Config:
         'error_log',
         'run_once',
         'fix_trailing_slash',
+        'output_encoding',
+        'nph',
         'compress_pages',
+        'generate_etags',
         'form_tokens',
         'session_cookie_domain',
         'session_cookie_name',
@@ -214,6 +328,9 @@ class Config:
         'mail_from',
         'mail_server',
         'mail_debug_addr',
+        'mail_pool_size',
+        'mail_idle_timeout',
+        'mail_outbox',
         'upload_dir',
         'upload_dir_mode',
         'support_application_json',
@@ -275,6 +392,29 @@ class Config:
                               source,
                               "DISPLAY_EXCEPTIONS")
 
+        if self.access_log_overflow not in (None, 'block', 'drop'):
+            raise ConfigError("Must be 'block' or 'drop'",
+                              source,
+                              "ACCESS_LOG_OVERFLOW")
+
+        if self.access_log_format not in (None, 'common', 'json', 'logfmt'):
+            raise ConfigError("Must be 'common', 'json', or 'logfmt'",
+                              source,
+                              "ACCESS_LOG_FORMAT")
+
+        if not (isinstance(self.profile_keep, int) and
+                self.profile_keep >= 1):
+            raise ConfigError("Must be an integer of at least 1",
+                              source,
+                              "PROFILE_KEEP")
+
+        import codecs
+        try:
+            codecs.lookup(self.output_encoding)
+        except LookupError:
+            raise ConfigError("Unknown encoding",
+                              source,
+                              "OUTPUT_ENCODING")
 
     def read_file(self, filename):
         """Read configuration from a file.  Any variables already
@@ -0,0 +1,204 @@
+"""quixote.errormail
+$HeadURL: svn+ssh://svn/repos/trunk/quixote/errormail.py $
+$Id$
+
+Send error reports from a background thread, collapsing repeats.
+
+Exceptions are fingerprinted by their type and the frames of their
+traceback.  The first report for a fingerprint is mailed right away;
+further reports of the same error within 'window' seconds are counted
+and go out as a single message once the window has passed.  No more
+than 'limit' messages are sent per window in total, so a broken deploy
+produces a handful of messages rather than one per failing request.
+"""
+
+__revision__ = "$Id$"
+
+import os
+import sys
+import time
+import atexit
+import traceback
+import threading
+from hashlib import sha1
+
+
+def fingerprint(exc_type, tb):
+    """fingerprint(exc_type : class, tb : traceback) -> string
+
+    Return a string identifying where an exception of 'exc_type' was
+    raised.  The exception value is ignored on purpose: the same bug
+    hit with different data should only be reported once.
+    """
+    parts = ['%s.%s' % (getattr(exc_type, '__module__', ''),
+                        getattr(exc_type, '__name__', exc_type))]
+    for filename, lineno, name, line in traceback.extract_tb(tb):
+        parts.append('%s:%s:%d' % (filename, name, lineno))
+    return sha1('\n'.join(parts)).hexdigest()
+
+
+class _Report:
+
+    def __init__(self, summary, msg, due):
+        self.summary = summary
+        self.msg = msg
+        self.count = 1
+        self.first_time = time.time()
+        self.due = due
+
+
+class ErrorMailer:
+    """
+    Queue of error reports that are mailed from a background thread.
+
+    'send' is called as send(msg, summary) for every message that goes
+    out; 'log' is called with a string if sending fails.
+
+    Instance attributes:
+      window : float
+        seconds over which repeats of one error are collapsed, and over
+        which 'limit' applies
+      limit : int
+        maximum number of messages sent per window
+      max_pending : int
+        maximum number of distinct errors waiting to be sent; reports
+        beyond that are counted in 'dropped' and otherwise ignored
+      dropped : int
+    """
+
+    def __init__(self, send, log=None, window=60, limit=10, max_pending=100):
+        self.send = send
+        self.log = log
+        self.window = window
+        self.limit = limit
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending = {}   # fingerprint -> _Report
+        self._last_sent = {} # fingerprint -> time
+        self._sent_times = [] # times of messages sent in the last window
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._stopped = 0
+        atexit.register(self._shutdown)
+
+    def report(self, key, msg, summary):
+        """Queue an error report identified by 'key' (see fingerprint())."""
+        cond = self._cond
+        cond.acquire()
+        try:
+            if self._pid != os.getpid() and not self._stopped:
+                self._start_thread()
+            report = self._pending.get(key)
+            if report is not None:
+                report.count += 1
+                return
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            now = time.time()
+            due = max(now, self._last_sent.get(key, 0) + self.window)
+            self._pending[key] = _Report(summary, msg, due)
+            cond.notify()
+        finally:
+            cond.release()
+
+    def _start_thread(self):
+        # Called with the lock held; restarted after a fork.
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run,
+                                        name="quixote-error-mailer")
+        self._thread.setDaemon(1)
+        self._thread.start()
+
+    def _next_batch(self, now, force=0):
+        # Called with the lock held.  Returns the reports that may be sent
+        # now, and the time at which to look again.
+        cutoff = now - self.window
+        self._sent_times = [t for t in self._sent_times if t > cutoff]
+        for key, when in self._last_sent.items():
+            if when <= cutoff:
+                del self._last_sent[key]
+        due = [(report.due, key) for key, report in self._pending.items()
+               if force or report.due <= now]
+        due.sort()
+        batch = []
+        for when, key in due:
+            if len(self._sent_times) >= self.limit:
+                break
+            batch.append(self._pending.pop(key))
+            self._sent_times.append(now)
+            self._last_sent[key] = now
+        wake = [report.due for report in self._pending.values()]
+        if self._sent_times and len(self._sent_times) >= self.limit:
+            wake.append(self._sent_times[0] + self.window)
+        if wake:
+            return batch, max(min(wake), now + 0.01)
+        return batch, None
+
+    def _send(self, batch):
+        for report in batch:
+            msg = report.msg
+            summary = report.summary
+            if report.count > 1:
+                summary = '%s [%d times]' % (summary, report.count)
+                msg = ('This error occurred %d times since %s.  The first '
+                       'occurrence follows.\n\n%s'
+                       % (report.count,
+                          time.strftime('%Y-%m-%d %H:%M:%S',
+                                        time.localtime(report.first_time)),
+                          msg))
+            try:
+                self.send(msg, summary)
+            except Exception:
+                if self.log is not None:
+                    exc_type, exc_value = sys.exc_info()[:2]
+                    self.log('error sending error report (%s): %s'
+                             % (summary, ''.join(
+                                 traceback.format_exception_only(exc_type,
+                                                                 exc_value))
+                                .strip()))
+
+    def _run(self):
+        cond = self._cond
+        while 1:
+            cond.acquire()
+            try:
+                if self._stopped:
+                    break
+                batch, wake = self._next_batch(time.time())
+                if not batch:
+                    if wake is None:
+                        cond.wait()
+                    else:
+                        cond.wait(wake - time.time())
+                    continue
+            finally:
+                cond.release()
+            self._send(batch)
+
+    def flush(self):
+        """Send everything pending now, in the calling thread, still
+        respecting the rate limit.  Called at exit so that single-request
+        processes (eg. CGI) do not lose their reports.
+        """
+        self._cond.acquire()
+        try:
+            batch, wake = self._next_batch(time.time(), force=1)
+        finally:
+            self._cond.release()
+        self._send(batch)
+
+    def _shutdown(self):
+        # Stop the thread while the interpreter is still intact, then
+        # send whatever is left.
+        self._cond.acquire()
+        try:
+            self._stopped = 1
+            self._cond.notify()
+            thread = self._thread
+        finally:
+            self._cond.release()
+        if thread is not None and self._pid == os.getpid():
+            thread.join(1.0)
+        self.flush()
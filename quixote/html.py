@@ -62,35 +62,10 @@ from types import UnicodeType
 try:
     # faster C implementation
     from quixote._c_htmltext import htmltext, htmlescape, _escape_string, \
-        TemplateIO
+        TemplateIO, htmltag, href, ValuelessAttr
 except ImportError:
     from quixote._py_htmltext import htmltext, htmlescape, _escape_string, \
-        TemplateIO
-
-ValuelessAttr = ["valueless_attr"] # magic singleton object
-
-def htmltag(tag, xml_end=0, css_class=None, **attrs):
-    """Create a HTML tag.
-    """
-    r = ["<%s" % tag]
-    if css_class is not None:
-        attrs['class'] = css_class
-    for (attr, val) in attrs.items():
-        if val is ValuelessAttr:
-            val = attr
-        if val is not None:
-            r.append(' %s="%s"' % (attr, _escape_string(str(val))))
-    if xml_end:
-        r.append(" />")
-    else:
-        r.append(">")
-    return htmltext("".join(r))
-
-
-def href(url, text, title=None, **attrs):
-    return (htmltag("a", href=url, title=title, **attrs) +
-            htmlescape(text) +
-            htmltext("</a>"))
+        TemplateIO, htmltag, href, ValuelessAttr
 
 
 def nl2br(value):
@@ -105,7 +80,8 @@ def nl2br(value):
 def url_quote(value, fallback=None):
     """url_quote(value : any [, fallback : string]) -> string
 
-    Quotes 'value' for use in a URL; see urllib.quote().  If value is None,
+    Quotes 'value' for use in a URL; see urllib.quote().  Unicode is
+    encoded as UTF-8 first, as RFC 3986 recommends.  If value is None,
     then the behavior depends on the fallback argument.  If it is not
     supplied then an error is raised.  Otherwise, the fallback value is
     returned unquoted.
@@ -116,7 +92,7 @@ def url_quote(value, fallback=None):
         else:
             return fallback
     if isinstance(value,  UnicodeType):
-        value = value.encode('iso-8859-1')
+        value = value.encode('utf-8')
     else:
         value = str(value)
     return urllib.quote(value)
@@ -131,25 +107,19 @@ def html_quote(value, fallback=None):
     """html_quote(value : any [, fallback : string]) -> str
 
     Quotes 'value' for use in an HTML page.  The special characters &,
-    <, > are replaced by SGML entities.  If value is None, then the
-    behavior depends on the fallback argument.  If it is not supplied
-    then an error is raised.  Otherwise, the fallback value is returned
-    unquoted.
+    <, > are replaced by SGML entities; unicode stays unicode.  If value
+    is None, then the behavior depends on the fallback argument.  If it
+    is not supplied then an error is raised.  Otherwise, the fallback
+    value is returned unquoted.
     """
     if value is None:
         if fallback is None:
             raise ValueError, "value is None and no fallback supplied"
         else:
             return fallback
-    elif isinstance(value,  UnicodeType):
-        value = value.encode('iso-8859-1')
-    else:
+    elif not isinstance(value,  UnicodeType):
         value = str(value)
-    value = value.replace("&", "&amp;") # must be done first
-    value = value.replace("<", "&lt;")
-    value = value.replace(">", "&gt;")
-    value = value.replace('"', "&quot;")
-    return value
+    return _escape_string(value)
 
 
 def value_quote(value):
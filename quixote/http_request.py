@@ -26,6 +26,7 @@ __revision__ = "$Id$"
 
 import re
 import time
+import rfc822
 import urlparse, urllib
 from cgi import FieldStorage
 from types import ListType
@@ -95,6 +96,11 @@ class HTTPRequest:
     the response object in other ways, you can do so via 'response'.
     Just keep in mind that Quixote discards the original response object
     when handling an exception.
+
+    The 'timings' attribute maps the name of each phase of request
+    processing ("parse", "traverse", "handler", ...) to the seconds it
+    took, and 'log_fields' collects extra name/value pairs that end up
+    in a structured access log line (see ACCESS_LOG_FORMAT).
     """
 
     def __init__(self, stdin, environ, content_type=None):
@@ -108,6 +114,9 @@ class HTTPRequest:
         self.session = None
         self.response = HTTPResponse()
         self.start_time = None
+        self.timings = {}
+        self.log_fields = {}
+        self.log_deferred = 0
 
         # The strange treatment of SERVER_PORT_SECURE is because IIS
         # sets this environment variable to "0" for non-SSL requests
@@ -520,6 +529,70 @@ class HTTPRequest:
         location = _http_redir_re.sub('', location)
         return self.response.redirect(location, permanent)
 
+    def etag_matches(self, etag):
+        """etag_matches(etag : string) -> boolean
+
+        Return true if the "If-None-Match" header lists 'etag' (a quoted
+        entity tag), or is "*".  Weak and strong tags match each other.
+        """
+        header = self.get_header("if-none-match")
+        if not header:
+            return 0
+        etag = _strip_weak(etag)
+        for tag in header.split(","):
+            tag = tag.strip()
+            if tag == "*" or _strip_weak(tag) == etag:
+                return 1
+        return 0
+
+    def not_modified(self, etag=None, last_modified=None):
+        """not_modified(etag : string = None, last_modified : float = None)
+           -> boolean
+
+        Set the "ETag" and/or "Last-Modified" headers of the response
+        from a version tag or timestamp of the resource, and return true
+        if the client already has that version (per "If-None-Match", or
+        "If-Modified-Since" if no 'etag' is given).  The response status
+        is then set to 304, and the handler can return an empty string
+        without rendering anything:
+
+            if request.not_modified(etag=str(page.version)):
+                return ""
+        """
+        response = self.response
+        if last_modified is not None:
+            response.set_header("Last-Modified",
+                                rfc822.formatdate(last_modified))
+        if etag is not None:
+            if not (etag.startswith('"') or etag.startswith('W/"')):
+                etag = '"%s"' % etag
+            response.set_header("ETag", etag)
+            # the publisher tags compressed bodies with a "-gzip" suffix
+            match = (self.etag_matches(etag) or
+                     self.etag_matches(etag[:-1] + '-gzip"'))
+        elif last_modified is not None:
+            since = self.get_header("if-modified-since")
+            match = 0
+            if since:
+                date = rfc822.parsedate_tz(since)
+                if date is not None:
+                    try:
+                        match = rfc822.mktime_tz(date) >= int(last_modified)
+                    except (OverflowError, ValueError):
+                        pass
+        else:
+            match = 0
+        if match and self.get_method() in ("GET", "HEAD"):
+            response.set_status(304)
+            return 1
+        return 0
+
+
+def _strip_weak(etag):
+    if etag.startswith("W/"):
+        return etag[2:]
+    return etag
+
 
 class HTTPJSONRequest(HTTPRequest):
     def process_inputs(self):
@@ -23,9 +23,11 @@ copyright and license from the rest of Quixote).
 
 __revision__ = "$Id$"
 
+import re
 import time
 from rfc822 import formatdate
-from types import StringType, IntType
+from types import StringType, IntType, UnicodeType
+from quixote.html import htmltext
 
 status_reasons = {
     100: 'Continue',
@@ -76,6 +78,55 @@ status_reasons = {
     507: 'Insufficient Storage',
 }
 
+# "Status" header values for the standard reason phrases, so that
+# generate_headers() doesn't have to format them for every response.
+_status_lines = {}
+for _code, _reason in status_reasons.items():
+    _status_lines[(_code, _reason)] = "%03d %s" % (_code, _reason)
+del _code, _reason
+
+# Canonical spelling of header names, keyed by the lowercase name that
+# HTTPResponse.headers uses.  Other names are added as responses use
+# them, up to _MAX_HEADER_NAMES in all, so that an application setting
+# headers named after request data can't make it grow without bound.
+_MAX_HEADER_NAMES = 200
+_header_names = {
+    'content-type': 'Content-Type',
+    'content-length': 'Content-Length',
+    'content-encoding': 'Content-Encoding',
+    'location': 'Location',
+    'last-modified': 'Last-Modified',
+    'cache-control': 'Cache-Control',
+    'expires': 'Expires',
+    'date': 'Date',
+    'etag': 'Etag',
+    }
+
+def _header_name(name):
+    canonical = _header_names.get(name)
+    if canonical is None:
+        canonical = name.title()
+        if len(_header_names) < _MAX_HEADER_NAMES:
+            _header_names[name] = canonical
+    return canonical
+
+_charset_re = re.compile(r';\s*charset\s*=\s*"?([^\s;"]+)', re.I)
+
+_date_cache = {}
+
+def _format_date(now):
+    """Return formatdate(now), reusing the string built for the same
+    second.  Both Date and Expires go through here, so a few seconds'
+    worth of strings are kept.
+    """
+    second = int(now)
+    date = _date_cache.get(second)
+    if date is None:
+        if len(_date_cache) > 100:
+            _date_cache.clear()
+        date = _date_cache[second] = formatdate(second)
+    return date
+
 
 class HTTPResponse:
     """
@@ -103,12 +154,20 @@ class HTTPResponse:
         "Content-type" or "Content-length" headers.  These headers
         are set as soon as the body is set (with set_body()), even
         if the body is an empty string.
+      charset : string
+        the encoding applied by set_body() to text (unicode) bodies,
+        and named in the default "Content-type" header.  Publisher sets
+        it from the OUTPUT_ENCODING config variable.
       buffered : bool
         if false, response data will be flushed as soon as it is
         written (the default is true).  This is most useful for
         responses that use the Stream() protocol.  Note that whether the
         client actually receives the partial response data is highly
         dependent on the web server
+      buffer_size : int
+        when 'buffered' is true, Stream chunks are collected until this
+        many bytes are waiting and then written with a single call;
+        bodies smaller than this are written together with the headers
       cookies : { name:string : { attrname : value } }
         collection of cookies to set in this response; it is expected
         that the user-agent will remember the cookies and send them on
@@ -119,6 +178,11 @@ class HTTPResponse:
         meaning don't cache at all.  This variable is used to set the HTTP
         expires header.  If set to None then the expires header will not be
         added.
+      cache_policy : (ttl:int, vary_headers:(string), vary_cookies:(string),
+                      anonymous_only:bool) | None
+        if set (with set_cache_policy()), the publisher may keep this
+        response and send it again for the same URL (see
+        quixote.cache.ResponseCache)
       javascript_code : { string : string }
         a collection of snippets of JavaScript code to be included in
         the response.  The collection is built by calling add_javascript(),
@@ -126,12 +190,18 @@ class HTTPResponse:
         else's problem.
     """
 
-    def __init__(self, status=200, body=None):
+    buffer_size = 65536
+    charset = 'iso-8859-1'
+
+    def __init__(self, status=200, body=None, charset=None):
         """
-        Creates a new HTTP response.
+        Creates a new HTTP response.  'charset' overrides the class
+        default used to encode text bodies.
         """
         self.set_status(status)
         self.headers = {}
+        if charset is not None:
+            self.charset = charset
 
         if body is not None:
             self.set_body(body)
@@ -140,6 +210,7 @@ class HTTPResponse:
 
         self.cookies = {}
         self.cache = 0
+        self.cache_policy = None
         self.buffered = 1
         self.javascript_code = None
 
@@ -195,23 +266,74 @@ class HTTPResponse:
         """
         self.headers["content-type"] = ctype
 
+    def set_cache_policy(self, ttl, vary_headers=(), vary_cookies=(),
+                         anonymous_only=1):
+        """set_cache_policy(ttl : int, vary_headers : [string] = (),
+                            vary_cookies : [string] = (),
+                            anonymous_only : bool = true)
+
+        Let the publisher serve this response again, without calling the
+        handler, to GET requests for the same URL during the next 'ttl'
+        seconds.  Requests that differ in any of the 'vary_headers' or
+        'vary_cookies' get responses of their own.  If 'anonymous_only'
+        is true, requests made with a logged in session (one with a
+        user) are always passed to the handler.  Responses that set
+        cookies are never cached.
+        """
+        self.cache_policy = (ttl,
+                             tuple([name.lower() for name in vary_headers]),
+                             tuple(vary_cookies),
+                             anonymous_only and 1 or 0)
+
     def set_body(self, body):
         """set_body(body : any)
 
         Sets the return body equal to the argument "body". Also updates the
         "Content-length" header if the length is of the body is known.  If
         the "Content-type" header has not yet been set, it is set to
-        "text/html".
+        "text/html".  Text is encoded using 'charset' (see encode()).
         """
         if isinstance(body, Stream):
             self.body = body
             if body.length is not None:
                 self.set_header('content-length', body.length)
         else:
-            self.body = str(body)
+            self.body = self.encode(body)
             self.set_header('content-length', len(self.body))
         if not self.headers.has_key('content-type'):
-            self.set_header('content-type', 'text/html; charset=iso-8859-1')
+            self.set_header('content-type',
+                            'text/html; charset=%s' % self.charset)
+
+    def encode(self, body):
+        """encode(body : any) -> string
+
+        Return 'body' as a str.  Unicode, and htmltext holding unicode,
+        is encoded using the charset of the Content-Type header if it
+        names one, and 'charset' otherwise; anything else is passed to
+        str().  In HTML, characters the charset can't represent become
+        character references; in other content they raise
+        UnicodeEncodeError.  This is the one place templates' text
+        output gets encoded.
+        """
+        is_html = isinstance(body, htmltext)
+        if is_html:
+            body = body.s
+        if isinstance(body, UnicodeType):
+            ctype = self.headers.get('content-type')
+            charset = self.charset
+            if ctype is None:
+                is_html = 1
+            else:
+                match = _charset_re.search(ctype)
+                if match:
+                    charset = match.group(1)
+                ctype = ctype.lower()
+                if ctype.startswith('text/html') or 'xhtml' in ctype:
+                    is_html = 1
+            if is_html:
+                return body.encode(charset, 'xmlcharrefreplace')
+            return body.encode(charset)
+        return str(body)
 
     def expire_cookie(self, name, **attrs):
         """
@@ -325,14 +447,19 @@ class HTTPResponse:
 
         Generate a list of headers to be returned as part of the response.
         """
-        headers = []
-
         # "Status" header must come first.
-        headers.append(("Status", "%03d %s" % (self.status_code,
-                                               self.reason_phrase)))
-
-        for name, value in self.headers.items():
-            headers.append((name.title(), value))
+        status = _status_lines.get((self.status_code, self.reason_phrase))
+        if status is None:
+            status = "%03d %s" % (self.status_code, self.reason_phrase)
+        headers = [("Status", status)]
+
+        items = self.headers.items()
+        if self.status_code < 200 or self.status_code in (204, 304):
+            # these never have a body, whatever set_body() was given
+            items = [item for item in items if item[0] != 'content-length']
+        names = _header_names
+        for name, value in items:
+            headers.append((names.get(name) or _header_name(name), value))
 
         # All the "Set-Cookie" headers.
         if self.cookies:
@@ -340,15 +467,15 @@ class HTTPResponse:
 
         # Date header
         now = time.time()
-        if not self.headers.has_key("date"):
-            headers.append(("Date", formatdate(now)))
+        if "date" not in self.headers:
+            headers.append(("Date", _format_date(now)))
 
         # Cache directives
         if self.cache is None:
             pass # don't mess with the expires header
-        elif not self.headers.has_key("expires"):
+        elif "expires" not in self.headers:
             if self.cache > 0:
-                expire_date = formatdate(now + self.cache)
+                expire_date = _format_date(now + self.cache)
             else:
                 expire_date = "-1" # allowed by HTTP spec and may work better
                                    # with some clients
@@ -356,50 +483,167 @@ class HTTPResponse:
 
         return headers
 
+    def generate_header_block(self, http_version=None, chunked=0):
+        """generate_header_block(http_version : string = None,
+                                 chunked : bool = false) -> string
 
-    def write(self, file):
-        """write(file : file)
-
-        Write the HTTP response headers and body to 'file'.  This is not
-        a complete HTTP response, as it doesn't start with a response
-        status line as specified by RFC 2616.  It does, however, start
-        with a "Status" header as described by the CGI spec.  It
-        is expected that this response is parsed by the web server
-        and turned into a complete HTTP response.
+        Return the headers from generate_headers() formatted as a CGI
+        header block, including the blank line that ends it.  If
+        'http_version' is given, the block starts with an HTTP status
+        line instead of a "Status" header (see write()), and 'chunked'
+        adds a "Transfer-Encoding: chunked" header.
         """
-        # XXX currently we write a response like this:
-        #  Status: 200 OK
-        #  Content-type: text/html; charset=iso-8859-1
-        #  Content-length: 100
-        #  Set-Cookie: foo=bar
-        #  Set-Cookie: bar=baz
-        #
-        #  <html><body>This is a document</body></html>
-        #
-        # which has to be interpreted by the web server to create
-        # a true HTTP response -- that is, this is for a
-        # "parsed header" CGI driver script.
-        #
-        # We should probably have provisions for operating in
-        # "non-parsed header" mode, where the CGI script is responsible
-        # for generating a complete HTTP response with no help from the
-        # server.
+        headers = self.generate_headers()
+        if http_version is None:
+            lines = ["%s: %s\r\n" % header for header in headers]
+        else:
+            lines = ["%s %s\r\n" % (http_version, headers[0][1])]
+            lines.extend(["%s: %s\r\n" % header for header in headers[1:]])
+            if chunked:
+                lines.append("Transfer-Encoding: chunked\r\n")
+        lines.append("\r\n")
+        return "".join(lines)
+
+
+    def write(self, file, http_version=None, send_body=1):
+        """write(file : file, http_version : string = None,
+                 send_body : bool = true)
+
+        Write the HTTP response headers and body to 'file'.
+
+        By default this is not a complete HTTP response, as it doesn't
+        start with a response status line as specified by RFC 2616.  It
+        does, however, start with a "Status" header as described by the
+        CGI spec, and it is expected that this response is parsed by the
+        web server and turned into a complete HTTP response.  For
+        example:
+          Status: 200 OK
+          Content-type: text/html; charset=iso-8859-1
+          Content-length: 100
+          Set-Cookie: foo=bar
+
+          <html><body>This is a document</body></html>
+
+        If 'http_version' ("HTTP/1.0" or "HTTP/1.1") is given, a complete
+        response is written instead ("non-parsed header" mode): it starts
+        with a status line, and a Stream body of unknown length is sent
+        with chunked transfer-coding to HTTP/1.1 clients.  In that mode
+        no body is sent for 1xx, 204 and 304 responses, nor when
+        'send_body' is false (eg. for HEAD requests).
+        """
+        # The headers and body are handed to 'file' in as few write()
+        # calls as possible, since on unbuffered sockets and pipes each
+        # one is a system call.
         flush_output = not self.buffered and hasattr(file, 'flush')
-        for name, value in self.generate_headers():
-            file.write("%s: %s\r\n" % (name, value))
-        file.write("\r\n")
-        if self.body is not None:
-            if isinstance(self.body, Stream):
-                for chunk in self.body:
-                    file.write(chunk)
-                    if flush_output:
-                        file.flush()
-            else:
-                file.write(self.body)
+        body = self.body
+        chunked = 0
+        if http_version is not None:
+            status = self.status_code
+            if status < 200 or status == 204 or status == 304:
+                send_body = 0
+            if (send_body and isinstance(body, Stream) and
+                    body.length is None and http_version == "HTTP/1.1"):
+                chunked = 1
+        header_block = self.generate_header_block(http_version, chunked)
+        if body is None or not send_body:
+            file.write(header_block)
+        elif isinstance(body, Stream):
+            self._write_stream(file, header_block, body, chunked)
+        elif len(body) < self.buffer_size:
+            file.write(header_block + body)
+        else:
+            # don't copy a large body just to save one call
+            file.write(header_block)
+            file.write(body)
         if flush_output:
             file.flush()
 
 
+    def _write_stream(self, file, header_block, stream, chunked):
+        can_flush = hasattr(file, 'flush')
+        flush_bytes = stream.flush_bytes
+        if not self.buffered:
+            # every chunk goes out as soon as it is produced, starting
+            # with the headers
+            flush_bytes = 1
+            file.write(header_block)
+            header_block = None
+            if can_flush:
+                file.flush()
+        for segment in _segment(iter(stream), self.buffer_size,
+                                flush_bytes, stream.flush_interval):
+            if segment is FLUSH:
+                if header_block is not None:
+                    file.write(header_block)
+                    header_block = None
+                if can_flush:
+                    file.flush()
+                continue
+            if chunked:
+                segment = "%x\r\n%s\r\n" % (len(segment), segment)
+            if header_block is not None:
+                # send the headers along with the first segment
+                segment = header_block + segment
+                header_block = None
+            file.write(segment)
+        trailer = ""
+        if chunked:
+            trailer = "0\r\n\r\n"
+        if header_block is not None:
+            trailer = header_block + trailer
+        if trailer:
+            file.write(trailer)
+
+
+def _segment(chunks, buffer_size, flush_bytes=None, flush_interval=None):
+    """Regroup the strings produced by 'chunks' into segments of up to
+    about 'buffer_size' bytes, yielding FLUSH after each segment that
+    should be flushed to the client.  That is the case when 'chunks'
+    yields FLUSH itself, when at least 'flush_bytes' bytes have been
+    produced since the last flush, or when data is waiting and
+    'flush_interval' seconds have passed since the last flush.  Empty
+    strings are dropped (an empty chunk would end a chunked body early).
+    """
+    pending = []
+    pending_size = 0
+    unflushed = 0
+    last_flush = time.time()
+    for chunk in chunks:
+        if chunk is FLUSH:
+            flush = 1
+        elif not chunk:
+            continue
+        else:
+            pending.append(chunk)
+            pending_size += len(chunk)
+            unflushed += len(chunk)
+            flush = ((flush_bytes is not None and unflushed >= flush_bytes) or
+                     (flush_interval is not None and
+                      time.time() - last_flush >= flush_interval))
+            if not flush and pending_size < buffer_size:
+                continue
+        if pending:
+            yield "".join(pending)
+            pending = []
+            pending_size = 0
+        if flush:
+            yield FLUSH
+            unflushed = 0
+            last_flush = time.time()
+    if pending:
+        yield "".join(pending)
+
+
+class _Flush:
+
+    def __repr__(self):
+        return "FLUSH"
+
+# Yielded by a Stream's iterator to have everything produced so far sent
+# to the client right away.
+FLUSH = _Flush()
+
+
 class Stream:
     """
     A wrapper around response data that can be streamed.  The 'iterable'
@@ -414,10 +658,32 @@ class Stream:
       length: int | None
         the number of bytes that will be produced by the stream, None
         if it is not known.  Used to set the Content-Length header.
+        Otherwise, the stream is sent with chunked transfer-coding when
+        possible (see HTTPResponse.write()).
+      flush_bytes : int | None
+        flush the output once this many bytes have been produced since
+        the last flush
+      flush_interval : float | None
+        flush the output when data has been waiting for this many
+        seconds.  This is checked as each item is produced; a stream
+        that blocks for a long time should yield FLUSH first.
+
+    The iterable may also yield FLUSH at any point to have everything
+    produced so far (including the headers) sent immediately.  Without
+    any of these, output is only flushed when the response is complete,
+    unless the response is not buffered, in which case every item is
+    flushed as it is produced.
     """
-    def __init__(self, iterable, length=None):
+
+    flush_bytes = None
+    flush_interval = None
+
+    def __init__(self, iterable, length=None, flush_bytes=None,
+                 flush_interval=None):
         self.iterable = iterable
         self.length = length
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
 
     def __iter__(self):
         return iter(self.iterable)
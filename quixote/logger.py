@@ -0,0 +1,262 @@
+"""quixote.logger
+$HeadURL: svn+ssh://svn/repos/trunk/quixote/logger.py $
+$Id$
+
+Helpers for formatting and writing the access log.
+
+  format_timestamp(now) : Format a time the way the logs want it, reusing
+                          the string built for the current second.
+  BufferedLog           : File-like object that collects lines in memory
+                          and writes them out from a background thread.
+  format_json(fields)   : Render (name, value) pairs as one JSON line.
+  format_logfmt(fields) : Render (name, value) pairs as one logfmt line.
+"""
+
+__revision__ = "$Id$"
+
+import os
+import re
+import time
+import atexit
+import threading
+from json import dumps
+
+_last_timestamp = (None, None)
+
+def format_timestamp(now=None):
+    """format_timestamp(now : float = time.time()) -> string
+
+    Return 'now' formatted as "YYYY-MM-DD HH:MM:SS" in local time.  The
+    string is cached for the current second, so formatting the time for
+    every request costs a comparison rather than a strftime() call.
+    """
+    global _last_timestamp
+    if now is None:
+        now = time.time()
+    second = int(now)
+    cached_second, timestamp = _last_timestamp
+    if second != cached_second:
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+        # replaced as a single tuple so other threads never see a
+        # mismatched pair
+        _last_timestamp = (second, timestamp)
+    return timestamp
+
+
+def format_json(fields):
+    """format_json(fields : [(string, any)]) -> string
+
+    Return 'fields' as a JSON object on a single line, keeping the
+    order of the pairs.  Byte strings that are not UTF-8 (eg. headers
+    sent by a broken client) are decoded with replacement characters.
+    """
+    items = []
+    for name, value in fields:
+        if isinstance(value, str):
+            value = value.decode('utf-8', 'replace')
+        items.append('%s: %s' % (dumps(name), dumps(value)))
+    return '{%s}\n' % ', '.join(items)
+
+
+_logfmt_bare_re = re.compile(r'^[^\s"=\\\x00-\x1f\x7f]+$')
+_logfmt_escape_re = re.compile(r'[\\"\x00-\x1f\x7f]')
+_logfmt_escapes = {'\\': '\\\\', '"': '\\"', '\n': '\\n', '\r': '\\r',
+                   '\t': '\\t'}
+
+def _logfmt_escape(match):
+    char = match.group()
+    return _logfmt_escapes.get(char) or '\\x%02x' % ord(char)
+
+def _logfmt_value(value):
+    if value is None:
+        return ''
+    elif value is True or value is False:
+        return value and 'true' or 'false'
+    elif isinstance(value, float):
+        return '%.6f' % value
+    value = str(value)
+    if _logfmt_bare_re.match(value):
+        return value
+    # control characters are escaped too, so that a value (eg. a URI
+    # or User-Agent sent by a client) can't start a forged record
+    return '"%s"' % _logfmt_escape_re.sub(_logfmt_escape, value)
+
+def format_logfmt(fields):
+    """format_logfmt(fields : [(string, any)]) -> string
+
+    Return 'fields' as space-separated name=value pairs on a single
+    line.  Values containing spaces, quotes, '=' or control characters
+    are double-quoted, with backslash escapes.
+    """
+    return ' '.join(['%s=%s' % (name, _logfmt_value(value))
+                     for name, value in fields]) + '\n'
+
+
+class BufferedLog:
+    """
+    A write-only, file-like wrapper that batches lines in memory and
+    hands them to the underlying file from a background thread.
+
+    The flusher thread wakes up when 'flush_size' bytes have been
+    buffered or every 'flush_interval' seconds, whichever comes first.
+    If the writer falls behind and 'max_size' bytes are waiting, new
+    lines are either dropped (policy 'drop', counted in 'dropped') or
+    the caller waits for the flusher to catch up (policy 'block').
+
+    Instance attributes:
+      file : file
+        the file that finally receives the data
+      dropped : int
+        number of lines discarded because the buffer was full
+    """
+
+    POLICIES = ('block', 'drop')
+
+    def __init__(self, file, flush_size=65536, flush_interval=1.0,
+                 max_size=None, policy='block'):
+        if policy not in self.POLICIES:
+            raise ValueError, "policy must be one of %r" % (self.POLICIES,)
+        self.file = file
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        if max_size is None:
+            max_size = 16 * flush_size
+        self.max_size = max(max_size, flush_size)
+        self.policy = policy
+        self.dropped = 0
+        self._lines = []
+        self._size = 0
+        self._closed = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._stopped = 0
+        atexit.register(self._shutdown)
+
+    def __repr__(self):
+        return "<%s at %x: %r>" % (self.__class__.__name__, id(self),
+                                   self.file)
+
+    def _forget_inherited(self):
+        # Called with the lock held.  Lines buffered before a fork are
+        # the parent's to write; writing them here too would repeat them
+        # once per child.
+        if self._pid is not None and self._pid != os.getpid():
+            self._lines = []
+            self._size = 0
+            self._thread = None
+            self._pid = None
+
+    def _start_flusher(self):
+        # Called with the lock held.  The thread is (re)started lazily so
+        # that a log opened before a pre-forking server forks still gets
+        # a flusher in every child.
+        self._forget_inherited()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run,
+                                        name="quixote-log-flusher")
+        self._thread.setDaemon(1)
+        self._thread.start()
+
+    def write(self, data):
+        cond = self._cond
+        cond.acquire()
+        try:
+            if self._closed:
+                raise ValueError, "I/O operation on closed log"
+            if self._stopped:
+                # past exit handlers; there is no flusher any more
+                self._lines.append(data)
+                lines = self._take()
+                self._write_out(lines)
+                return
+            if self._pid != os.getpid():
+                self._start_flusher()
+            if self._size >= self.max_size:
+                if self.policy == 'drop':
+                    self.dropped += 1
+                    return
+                while self._size >= self.max_size and not self._closed:
+                    cond.notifyAll()
+                    cond.wait()
+            self._lines.append(data)
+            self._size += len(data)
+            if self._size >= self.flush_size:
+                cond.notifyAll()
+        finally:
+            cond.release()
+
+    def _take(self):
+        # Called with the lock held.
+        lines = self._lines
+        self._lines = []
+        self._size = 0
+        self._cond.notifyAll() # wake up writers blocked on a full buffer
+        return lines
+
+    def _write_out(self, lines):
+        if lines:
+            self.file.write("".join(lines))
+            self.file.flush()
+
+    def _run(self):
+        cond = self._cond
+        while 1:
+            cond.acquire()
+            try:
+                if (self._size < self.flush_size and not self._closed and
+                        not self._stopped):
+                    cond.wait(self.flush_interval)
+                lines = self._take()
+                closed = self._closed or self._stopped
+            finally:
+                cond.release()
+            try:
+                self._write_out(lines)
+            except (IOError, OSError):
+                # nowhere sensible to report this; keep the thread alive
+                pass
+            if closed:
+                break
+
+    def flush(self):
+        """Write everything buffered so far, in the calling thread."""
+        self._cond.acquire()
+        try:
+            self._forget_inherited()
+            lines = self._take()
+        finally:
+            self._cond.release()
+        if not self.file.closed:
+            self._write_out(lines)
+
+    def _shutdown(self):
+        # Stop the flusher while the interpreter is still intact; daemon
+        # threads that outlive the exit handlers die noisily.
+        self._cond.acquire()
+        try:
+            self._stopped = 1
+            self._cond.notifyAll()
+            thread = self._thread
+        finally:
+            self._cond.release()
+        if thread is not None and self._pid == os.getpid():
+            thread.join(1.0)
+        self.flush()
+
+    def close(self):
+        self._cond.acquire()
+        try:
+            self._closed = 1
+            self._cond.notifyAll()
+            thread = self._thread
+        finally:
+            self._cond.release()
+        if thread is not None and self._pid == os.getpid():
+            thread.join()
+        self.flush()
+        self.file.close()
+
+    @property
+    def closed(self):
+        return self._closed
@@ -0,0 +1,435 @@
+"""quixote.metrics
+$HeadURL: svn+ssh://svn/repos/trunk/quixote/metrics.py $
+$Id$
+
+Request metrics in the Prometheus text exposition format.
+
+When the METRICS config variable is true the publisher counts requests
+and exceptions per handler, keeps a fixed-bucket latency histogram per
+handler, and tracks upload bytes, gzip input/output bytes and the
+size of the session table.  To publish them, put a MetricsExporter in
+your root namespace:
+
+    _q_exports = [..., '_q_metrics']
+    _q_metrics = MetricsExporter()
+
+Each process keeps its own numbers.  If METRICS_DIR is set, every
+process stores them in a memory-mapped file in that directory, and the
+exporter adds up the files of all processes, so a scrape of any worker
+reports totals for the whole application.
+"""
+
+__revision__ = "$Id$"
+
+import os
+import re
+import mmap
+import fcntl
+import struct
+import marshal
+import tempfile
+import bisect
+import threading
+
+from quixote import errors
+
+# upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_METRICS = [
+    ('quixote_requests_total', 'counter',
+     'Requests served, by handler and status code.'),
+    ('quixote_request_seconds', 'histogram',
+     'Time taken to process requests, by handler.'),
+    ('quixote_exceptions_total', 'counter',
+     'Uncaught exceptions, by handler and exception type.'),
+    ('quixote_upload_bytes_total', 'counter',
+     'Bytes received in file upload requests.'),
+    ('quixote_compress_input_bytes_total', 'counter',
+     'Response bytes before gzip compression.'),
+    ('quixote_compress_output_bytes_total', 'counter',
+     'Response bytes after gzip compression.'),
+    ('quixote_sessions', 'gauge',
+     'Sessions in the session table.'),
+    ]
+
+# Samples are stored under keys made of the sample name and its labels
+# separated by NUL bytes, eg. "quixote_requests_total\0handler=x\0status=200".
+# Histogram buckets are stored non-cumulatively (one increment per
+# observation) and turned into Prometheus' cumulative form by render().
+
+_BUCKET_LABELS = ['%g' % le for le in BUCKETS] + ['+Inf']
+
+
+def _make_key(name, *labels):
+    return '\0'.join((name,) + labels)
+
+def _split_key(key):
+    parts = key.split('\0')
+    labels = []
+    for part in parts[1:]:
+        name, value = part.split('=', 1)
+        labels.append((name, value))
+    return parts[0], labels
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+def _format_sample(name, labels, value):
+    if labels:
+        name = '%s{%s}' % (name, ','.join(['%s="%s"' % (k, _escape_label(v))
+                                          for k, v in labels]))
+    if value == int(value):
+        return '%s %d\n' % (name, value)
+    return '%s %r\n' % (name, value)
+
+
+class DictStore:
+    """Keeps samples in an ordinary dictionary (one process only)."""
+
+    def __init__(self):
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, key, amount=1):
+        self._lock.acquire()
+        try:
+            self.values[key] = self.values.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def collect(self):
+        """collect() -> ({key : float}, {key : float})
+
+        Return the (counters, gauges) visible to this process.
+        """
+        counters = {}
+        gauges = {}
+        for key, value in self.values.items():
+            if key.startswith('quixote_sessions'):
+                gauges[key] = value
+            else:
+                counters[key] = value
+        return counters, gauges
+
+
+class MmapStore:
+    """
+    Keeps samples in a memory-mapped file that only this process
+    writes, so that other processes can read and add them up.
+
+    File layout: an 8 byte header holding the number of bytes in use,
+    followed by entries of [key length (4 bytes), key padded to an
+    8 byte boundary, value (8 byte double)].  Entries are only ever
+    appended and values are updated in place.
+
+    collect() folds the counters of processes that have exited into
+    the "metrics-retired" file, a marshalled dictionary, and removes
+    their files, so that the directory doesn't grow with every worker
+    ever started.
+    """
+
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._pid = None
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        self._pid = os.getpid()
+        self.filename = os.path.join(self.directory,
+                                     'metrics-%d.db' % self._pid)
+        self._file = open(self.filename, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < self.INITIAL_SIZE:
+            self._file.truncate(self.INITIAL_SIZE)
+            size = self.INITIAL_SIZE
+        self._capacity = size
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._used = struct.unpack_from('i', self._map, 0)[0]
+        if self._used == 0:
+            self._used = 8
+            struct.pack_into('i', self._map, 0, self._used)
+        self._positions = {}
+        for key, value, pos in _read_entries(self._map, self._used):
+            self._positions[key] = pos
+
+    def _grow(self, needed):
+        while self._used + needed > self._capacity:
+            self._capacity *= 2
+        self._map.close()
+        self._file.truncate(self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+
+    def _position(self, key):
+        if self._pid != os.getpid():
+            # we have been forked; the parent keeps the old file
+            self._open()
+        pos = self._positions.get(key)
+        if pos is None:
+            padding = ' ' * (8 - (len(key) + 4) % 8)
+            entry = struct.pack('i%dsd' % (len(key) + len(padding)),
+                                len(key), key + padding, 0.0)
+            if self._used + len(entry) > self._capacity:
+                self._grow(len(entry))
+            self._map[self._used:self._used + len(entry)] = entry
+            self._used += len(entry)
+            # write the header last so readers never see a partial entry
+            struct.pack_into('i', self._map, 0, self._used)
+            pos = self._positions[key] = self._used - 8
+        return pos
+
+    def inc(self, key, amount=1):
+        self._lock.acquire()
+        try:
+            pos = self._position(key)
+            value = struct.unpack_from('d', self._map, pos)[0]
+            struct.pack_into('d', self._map, pos, value + amount)
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            struct.pack_into('d', self._map, self._position(key), value)
+        finally:
+            self._lock.release()
+
+    def collect(self):
+        counters = {}
+        gauges = {}
+        dead = []
+        for name in os.listdir(self.directory):
+            match = _store_file_re.match(name)
+            if not match:
+                continue
+            path = os.path.join(self.directory, name)
+            if not _pid_alive(int(match.group(1))):
+                dead.append(path)
+                continue
+            for key, value in _read_file(path):
+                if _is_gauge(key):
+                    gauges[key] = gauges.get(key, 0) + value
+                else:
+                    counters[key] = counters.get(key, 0) + value
+        if dead:
+            self._retire(dead)
+        for key, value in self._read_retired().items():
+            counters[key] = counters.get(key, 0) + value
+        return counters, gauges
+
+    def _read_retired(self):
+        try:
+            fp = open(os.path.join(self.directory, 'metrics-retired'), 'rb')
+        except IOError:
+            return {}
+        try:
+            try:
+                return marshal.load(fp)
+            except (EOFError, ValueError, TypeError):
+                return {}
+        finally:
+            fp.close()
+
+    def _retire(self, paths):
+        # Add the counters in the files of dead processes to the retired
+        # totals and remove the files; gauges of dead processes are
+        # meaningless.  The lock keeps two processes collecting at once
+        # from both counting the same file.
+        lock = open(os.path.join(self.directory, 'metrics.lock'), 'a')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            retired = self._read_retired()
+            removed = []
+            for path in paths:
+                if not os.path.exists(path):
+                    # retired by another process meanwhile
+                    continue
+                for key, value in _read_file(path):
+                    if not _is_gauge(key):
+                        retired[key] = retired.get(key, 0) + value
+                removed.append(path)
+            if not removed:
+                return
+            fd, tempname = tempfile.mkstemp(dir=self.directory,
+                                            suffix='.tmp')
+            try:
+                os.write(fd, marshal.dumps(retired))
+                os.close(fd)
+                os.rename(tempname,
+                          os.path.join(self.directory, 'metrics-retired'))
+            except:
+                os.unlink(tempname)
+                raise
+            for path in removed:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+        finally:
+            lock.close()
+
+
+_store_file_re = re.compile(r'^metrics-(\d+)\.db$')
+
+def _is_gauge(key):
+    return key.startswith('quixote_sessions')
+
+def _read_file(path):
+    # Return the (key, value) entries of a store file.
+    try:
+        fp = open(path, 'rb')
+    except IOError:
+        return []
+    try:
+        data = fp.read()
+    finally:
+        fp.close()
+    if len(data) < 8:
+        return []
+    used = struct.unpack_from('i', data, 0)[0]
+    return [(key, value) for key, value, pos in _read_entries(data, used)]
+
+def _read_entries(data, used):
+    pos = 8
+    used = min(used, len(data))
+    while pos + 4 <= used:
+        length = struct.unpack_from('i', data, pos)[0]
+        if length <= 0:
+            break
+        key_size = length + (8 - (length + 4) % 8)
+        end = pos + 4 + key_size + 8
+        if end > used:
+            break
+        key = str(data[pos + 4:pos + 4 + length])
+        value_pos = pos + 4 + key_size
+        value = struct.unpack_from('d', data, value_pos)[0]
+        yield key, value, value_pos
+        pos = end
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, exc:
+        import errno
+        return exc.errno == errno.EPERM
+    return 1
+
+
+class Metrics:
+    """
+    Collects the publisher's metrics and renders them as Prometheus
+    text.  'directory' selects the shared MmapStore; without it the
+    numbers live in a DictStore and cover this process only.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            self.store = DictStore()
+        else:
+            self.store = MmapStore(directory)
+        self._bucket_keys = {}
+
+    def observe_request(self, handler, status, seconds):
+        store = self.store
+        store.inc(_make_key('quixote_requests_total', 'handler=' + handler,
+                            'status=%d' % status))
+        keys = self._bucket_keys.get(handler)
+        if keys is None:
+            keys = [_make_key('quixote_request_seconds_bucket',
+                              'handler=' + handler, 'le=' + le)
+                    for le in _BUCKET_LABELS]
+            keys.append(_make_key('quixote_request_seconds_sum',
+                                  'handler=' + handler))
+            self._bucket_keys[handler] = keys
+        store.inc(keys[bisect.bisect_left(BUCKETS, seconds)])
+        store.inc(keys[-1], seconds)
+
+    def count_exception(self, handler, exc_type):
+        self.store.inc(_make_key('quixote_exceptions_total',
+                                 'handler=' + handler,
+                                 'type=' + exc_type))
+
+    def add_upload(self, nbytes):
+        self.store.inc('quixote_upload_bytes_total', nbytes)
+
+    def add_compression(self, before, after):
+        self.store.inc('quixote_compress_input_bytes_total', before)
+        self.store.inc('quixote_compress_output_bytes_total', after)
+
+    def set_sessions(self, count):
+        self.store.set('quixote_sessions', count)
+
+    def render(self):
+        """render() -> string
+
+        Return all metrics in the Prometheus text exposition format.
+        """
+        counters, gauges = self.store.collect()
+        samples = {}
+        for values in (counters, gauges):
+            for key, value in values.items():
+                name, labels = _split_key(key)
+                samples.setdefault(name, []).append((labels, value))
+        chunks = []
+        for name, kind, help in _METRICS:
+            chunks.append('# HELP %s %s\n' % (name, help))
+            chunks.append('# TYPE %s %s\n' % (name, kind))
+            if kind == 'histogram':
+                chunks.extend(self._render_histogram(name, samples))
+            else:
+                items = samples.get(name, [])
+                items.sort()
+                for labels, value in items:
+                    chunks.append(_format_sample(name, labels, value))
+        return ''.join(chunks)
+
+    def _render_histogram(self, name, samples):
+        buckets = {}
+        for labels, value in samples.get(name + '_bucket', []):
+            handler = labels[0][1]
+            le = labels[1][1]
+            buckets.setdefault(handler, {})[le] = value
+        sums = {}
+        for labels, value in samples.get(name + '_sum', []):
+            sums[labels[0][1]] = value
+        handlers = buckets.keys()
+        handlers.sort()
+        lines = []
+        for handler in handlers:
+            counts = buckets[handler]
+            total = 0
+            for le in _BUCKET_LABELS:
+                total += counts.get(le, 0)
+                lines.append(_format_sample(name + '_bucket',
+                                            [('handler', handler),
+                                             ('le', le)], total))
+            lines.append(_format_sample(name + '_sum',
+                                        [('handler', handler)],
+                                        sums.get(handler, 0)))
+            lines.append(_format_sample(name + '_count',
+                                        [('handler', handler)], total))
+        return lines
+
+
+class MetricsExporter:
+    """
+    A callable namespace object that returns the current publisher's
+    metrics.  Raises TraversalError if metrics are not enabled.
+    """
+
+    _q_exports = []
+
+    def __call__(self, request):
+        from quixote.publish import get_publisher
+        metrics = get_publisher().get_metrics()
+        if metrics is None:
+            raise errors.TraversalError(private_msg="METRICS is not enabled")
+        request.response.set_content_type('text/plain; version=0.0.4')
+        return metrics.render()
@@ -0,0 +1,231 @@
+"""quixote.profiler
+$HeadURL: svn+ssh://svn/repos/trunk/quixote/profiler.py $
+$Id$
+
+Profile a sample of live requests with cProfile.
+
+A Publisher configured with PROFILE_DIR profiles one request in every
+PROFILE_EVERY, plus any request carrying a valid X-Quixote-Profile
+header (see make_token()).  Each profile is dumped in pstats format to a
+subdirectory of PROFILE_DIR named after the handler that served the
+request; only the newest PROFILE_KEEP dumps per handler are kept.
+
+Run this module as a script to merge and report the dumps:
+
+    python -m quixote.profiler report /var/tmp/qx-profile [handler ...]
+    python -m quixote.profiler token SECRET [TTL]
+"""
+
+__revision__ = "$Id$"
+
+import os
+import re
+import sys
+import time
+import hmac
+import types
+import itertools
+try:
+    import cProfile as profile
+except ImportError:
+    import profile
+import pstats
+from hashlib import sha1
+
+PROFILE_HEADER = 'X-Quixote-Profile'
+
+_unsafe_chars_re = re.compile(r'[^A-Za-z0-9_.-]+')
+
+def handler_name(object):
+    """handler_name(object : any) -> string
+
+    Return a filesystem-safe name for the object that handled a request,
+    eg. "myapp.ui.UserPage.edit" for a bound method.
+    """
+    if isinstance(object, types.MethodType):
+        owner = object.im_class
+        name = '%s.%s.%s' % (owner.__module__, owner.__name__,
+                             object.__name__)
+    elif isinstance(object, (types.FunctionType, types.ClassType, type)):
+        name = '%s.%s' % (object.__module__, object.__name__)
+    elif isinstance(object, types.ModuleType):
+        name = object.__name__
+    elif isinstance(object, basestring):
+        name = 'string'
+    else:
+        cls = object.__class__
+        name = '%s.%s' % (cls.__module__, cls.__name__)
+    return _unsafe_chars_re.sub('_', name)
+
+
+def _sign(secret, expires):
+    return hmac.new(secret, str(expires), sha1).hexdigest()
+
+def make_token(secret, ttl=300):
+    """make_token(secret : string, ttl : int = 300) -> string
+
+    Return a value for the X-Quixote-Profile header that forces requests
+    to be profiled for the next 'ttl' seconds.
+    """
+    expires = int(time.time()) + ttl
+    return '%d:%s' % (expires, _sign(secret, expires))
+
+def check_token(secret, token, now=None):
+    """Return true if 'token' was made by make_token() with 'secret' and
+    has not expired yet.
+    """
+    try:
+        expires, signature = token.split(':', 1)
+        expires = int(expires)
+    except ValueError:
+        return 0
+    if now is None:
+        now = time.time()
+    if expires < now:
+        return 0
+    # compare_digest() is only available in Python 2.7.7 and later
+    compare = getattr(hmac, 'compare_digest', None)
+    if compare is None:
+        return _sign(secret, expires) == signature
+    return compare(_sign(secret, expires), signature)
+
+
+class RequestProfiler:
+    """
+    Decides which requests to profile, runs them under cProfile and
+    writes the results.
+
+    Instance attributes:
+      directory : string
+        where profile dumps are written
+      every : int
+        profile one request in this many (0 to only profile requests
+        with a valid token)
+      secret : string | None
+        key for checking X-Quixote-Profile tokens (None disables them)
+      keep : int
+        number of dumps kept per handler (0 keeps none)
+    """
+
+    def __init__(self, directory, every=0, secret=None, keep=100):
+        self.directory = directory
+        self.every = every
+        self.secret = secret
+        self.keep = keep
+        self._counter = itertools.count(1)
+
+    def should_profile(self, request):
+        if self.every and self._counter.next() % self.every == 0:
+            return 1
+        if self.secret:
+            token = request.get_header(PROFILE_HEADER)
+            if token and check_token(self.secret, token):
+                return 1
+        return 0
+
+    def run(self, func, *args):
+        """run(func : callable, *args) -> (result : any, prof : Profile)
+
+        Call 'func' with 'args' under the profiler.  Exceptions propagate
+        unchanged; the profile is discarded in that case.
+        """
+        prof = profile.Profile()
+        result = prof.runcall(func, *args)
+        return result, prof
+
+    def dump(self, prof, name):
+        """Write the statistics in 'prof' to the directory for handler
+        'name', then remove the oldest dumps beyond 'keep'.
+        """
+        directory = os.path.join(self.directory, name)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory): # lost a race, that's fine
+                    raise
+        filename = '%.6f-%d.prof' % (time.time(), os.getpid())
+        tmp_path = os.path.join(directory, '.' + filename)
+        prof.dump_stats(tmp_path)
+        os.rename(tmp_path, os.path.join(directory, filename))
+        self._prune(directory)
+
+    def _prune(self, directory):
+        dumps = _list_dumps(directory)
+        # not dumps[:-self.keep], which is empty when keep is 0
+        for filename in dumps[:max(len(dumps) - self.keep, 0)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass # another process got to it first
+
+
+def _list_dumps(directory):
+    dumps = [name for name in os.listdir(directory)
+             if name.endswith('.prof') and not name.startswith('.')]
+    dumps.sort() # names start with the time, so this is oldest first
+    return [os.path.join(directory, name) for name in dumps]
+
+def load_stats(directory, handlers=None):
+    """load_stats(directory : string, handlers : [string] = None)
+       -> { string : pstats.Stats }
+
+    Merge the dumps found under 'directory' into one Stats object per
+    handler.  If 'handlers' is given only those handlers are loaded.
+    """
+    if not handlers:
+        handlers = os.listdir(directory)
+    result = {}
+    for name in handlers:
+        path = os.path.join(directory, name)
+        if not os.path.isdir(path):
+            continue
+        stats = None
+        for filename in _list_dumps(path):
+            if stats is None:
+                stats = pstats.Stats(filename)
+            else:
+                stats.add(filename)
+        if stats is not None:
+            result[name] = stats
+    return result
+
+
+def report(directory, handlers=None, sort='cumulative', limit=30,
+           file=None):
+    """Print merged statistics for each handler to 'file'."""
+    if file is None:
+        file = sys.stdout
+    all_stats = load_stats(directory, handlers)
+    names = all_stats.keys()
+    names.sort()
+    for name in names:
+        stats = all_stats[name]
+        count = len(_list_dumps(os.path.join(directory, name)))
+        stats.stream = file
+        file.write("=== %s (%d requests)\n" % (name, count))
+        stats.sort_stats(sort).print_stats(limit)
+
+
+def main(args=None):
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog report DIR [HANDLER ...]\n"
+                                "       %prog token SECRET [TTL]")
+    parser.add_option("-s", "--sort", default="cumulative",
+                      help="pstats sort key (default: %default)")
+    parser.add_option("-n", "--limit", type="int", default=30,
+                      help="number of functions to list (default: %default)")
+    (options, args) = parser.parse_args(args)
+    if len(args) >= 2 and args[0] == 'report':
+        report(args[1], args[2:], options.sort, options.limit)
+    elif len(args) in (2, 3) and args[0] == 'token':
+        ttl = 300
+        if len(args) == 3:
+            ttl = int(args[2])
+        print make_token(args[1], ttl)
+    else:
+        parser.error("unknown command")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,8 +8,12 @@ Compile a PTL template.
 First the tokens "template" are replaced with "def".  Next, the file is
 parsed into a parse tree.  This tree is converted into a modified AST.
 It is during this state that the semantics are modified by adding extra
-nodes to the tree.  Finally bytecode is generated using the compiler
-package.
+nodes to the tree.  Adjacent literal fragments of a template are then
+merged, and the literals of [html] templates become htmltext constants
+built once, when the module is imported.  With fast_append, each line of
+output calls a local alias of the TemplateIO's append method instead of
+doing "IO_INSTANCE += obj".  Finally bytecode is generated using the
+compiler package.
 
 Note that script/module requires the compiler package.
 """
@@ -23,6 +27,7 @@ import symbol
 import token
 import parser
 import re
+from types import StringType, UnicodeType
 
 assert sys.hexversion >= 0x20000b1, 'PTL requires Python 2.0 or newer'
 
@@ -37,18 +42,28 @@ if sys.hexversion >= 0x20200b1:
 IO_MODULE = "quixote.html"
 IO_CLASS = "TemplateIO"
 IO_INSTANCE = "_q_output"
+IO_APPEND = "_q_append"
 HTML_TEMPLATE_PREFIX = "_q_html_template_"
 PLAIN_TEMPLATE_PREFIX = "_q_plain_template_"
 TEMPLATE_PREFIX = "_q_template_"
 MARKUP_MODULE = "quixote.html"
 MARKUP_CLASS = "htmltext"
 MARKUP_MANGLED_CLASS = "_q_htmltext"
+MARKUP_CONSTANT_PREFIX = "_q_html_const_"
+
+_string_types = (StringType, UnicodeType)
 
 class TemplateTransformer(transformer.Transformer):
 
-    def __init__(self, *args, **kwargs):
-        transformer.Transformer.__init__(self, *args, **kwargs)
+    # merge adjacent literals and build htmltext literals at import time
+    fold_constants = 1
+
+    def __init__(self, fast_append=0):
+        transformer.Transformer.__init__(self)
+        self.fast_append = fast_append
         self.__template_type = [] # stack, "html", "plain" or None
+        self.__constants = {} # (type, value) -> name
+        self.__constant_assigns = [] # module level assignments
 
     def file_input(self, nodelist):
         # Add a "from IO_MODULE import IO_CLASS" statement to the
@@ -78,6 +93,10 @@ class TemplateTransformer(transformer.Transformer):
             if node[0] != token.ENDMARKER and node[0] != token.NEWLINE:
                 self.com_append_stmt(stmts, node)
 
+        # the htmltext constants used by templates must be bound before
+        # any of the module's own code runs
+        stmts[4:4] = self.__constant_assigns
+
         return ast.Module(doc, ast.Stmt(stmts))
 
     def funcdef(self, nodelist):
@@ -136,7 +155,17 @@ class TemplateTransformer(transformer.Transformer):
             ret = ast.Return(ast.CallFunc(func, []))
 
             # wrap original function code
-            code = ast.Stmt([assign, code, ret])
+            stmts = [assign, code, ret]
+            if self.fast_append:
+                # "IO_APPEND = IO_INSTANCE.append"
+                func = ast.Getattr(ast.Name(IO_INSTANCE), "append")
+                stmts.insert(1, ast.Assign(
+                    [ast.AssName(IO_APPEND, OP_ASSIGN)], func))
+            code = ast.Stmt(stmts)
+            if self.fold_constants:
+                code = self._rewrite(code, self._fold)
+            if self.fast_append:
+                code = self._rewrite(code, self._use_append)
 
             if sys.hexversion >= 0x20400a2:
                 n = ast.Function(decorators, name, names, defaults, flags, doc,
@@ -184,6 +213,121 @@ class TemplateTransformer(transformer.Transformer):
         return n
 
 
+    def _literal_value(self, node):
+        """Return the string if node is _q_htmltext("..."), else None."""
+        if (isinstance(node, ast.CallFunc) and
+            isinstance(node.node, ast.Name) and
+            node.node.name == MARKUP_MANGLED_CLASS and
+            len(node.args) == 1 and
+            isinstance(node.args[0], ast.Const) and
+            isinstance(node.args[0].value, _string_types) and
+            node.star_args is None and node.dstar_args is None):
+            return node.args[0].value
+        return None
+
+    def _fragment(self, node):
+        """Return (is_html, string) if node is "IO_INSTANCE += literal".
+        """
+        if (isinstance(node, ast.AugAssign) and node.op == '+=' and
+            isinstance(node.node, ast.Name) and
+            node.node.name == IO_INSTANCE):
+            expr = node.expr
+            if (isinstance(expr, ast.Const) and
+                isinstance(expr.value, _string_types)):
+                return (0, expr.value)
+            value = self._literal_value(expr)
+            if value is not None:
+                return (1, value)
+        return None
+
+    def _merge_fragments(self, nodes):
+        """Merge runs of literal output statements into one statement.
+
+        Only literals of the same kind and string type are merged, so
+        the output is unchanged.
+        """
+        result = []
+        last = None
+        for node in nodes:
+            fragment = self._fragment(node)
+            if (fragment is not None and last is not None and
+                fragment[0] == last[0] and
+                type(fragment[1]) is type(last[1])):
+                last = (last[0], last[1] + fragment[1])
+                expr = ast.Const(last[1])
+                if last[0]:
+                    expr = ast.CallFunc(ast.Name(MARKUP_MANGLED_CLASS), [expr])
+                merged = ast.AugAssign(ast.Name(IO_INSTANCE), '+=', expr)
+                merged.lineno = result[-1].lineno
+                result[-1] = merged
+            else:
+                result.append(node)
+                last = fragment
+        return result
+
+    def _markup_constant(self, value):
+        """Return the name of a module level htmltext constant for value.
+        """
+        key = (type(value), value)
+        name = self.__constants.get(key)
+        if name is None:
+            name = "%s%d" % (MARKUP_CONSTANT_PREFIX, len(self.__constants))
+            self.__constants[key] = name
+            call = ast.CallFunc(ast.Name(MARKUP_MANGLED_CLASS),
+                                [ast.Const(value)])
+            self.__constant_assigns.append(
+                ast.Assign([ast.AssName(name, OP_ASSIGN)], call))
+        return name
+
+    def _fold(self, node):
+        """Merge literal fragments and replace _q_htmltext("...") calls
+        with module level constants.
+        """
+        if isinstance(node, ast.Stmt):
+            node.nodes = self._merge_fragments(node.nodes)
+        value = self._literal_value(node)
+        if value is not None:
+            name = ast.Name(self._markup_constant(value))
+            name.lineno = node.lineno
+            return name
+        return node
+
+    def _use_append(self, node):
+        """Replace "IO_INSTANCE += obj" with "IO_APPEND(obj)".
+        """
+        if (isinstance(node, ast.AugAssign) and node.op == '+=' and
+            isinstance(node.node, ast.Name) and
+            node.node.name == IO_INSTANCE):
+            call = ast.CallFunc(ast.Name(IO_APPEND), [node.expr])
+            return ast.Discard(call, node.lineno)
+        return node
+
+    def _rewrite(self, node, rewrite):
+        """Return rewrite(node), with rewrite() applied in turn to
+        everything below the node it returns.
+        """
+        node = rewrite(node)
+        for attr, child in node.__dict__.items():
+            if isinstance(child, ast.Node):
+                setattr(node, attr, self._rewrite(child, rewrite))
+            elif isinstance(child, (list, tuple)):
+                setattr(node, attr,
+                        self._rewrite_sequence(child, rewrite))
+        return node
+
+    def _rewrite_sequence(self, seq, rewrite):
+        items = []
+        for item in seq:
+            if isinstance(item, ast.Node):
+                item = self._rewrite(item, rewrite)
+            elif isinstance(item, tuple):
+                item = self._rewrite_sequence(item, rewrite)
+            items.append(item)
+        if isinstance(seq, tuple):
+            return tuple(items)
+        return items
+
+
 _old_template_re = re.compile(r"^([ \t]*) template ([ \t]+)"
                               r" ([a-zA-Z_][a-zA-Z_0-9]*)"   # name of template
                               r" ([ \t]*[\(\\])",
@@ -222,10 +366,10 @@ def translate_tokens(buf):
 
 
 if sys.hexversion >= 0x20300b1:
-    def parse(buf, filename='<string>'):
+    def parse(buf, filename='<string>', fast_append=0):
         buf = translate_tokens(buf)
         try:
-            return TemplateTransformer().parsesuite(buf)
+            return TemplateTransformer(fast_append).parsesuite(buf)
         except SyntaxError, e:
             # set the filename attribute
             raise SyntaxError(str(e), (filename, e.lineno, e.offset, e.text))
@@ -234,7 +378,7 @@ else:
     # The parser module in Python <= 2.2 can raise ParserError.  Since
     # the ParserError exception is basically useless, we use compile()
     # to generate a better exception.
-    def parse(buf, filename='<string>'):
+    def parse(buf, filename='<string>', fast_append=0):
         buf = translate_tokens(buf)
         # compile() and parsermodule don't accept code that is missing a
         # trailing newline.  The Python interpreter seems to add a newline when
@@ -242,7 +386,7 @@ else:
         if buf[-1:] != '\n':
             buf += "\n"
         try:
-            return TemplateTransformer().parsesuite(buf)
+            return TemplateTransformer(fast_append).parsesuite(buf)
         except (parser.ParserError, SyntaxError):
             import __builtin__
             try:
@@ -255,28 +399,81 @@ else:
 
 PTL_EXT = ".ptl"
 PTLC_EXT = ".ptlc"
+# the last byte is the version of the .ptlc format: the magic, the
+# mtime and the SHA-1 digest of the source, then the code
 if sys.hexversion >= 0x20300a1:
-    PTLC_MAGIC = "PTLC\x04\x00"
+    PTLC_MAGIC = "PTLC\x04\x01"
 elif sys.hexversion >= 0x20200b1:
-    PTLC_MAGIC = "PTLC\x03\x00"
+    PTLC_MAGIC = "PTLC\x03\x01"
 elif sys.hexversion >= 0x20100b1:
-    PTLC_MAGIC = "PTLC\x02\x00"
+    PTLC_MAGIC = "PTLC\x02\x01"
 elif sys.hexversion >= 0x20000b1:
-    PTLC_MAGIC = "PTLC\x01\x00"
+    PTLC_MAGIC = "PTLC\x01\x01"
 else:
     raise RuntimeError, 'python too old'
 
+# A .ptla archive holds the compiled code of many templates: the magic,
+# the length of the index as a 4 byte little-endian integer, the
+# marshalled index, then the code of each template as in a .ptlc file.
+# The index maps the absolute path of each .ptl file to (offset,
+# length, mtime, digest); offsets count from the end of the index.
+PTLA_EXT = ".ptla"
+PTLA_MAGIC = "PTLA" + PTLC_MAGIC[4:]
+
+def source_digest(source):
+    """source_digest(source : string) -> string
+
+    Return the digest of a template's source stored in .ptlc files.
+    """
+    from hashlib import sha1
+    return sha1(source).digest()
+
+def read_header(file):
+    """read_header(file) -> (mtime, digest) | None
+
+    Read the header of an open .ptlc file, leaving the file positioned at
+    the code.  None is returned if the file has the wrong magic number
+    (or was written by an older version of PTL).
+    """
+    import marshal
+    if file.read(len(PTLC_MAGIC)) != PTLC_MAGIC:
+        return None
+    try:
+        mtime = marshal.load(file)
+        digest = marshal.load(file)
+    except (EOFError, ValueError, TypeError):
+        return None
+    return mtime, digest
+
+def is_current(filename, mtime, digest):
+    """is_current(filename, mtime, digest) -> boolean
+
+    Return true if the .ptlc header (mtime, digest) matches the template
+    source 'filename'.  The source is only read if its mtime has changed,
+    so a checkout that touches files without changing them does not make
+    the .ptlc files stale.  A missing source counts as current.
+    """
+    try:
+        if os.stat(filename)[stat.ST_MTIME] == mtime:
+            return 1
+        source = open(filename).read()
+    except (OSError, IOError):
+        return 1
+    return source_digest(source) == digest
+
 class Template(pycodegen.Module):
 
+    fast_append = 0
+
     if sys.hexversion >= 0x20200b1:
         def _get_tree(self):
-            tree = parse(self.source, self.filename)
+            tree = parse(self.source, self.filename, self.fast_append)
             misc.set_filename(self.filename, tree)
             syntax.check(tree)
             return tree
     else:
         def compile(self):
-            ast = parse(self.source, self.filename)
+            ast = parse(self.source, self.filename, self.fast_append)
             gen = pycodegen.ModuleCodeGenerator(self.filename)
             walk(ast, gen, 1)
             self.code = gen.getCode()
@@ -288,98 +485,263 @@ class Template(pycodegen.Module):
         f.write(PTLC_MAGIC)
         mtime = os.stat(self.filename)[stat.ST_MTIME]
         marshal.dump(mtime, f)
+        marshal.dump(source_digest(self.source), f)
         marshal.dump(self.code, f)
 
 
-def compile_template(input, filename, output=None):
-    """compile_template(input, filename, output=None) -> code
+def compile_template(input, filename, output=None, fast_append=0):
+    """compile_template(input, filename, output=None, fast_append=0) -> code
 
     Compile an open file.  If output is not None then the code is written
-    with the magic template header.  The code object is returned.
+    with the magic template header.  The code object is returned.  If
+    fast_append is true, templates add their output through a local
+    alias of TemplateIO.append rather than with "+="; the output is the
+    same, but each line of output costs less.
     """
     buf = input.read()
     template = Template(buf, filename)
+    template.fast_append = fast_append
     template.compile()
     if output:
         template.dump(output)
     return template.code
 
-def compile(inputname, outputname):
-    """compile(inputname, outputname)
+def _write_atomic(filename, write):
+    # Call write() with a temporary file in the same directory as
+    # 'filename' and rename it to 'filename' once it is complete, so
+    # that a reader never sees a partly written .ptlc file.  The file
+    # is created with mode 0666 so that the kernel applies the umask, as
+    # open() would.
+    import errno
+    prefix = os.path.join(os.path.dirname(filename) or '.',
+                          os.path.basename(filename))
+    while 1:
+        tempname = '%s.%s.tmp' % (prefix, os.urandom(6).encode('hex'))
+        try:
+            fd = os.open(tempname, (os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                                    getattr(os, 'O_BINARY', 0)), 0666)
+        except OSError, exc:
+            if exc.errno == errno.EEXIST:
+                continue
+            raise
+        break
+    try:
+        output = os.fdopen(fd, 'wb')
+        try:
+            write(output)
+        finally:
+            output.close()
+        os.rename(tempname, filename)
+    except:
+        os.unlink(tempname)
+        raise
+
+def compile(inputname, outputname, fast_append=0):
+    """compile(inputname, outputname, fast_append=0)
 
-    Compile a template file.  The new template is writen to outputname.
+    Compile a template file.  The new template is writen to outputname,
+    which is replaced atomically.
     """
     input = open(inputname)
-    output = open(outputname, "wb")
     try:
-        compile_template(input, inputname, output)
-    except:
-        # don't leave a corrupt .ptlc file around
-        output.close()
-        os.unlink(outputname)
+        _write_atomic(outputname,
+                      lambda output: compile_template(input, inputname,
+                                                      output, fast_append))
+    finally:
+        input.close()
+
+def _refresh_header(filename, ptlc_filename):
+    # The source was touched but not changed; store its new mtime so the
+    # importer doesn't need to read it again.
+    import marshal
+    file = open(ptlc_filename, 'rb')
+    try:
+        read_header(file)
+        code = file.read()
+    finally:
+        file.close()
+    mtime = os.stat(filename)[stat.ST_MTIME]
+    digest = source_digest(open(filename).read())
+    def write(output):
+        output.write(PTLC_MAGIC)
+        marshal.dump(mtime, output)
+        marshal.dump(digest, output)
+        output.write(code)
+    _write_atomic(ptlc_filename, write)
+
+def _compile_file(args):
+    # Compile one file for compile_files(), possibly in another process.
+    # Returns (filename, status), where status is "compiled", "current",
+    # or the error message.
+    filename, force, fast_append = args
+    path, ext = os.path.splitext(filename)
+    ptlc_filename = path + PTLC_EXT
+    try:
+        if not force:
+            try:
+                file = open(ptlc_filename, 'rb')
+            except IOError:
+                header = None
+            else:
+                try:
+                    header = read_header(file)
+                finally:
+                    file.close()
+            if header is not None:
+                mtime, digest = header
+                if is_current(filename, mtime, digest):
+                    if os.stat(filename)[stat.ST_MTIME] != mtime:
+                        _refresh_header(filename, ptlc_filename)
+                    return filename, "current"
+        compile(filename, ptlc_filename, fast_append)
+    except KeyboardInterrupt:
         raise
+    except Exception, exc:
+        return filename, "%s: %s" % (exc.__class__.__name__, exc)
+    return filename, "compiled"
 
-def compile_dir(dir, maxlevels=10, force=0):
-    """Byte-compile all PTL modules in the given directory tree.
-       (Adapted from compile_dir in Python module: compileall.py)
-
-    Arguments (only dir is required):
+def write_archive(filename, ptl_filenames):
+    """write_archive(filename, ptl_filenames)
 
-    dir:       the directory to byte-compile
-    maxlevels: maximum recursion level (default 10)
-    force:     if true, force compilation, even if timestamps are up-to-date
+    Pack the .ptlc files of the templates 'ptl_filenames' (which must
+    have been compiled) into the archive 'filename', replacing it
+    atomically.  See ptl_import.PTLArchive.
+    """
+    import marshal
+    import struct
+    index = {}
+    chunks = []
+    offset = 0
+    for ptl_filename in ptl_filenames:
+        ptlc_filename = os.path.splitext(ptl_filename)[0] + PTLC_EXT
+        file = open(ptlc_filename, 'rb')
+        try:
+            header = read_header(file)
+            code = file.read()
+        finally:
+            file.close()
+        if header is None:
+            raise ValueError, 'bad .ptlc magic for file "%s"' % ptlc_filename
+        mtime, digest = header
+        index[os.path.abspath(ptl_filename)] = (offset, len(code), mtime,
+                                                digest)
+        chunks.append(code)
+        offset += len(code)
+    index = marshal.dumps(index)
+    def write(output):
+        output.write(PTLA_MAGIC)
+        output.write(struct.pack('<I', len(index)))
+        output.write(index)
+        for chunk in chunks:
+            output.write(chunk)
+    _write_atomic(filename, write)
+
+def find_templates(dir, maxlevels=10):
+    """find_templates(dir, maxlevels=10) -> [string]
+
+    Return the paths of the PTL modules in a directory tree, not
+    following symbolic links to directories.
     """
-    print 'Listing', dir, '...'
     try:
         names = os.listdir(dir)
     except os.error:
         print "Can't list", dir
         names = []
     names.sort()
-    success = 1
+    filenames = []
     for name in names:
         fullname = os.path.join(dir, name)
         if os.path.isfile(fullname):
-            head, tail = name[:-4], name[-4:]
-            if tail == '.ptl':
-                cfile = fullname + 'c'
-                ftime = os.stat(fullname)[stat.ST_MTIME]
-                try:
-                    ctime = os.stat(cfile)[stat.ST_MTIME]
-                except os.error: ctime = 0
-                if (ctime > ftime) and not force:
-                    continue
-                print 'Compiling', fullname, '...'
-                try:
-                    ok = compile(fullname, cfile)
-                except KeyboardInterrupt:
-                    raise KeyboardInterrupt
-                except:
-                    # XXX compile catches SyntaxErrors
-                    if type(sys.exc_type) == type(''):
-                        exc_type_name = sys.exc_type
-                    else: exc_type_name = sys.exc_type.__name__
-                    print 'Sorry:', exc_type_name + ':',
-                    print sys.exc_value
-                    success = 0
-                else:
-                    if ok == 0:
-                        success = 0
+            if os.path.splitext(name)[1] == PTL_EXT:
+                filenames.append(fullname)
         elif (maxlevels > 0 and name != os.curdir and name != os.pardir and
               os.path.isdir(fullname) and not os.path.islink(fullname)):
-            if not compile_dir(fullname, maxlevels - 1, force):
+            filenames.extend(find_templates(fullname, maxlevels - 1))
+    return filenames
+
+def compile_files(filenames, force=0, jobs=1, quiet=0, fast_append=0):
+    """compile_files(filenames, force=0, jobs=1, quiet=0, fast_append=0)
+        -> boolean
+
+    Compile PTL modules to .ptlc files next to them, skipping the ones
+    whose .ptlc file is current (see is_current()) unless 'force' is
+    true.  With jobs > 1 the files are compiled by a pool of that many
+    processes; jobs=0 uses one per CPU.  Returns true if every file
+    compiled.
+    """
+    if jobs != 1 and len(filenames) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs or None)
+        results = pool.imap_unordered(_compile_file,
+                                      [(filename, force, fast_append)
+                                       for filename in filenames])
+    else:
+        pool = None
+        results = [_compile_file((filename, force, fast_append))
+                   for filename in filenames]
+    success = 1
+    try:
+        for filename, status in results:
+            if status == "compiled":
+                if not quiet:
+                    print 'Compiled', filename
+            elif status != "current":
+                print 'Sorry:', filename, status
                 success = 0
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
     return success
 
-def main():
-    args = sys.argv[1:]
+def compile_dir(dir, maxlevels=10, force=0, jobs=1):
+    """Byte-compile all PTL modules in the given directory tree.
+       (Adapted from compile_dir in Python module: compileall.py)
+
+    Arguments (only dir is required):
+
+    dir:       the directory to byte-compile
+    maxlevels: maximum recursion level (default 10)
+    force:     if true, force compilation, even if the .ptlc files are
+               up-to-date
+    jobs:      number of processes to compile with (0 for one per CPU)
+    """
+    print 'Listing', dir, '...'
+    return compile_files(find_templates(dir, maxlevels), force, jobs)
+
+def main(args=None):
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] FILE|DIR ...")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="number of processes, 0 for one per CPU "
+                           "(default: %default)")
+    parser.add_option("-f", "--force", action="store_true", default=False,
+                      help="compile even if the .ptlc files are current")
+    parser.add_option("-q", "--quiet", action="store_true", default=False,
+                      help="only report errors")
+    parser.add_option("--fast-append", action="store_true", default=False,
+                      help="compile templates with fast_append")
+    parser.add_option("-a", "--archive", metavar="FILE",
+                      help="also pack the compiled templates into the "
+                           "archive FILE (see ptl_import.install())")
+    (options, args) = parser.parse_args(args)
     if not args:
-        print "no files to compile"
-    else:
-        for filename in args:
-            path, ext = os.path.splitext(filename)
-            compile(filename, path + PTLC_EXT)
+        parser.error("no files to compile")
+    filenames = []
+    for arg in args:
+        if os.path.isdir(arg):
+            filenames.extend(find_templates(arg))
+        else:
+            filenames.append(arg)
+    if not compile_files(filenames, options.force, options.jobs,
+                         options.quiet, options.fast_append):
+        return 1
+    if options.archive:
+        write_archive(options.archive, filenames)
+    return 0
 
 if __name__ == "__main__":
-    main()
-
+    sys.exit(main())
@@ -2,42 +2,64 @@
 $HeadURL: svn+ssh://svn/repos/trunk/quixote/ptl_import.py $
 $Id$
 
-Import hooks; when installed, these hooks allow importing .ptl files
-as if they were Python modules.
+Import hook; when installed, it allows importing .ptl files as if they
+were Python modules.
 
-Note: there's some unpleasant incompatibility between ZODB's import
-trickery and the import hooks here.  Bottom line: if you're using ZODB,
-import it *before* installing the Quixote/PTL import hooks.
+The hook is a PEP 302 finder on sys.meta_path that only answers for PTL
+modules: any other import falls through to Python's own machinery.  To
+find out quickly that a directory holds no PTL module of a given name,
+the finder keeps a listing of each directory on the path, which is
+read again only when the directory's mtime changes.  Since many file
+systems keep mtimes to the second, a module written within a second
+of the previous listing may go unseen: programs that write modules
+and then import them should call PTLFinder.invalidate_caches() first.
+
+The finder can also take the code of PTL modules from an archive built
+by "python -m quixote.ptl_compile --archive FILE ...".  The archive is
+mapped into memory, so the processes of a preforking server share its
+pages, and a module's code is only unmarshalled when it is imported.
 """
 
 __revision__ = "$Id$"
 
 
 import sys
-import os.path
-import imp, ihooks, new
+import os
+import imp, new
 import marshal
-import stat
-import fcntl
-import errno
-import __builtin__
+import struct
 
-from ptl_compile import compile_template, PTL_EXT, PTLC_EXT, PTLC_MAGIC
+from ptl_compile import compile_template, read_header, is_current, \
+     _write_atomic, PTL_EXT, PTLC_EXT, PTLA_MAGIC
 
-assert sys.hexversion >= 0x20000b1, "need Python 2.0b1 or later"
+assert sys.hexversion >= 0x20300f0, "need Python 2.3 or later"
 
-def _exec_module_code(code, name, filename):
+def _exec_module_code(code, name, filename, path=None):
     if sys.modules.has_key(name):
         mod = sys.modules[name] # necessary for reload()
+        created = 0
+        saved = mod.__dict__.copy()
     else:
         mod = new.module(name)
         sys.modules[name] = mod
+        created = 1
     mod.__name__ = name
     mod.__file__ = filename
-    exec code in mod.__dict__
+    if path is not None:
+        mod.__path__ = path
+    try:
+        exec code in mod.__dict__
+    except:
+        # don't leave a half-initialized module behind
+        if created:
+            del sys.modules[name]
+        else:
+            mod.__dict__.clear()
+            mod.__dict__.update(saved)
+        raise
     return mod
 
-def _load_ptlc(name, filename, file=None):
+def _load_ptlc(name, filename, file=None, package_path=None):
     if not file:
         try:
             file = open(filename, "rb")
@@ -45,20 +67,13 @@ def _load_ptlc(name, filename, file=None):
             return None
     path, ext = os.path.splitext(filename)
     ptl_filename = path + PTL_EXT
-    magic = file.read(len(PTLC_MAGIC))
-    if magic != PTLC_MAGIC:
-        return _load_ptl(name, ptl_filename)
-    ptlc_mtime = marshal.load(file)
-    try:
-        mtime = os.stat(ptl_filename)[stat.ST_MTIME]
-    except OSError:
-        mtime = ptlc_mtime
-    if mtime > ptlc_mtime:
-        return _load_ptl(name, ptl_filename)
+    header = read_header(file)
+    if header is None or not is_current(ptl_filename, *header):
+        return _load_ptl(name, ptl_filename, package_path=package_path)
     code = marshal.load(file)
-    return _exec_module_code(code, name, filename)
+    return _exec_module_code(code, name, filename, package_path)
 
-def _load_ptl(name, filename, file=None):
+def _load_ptl(name, filename, file=None, package_path=None):
     if not file:
         try:
             file = open(filename, "rb")
@@ -66,102 +81,219 @@ def _load_ptl(name, filename, file=None):
             return None
     path, ext = os.path.splitext(filename)
     ptlc_filename = path + PTLC_EXT
+    # The .ptlc file is replaced atomically, so that _load_ptlc() never
+    # reads one that is partly written; processes compiling the same
+    # template at once each write a complete file.
+    code = []
+    def write(output):
+        code.append(compile_template(file, filename, output))
     try:
-        output_fd = os.open(ptlc_filename, os.O_WRONLY | os.O_CREAT, 0644)
+        _write_atomic(ptlc_filename, write)
+    except (OSError, IOError):
+        # eg. the directory isn't writable
+        if not code:
+            file.seek(0)
+            code.append(compile_template(file, filename))
+    return _exec_module_code(code[0], name, filename, package_path)
+
+
+class PTLArchive(object):
+    """The compiled code of many PTL modules, in a memory-mapped file
+    written by ptl_compile.write_archive().
+    """
+
+    def __init__(self, filename):
+        import mmap
+        self.filename = filename
+        file = open(filename, 'rb')
         try:
-            fcntl.flock(output_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError, e:
-            if e.errno == errno.EWOULDBLOCK:
-                fcntl.flock(output_fd, fcntl.LOCK_EX)
-                os.close(output_fd)
-                return _load_ptlc(name, ptlc_filename)
-            raise
-        output = os.fdopen(output_fd, 'wb')
-    except (OSError, IOError), e:
-        output = None
-    try:
-        code = compile_template(file, filename, output)
-    except:
-        # don't leave a corrupt .ptlc file around
-        if output:
-            output.close()
-            os.unlink(ptlc_filename)
-        raise
-    else:
-        if output:
-            output.close()
-    return _exec_module_code(code, name, filename)
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+        pos = len(PTLA_MAGIC)
+        if self.map[:pos] != PTLA_MAGIC:
+            raise ValueError, 'bad .ptla magic for file "%s"' % filename
+        size = struct.unpack('<I', self.map[pos:pos+4])[0]
+        pos += 4
+        self.index = marshal.loads(self.map[pos:pos+size])
+        self.base = pos + size
 
+    def get_code(self, filename):
+        """get_code(filename : string) -> code | None
 
-# Constant used to signal a PTL files
-PTLC_FILE = 128
-PTL_FILE = 129
+        Return the code of the template 'filename' (an absolute path), or
+        None if it isn't in the archive or its source has changed since
+        the archive was built.
+        """
+        entry = self.index.get(filename)
+        if entry is None:
+            return None
+        offset, length, mtime, digest = entry
+        if not is_current(filename, mtime, digest):
+            return None
+        start = self.base + offset
+        return marshal.loads(self.map[start:start+length])
 
-class PTLHooks(ihooks.Hooks):
 
-    def get_suffixes(self):
-        # add our suffixes
-        L = imp.get_suffixes()
-        return L + [(PTLC_EXT, 'rb', PTLC_FILE), (PTL_EXT, 'r', PTL_FILE)]
+# The PTL modules imported through PTLLoader, for ptl_reload:
+# module name -> (.ptl filename, __path__ or None, mtime of the .ptl file)
+loaded = {}
 
-class PTLLoader(ihooks.ModuleLoader):
+def _source_mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
 
-    def load_module(self, name, stuff):
-        file, filename, info = stuff
-        (suff, mode, type) = info
 
-        # If it's a PTL file, load it specially.
-        if type == PTLC_FILE:
-            return _load_ptlc(name, filename, file)
+class PTLLoader(object):
+    """PEP 302 loader for one PTL module (or package).
+    """
 
-        elif type == PTL_FILE:
-            return _load_ptl(name, filename, file)
+    def __init__(self, filename, path=None, archive=None):
+        self.filename = filename # the .ptl or .ptlc file
+        self.path = path # __path__, for a package
+        self.archive = archive
 
+    def load_module(self, fullname):
+        filename = os.path.splitext(self.filename)[0] + PTL_EXT
+        filename = os.path.abspath(filename)
+        mtime = _source_mtime(filename)
+        code = None
+        if self.archive is not None:
+            code = self.archive.get_code(filename)
+        if code is not None:
+            mod = _exec_module_code(code, fullname, filename, self.path)
+        elif self.filename.endswith(PTLC_EXT):
+            mod = _load_ptlc(fullname, self.filename,
+                             package_path=self.path)
         else:
-            # Otherwise, use the default handler for loading
-            return ihooks.ModuleLoader.load_module( self, name, stuff)
-
-try:
-    import cimport
-except ImportError:
-    cimport = None
-
-class cModuleImporter(ihooks.ModuleImporter):
-    def __init__(self, loader=None):
-        self.loader = loader or ihooks.ModuleLoader()
-        cimport.set_loader(self.find_import_module)
-
-    def find_import_module(self, fullname, subname, path):
-        stuff = self.loader.find_module(subname, path)
-        if not stuff:
+            mod = _load_ptl(fullname, self.filename,
+                            package_path=self.path)
+        if mod is None:
+            raise ImportError, "can't read %s" % self.filename
+        mod.__loader__ = self
+        loaded[fullname] = (filename, self.path, mtime)
+        return mod
+
+
+class PTLFinder(object):
+    """PEP 302 finder for PTL modules, meant for sys.meta_path.
+
+    A module is looked up in each directory of the path in turn, like
+    Python does.  The first directory with a package, extension, or
+    Python module of that name decides; if that isn't a PTL module,
+    find_module() returns None and leaves the import to Python.  A .ptlc
+    file comes before a .ptl file, and is recompiled if it is stale.
+    Path entries that aren't directories (eg. zip files) are asked,
+    through their own importer, whether they have the module.
+
+    Directory listings are cached, and read again when the directory's
+    mtime changes; call invalidate_caches() after adding a module within
+    the mtime resolution (often one second) of the last lookup.
+    """
+
+    def __init__(self, archive=None):
+        self.suffixes = ([(suffix, 0) for suffix, mode, type
+                          in imp.get_suffixes()] +
+                         [(PTLC_EXT, 1), (PTL_EXT, 1)])
+        self.listings = {} # directory -> (mtime, names or None)
+        self.archive = archive # a PTLArchive, or None
+
+    def invalidate_caches(self):
+        self.listings.clear()
+
+    def _listdir(self, dir):
+        # Return the names in 'dir' (None if it isn't a directory),
+        # listing it again only if it has changed.
+        try:
+            mtime = os.stat(dir).st_mtime
+        except (OSError, TypeError, ValueError):
             return None
-        return self.loader.load_module(fullname, stuff)
-
-    def install(self):
-        self.save_import_module = __builtin__.__import__
-        self.save_reload = __builtin__.reload
-        if not hasattr(__builtin__, 'unload'):
-            __builtin__.unload = None
-        self.save_unload = __builtin__.unload
-        __builtin__.__import__ = cimport.import_module
-        __builtin__.reload = cimport.reload_module
-        __builtin__.unload = self.unload
-
-_installed = 0
-
-def install():
-    global _installed
-    if not _installed:
-        hooks = PTLHooks()
-        loader = PTLLoader(hooks)
-        if cimport is not None:
-            importer = cModuleImporter(loader)
-        else:
-            importer = ihooks.ModuleImporter(loader)
-        ihooks.install(importer)
-        _installed = 1
+        listing = self.listings.get(dir)
+        if listing is None or listing[0] != mtime:
+            try:
+                names = dict.fromkeys(os.listdir(dir))
+            except OSError:
+                names = None
+            listing = self.listings[dir] = (mtime, names)
+        return listing[1]
+
+    def _has_module(self, entry, fullname):
+        # Whether the path entry 'entry', which isn't a directory we can
+        # list, provides 'fullname' through another importer.
+        import pkgutil
+        importer = pkgutil.get_importer(entry)
+        return (importer is not None and
+                importer.find_module(fullname) is not None)
+
+    def _find(self, dir, names, name):
+        # Return (filename, is_ptl) for the module 'name' in 'dir', or
+        # None if it isn't there.
+        for suffix, is_ptl in self.suffixes:
+            if names.has_key(name + suffix):
+                return os.path.join(dir, name + suffix), is_ptl
+        return None
+
+    def find_module(self, fullname, path=None):
+        name = fullname.split('.')[-1]
+        if path is None:
+            path = sys.path
+        for dir in path:
+            if not isinstance(dir, str):
+                continue
+            dir = dir or os.curdir
+            names = self._listdir(dir)
+            if names is None:
+                if self._has_module(dir, fullname):
+                    # eg. in a zip file: Python will import it from there
+                    return None
+                continue
+            if not names:
+                continue
+            if names.has_key(name):
+                # maybe a package
+                package = os.path.join(dir, name)
+                init_names = self._listdir(package)
+                if init_names:
+                    found = self._find(package, init_names, '__init__')
+                    if found is not None:
+                        filename, is_ptl = found
+                        if is_ptl:
+                            return PTLLoader(filename, [package],
+                                             self.archive)
+                        return None
+            found = self._find(dir, names, name)
+            if found is not None:
+                filename, is_ptl = found
+                if is_ptl:
+                    return PTLLoader(filename, archive=self.archive)
+                return None
+        return None
+
+
+_finder = None
+
+def install(archive=None):
+    """Install the PTL import hook, if it isn't installed already.
+
+    'archive' is the filename of a .ptla archive to take the code of PTL
+    modules from, when it is current.
+    """
+    global _finder
+    if _finder is None:
+        _finder = PTLFinder()
+        sys.meta_path.append(_finder)
+    if archive is not None:
+        _finder.archive = PTLArchive(archive)
+
+def uninstall():
+    """Remove the PTL import hook."""
+    global _finder
+    if _finder is not None:
+        sys.meta_path.remove(_finder)
+        _finder = None
 
 
 if __name__ == '__main__':
-    import ZODB
     install()
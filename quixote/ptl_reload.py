@@ -0,0 +1,232 @@
+"""quixote.ptl_reload
+$HeadURL: svn+ssh://svn/repos/trunk/quixote/ptl_reload.py $
+$Id$
+
+Reload PTL modules when their source changes; meant for development
+servers, see enable_ptl(watch=1).
+
+A background thread watches the .ptl files of the modules imported
+through the PTL import hook.  When one changes, it is recompiled and its
+code is run again in the existing module object, so everything that
+refers to the module itself (the publisher's root namespace, other
+modules, objects returned by _q_resolve) sees the new code.  PTL modules
+that hold functions or classes imported from a reloaded module ("from
+pages import header") are run again too, so that they pick up the new
+objects.
+
+The thread is woken up by inotify if the pyinotify package is
+installed, and polls the files' mtimes otherwise.  Nothing is done
+while handling requests, and nothing at all unless the reloader is
+started.
+"""
+
+__revision__ = "$Id$"
+
+import os
+import sys
+import imp
+import atexit
+import threading
+import traceback
+
+from quixote import ptl_import
+from quixote.ptl_compile import PTLC_EXT
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+def _imports_from(module, name):
+    # Return true if 'module' holds a function or class defined in the
+    # module 'name'.
+    for value in module.__dict__.values():
+        try:
+            if getattr(value, '__module__', None) == name:
+                return 1
+        except Exception:
+            pass
+    return 0
+
+
+class PTLReloader:
+    """
+    Reloads the PTL modules whose source has changed, from a background
+    thread started by start() (or when check() is called).
+
+    Instance attributes:
+      interval : float
+        seconds between checks when polling, and the longest wait for
+        inotify events
+      log : function
+        called with a message for every reload and every error
+    """
+
+    def __init__(self, interval=1.0, log=None):
+        self.interval = interval
+        self.log = log or self._log
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._stopped = 0
+        self._watch_manager = None
+        self._notifier = None
+        self._watched = {} # directories watched with inotify
+
+    def _log(self, msg):
+        sys.stderr.write('ptl_reload: %s\n' % msg)
+
+    def start(self):
+        """Start the background thread (again, after a fork)."""
+        self._cond.acquire()
+        try:
+            if self._pid != os.getpid() and not self._stopped:
+                self._pid = os.getpid()
+                self._notifier = None
+                self._watched = {}
+                if pyinotify is not None:
+                    self._watch_manager = pyinotify.WatchManager()
+                    self._notifier = pyinotify.Notifier(
+                        self._watch_manager, pyinotify.ProcessEvent())
+                self._thread = threading.Thread(target=self._run,
+                                                name="quixote-ptl-reload")
+                self._thread.setDaemon(1)
+                self._thread.start()
+        finally:
+            self._cond.release()
+
+    def changed(self):
+        """changed() -> [string]
+
+        Return the names of the PTL modules whose source has changed
+        since they were loaded.
+        """
+        names = []
+        for name, (filename, path, mtime) in ptl_import.loaded.items():
+            if (sys.modules.get(name) is not None and
+                ptl_import._source_mtime(filename) != mtime):
+                names.append(name)
+        return names
+
+    def dependents(self, names):
+        """dependents(names : [string]) -> [string]
+
+        Return 'names' followed by the loaded PTL modules that imported
+        functions or classes from them, directly or not.
+        """
+        order = list(names)
+        seen = dict.fromkeys(names)
+        for target in order:
+            for name in ptl_import.loaded.keys():
+                module = sys.modules.get(name)
+                if (module is not None and not seen.has_key(name) and
+                    _imports_from(module, target)):
+                    seen[name] = 1
+                    order.append(name)
+        return order
+
+    def check(self):
+        """check() -> [string]
+
+        Reload the changed modules and their dependents; returns the
+        names of the modules reloaded.  A module that fails to compile
+        or run is logged and left alone until its source changes again;
+        if its code raised, whatever it had set is undone, so that the
+        module keeps its old contents.
+        """
+        changed = self.changed()
+        if not changed:
+            return []
+        reloaded = []
+        imp.acquire_lock()
+        try:
+            for name in self.dependents(changed):
+                filename, path, mtime = ptl_import.loaded[name]
+                ptl_import.loaded[name] = (
+                    filename, path, ptl_import._source_mtime(filename))
+                try:
+                    self._reload(name, filename, path)
+                except Exception:
+                    self.log('error reloading %s:\n%s' %
+                             (name, traceback.format_exc()))
+                else:
+                    self.log('reloaded %s' % name)
+                    reloaded.append(name)
+        finally:
+            imp.release_lock()
+        return reloaded
+
+    def _reload(self, name, filename, path):
+        # The .ptlc file is recompiled if the source has changed.
+        ptlc_filename = os.path.splitext(filename)[0] + PTLC_EXT
+        if ptl_import._load_ptlc(name, ptlc_filename,
+                                 package_path=path) is None:
+            ptl_import._load_ptl(name, filename, package_path=path)
+
+    def _wait(self):
+        # Wait for something to change, or for the interval to pass.
+        notifier = self._notifier
+        if notifier is None:
+            self._cond.acquire()
+            try:
+                if not self._stopped:
+                    self._cond.wait(self.interval)
+            finally:
+                self._cond.release()
+            return
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_CREATE)
+        for filename, path, mtime in ptl_import.loaded.values():
+            dir = os.path.dirname(filename)
+            if not self._watched.has_key(dir):
+                self._watched[dir] = 1
+                self._watch_manager.add_watch(dir, mask)
+        if notifier.check_events(int(self.interval * 1000)):
+            notifier.read_events()
+            notifier.process_events()
+
+    def _run(self):
+        while not self._stopped:
+            self._wait()
+            if self._stopped:
+                break
+            try:
+                self.check()
+            except Exception:
+                self.log('error checking for changes:\n%s' %
+                         traceback.format_exc())
+
+    def stop(self):
+        self._shutdown()
+
+    def _shutdown(self):
+        self._cond.acquire()
+        try:
+            self._stopped = 1
+            self._cond.notify()
+            thread = self._thread
+        finally:
+            self._cond.release()
+        if thread is not None and self._pid == os.getpid():
+            thread.join(self.interval + 1.0)
+
+
+_reloader = None
+
+def start(interval=1.0, log=None):
+    """start(interval=1.0, log=None) -> PTLReloader
+
+    Start reloading changed PTL modules in the background.
+    """
+    global _reloader
+    if _reloader is None:
+        _reloader = PTLReloader(interval, log)
+    _reloader.start()
+    return _reloader
+
+def _shutdown():
+    if _reloader is not None:
+        _reloader.stop()
+
+atexit.register(_shutdown)
@@ -11,7 +11,7 @@ import marshal
 import dis
 import types
 
-from ptl_compile import PTLC_MAGIC
+from ptl_compile import read_header
 
 def dump(obj):
     print obj
@@ -19,11 +19,9 @@ def dump(obj):
         print "\t", attr, repr(getattr(obj, attr))
 
 def loadCode(path):
-    f = open(path)
-    magic = f.read(len(PTLC_MAGIC))
-    if magic != PTLC_MAGIC:
+    f = open(path, 'rb')
+    if read_header(f) is None:
         raise ValueError, 'bad .ptlc magic for file "%s"' % path
-    mtime = marshal.load(f)
     co = marshal.load(f)
     f.close()
     return co
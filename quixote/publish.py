@@ -10,6 +10,7 @@ __revision__ = "$Id$"
 import sys, os, traceback, cStringIO
 import time, types, socket, re, warnings
 import struct
+from hashlib import md5
 try:
     import zlib # for COMPRESS_PAGES option
     import binascii
@@ -23,6 +24,13 @@ from quixote.http_request import HTTPRequest, HTTPJSONRequest, get_content_type
 from quixote.http_response import HTTPResponse, Stream
 from quixote.upload import HTTPUploadRequest, Upload
 from quixote.sendmail import sendmail
+from quixote.profiler import RequestProfiler, handler_name
+from quixote.metrics import Metrics
+from quixote.cache import FragmentCache, ResponseCache, FileStore, \
+     MemoryStore
+from quixote.errormail import ErrorMailer, fingerprint
+from quixote.logger import BufferedLog, format_timestamp, format_json, \
+     format_logfmt
 
 try:
     import cgitb                        # Only available in Python 2.2
@@ -59,7 +67,7 @@ available in either the server's error log or Quixote's error log.</p>
 </html>
 """
 
-class Publisher:
+class Publisher(object):
     """
     The core of Quixote and of any Quixote application.  This class is
     responsible for converting each HTTP request into a search of
@@ -79,7 +87,8 @@ class Publisher:
         fulfill each HTTP request
       exit_now : boolean
         used for internal state management.  If true, the loop in
-        publish_cgi() will terminate at the end of the current request.
+        publish_fcgi() will terminate at the end of the current request.
+        Kept per thread, like namespace_stack.
       access_log : file
         file to which every access will be logged; set by
         setup_logs() (None if no access log)
@@ -95,11 +104,25 @@ class Publisher:
       _request : HTTPRequest
         the HTTP request currently being processed.
       namespace_stack : [ module | instance | class ]
+        the objects traversed to by the request the current thread is
+        processing, outermost first
+
+    All the state of a request lives in the request object or in
+    thread-local storage, so one Publisher can process requests in
+    several threads at once (see is_thread_safe).
     """
 
+    # Checked by QWIP before serving requests from multithreaded servers.
+    is_thread_safe = True
+
     def __init__(self, root_namespace, config=None):
         from quixote.config import Config
 
+        # per-thread state: the request, namespace_stack and exit_now
+        self._local = threading.local()
+        # held while creating the objects shared by all threads
+        self._lock = threading.Lock()
+
         # if more than one publisher in app, need to set_publisher per request
         set_publisher(self)
 
@@ -113,11 +136,14 @@ class Publisher:
             # namespaces are lurking out there in the world?
             self.root_namespace = root_namespace
 
-        # for PublishError exception handling
-        self.namespace_stack = [self.root_namespace]
-
-        self.exit_now = 0
         self.access_log = None
+        self._profiler = None
+        self._metrics = None
+        self._error_mailer = None
+        self._fragment_cache = None
+        self._response_cache = None
+        # compressed bodies by the hash of the uncompressed body
+        self._compressed = MemoryStore(self._GZIP_CACHE_SIZE)
         self.error_log = sys.stderr     # possibly overridden in setup_logs()
         sys.stdout = self.error_log     # print is handy for debugging
 
@@ -134,7 +160,21 @@ class Publisher:
         else:
             self.set_config(config)
 
-        self._local = threading.local()
+    @property
+    def namespace_stack(self):
+        return getattr(self._local, 'namespace_stack', [self.root_namespace])
+
+    @namespace_stack.setter
+    def namespace_stack(self, value):
+        self._local.namespace_stack = value
+
+    @property
+    def exit_now(self):
+        return getattr(self._local, 'exit_now', 0)
+
+    @exit_now.setter
+    def exit_now(self, value):
+        self._local.exit_now = value
 
     @property
     def _request(self):
@@ -162,7 +202,14 @@ class Publisher:
 
         if self.config.access_log is not None:
             try:
-                self.access_log = open(self.config.access_log, 'a', 1)
+                if self.config.access_log_buffer:
+                    self.access_log = BufferedLog(
+                        open(self.config.access_log, 'a'),
+                        flush_size=self.config.access_log_buffer,
+                        flush_interval=self.config.access_log_flush_interval,
+                        policy=self.config.access_log_overflow or 'block')
+                else:
+                    self.access_log = open(self.config.access_log, 'a', 1)
             except IOError, exc:
                 sys.stderr.write("error opening access log %s: %s\n"
                                  % (`self.config.access_log`, exc.strerror))
@@ -204,8 +251,7 @@ class Publisher:
         """
         Write an message to the error log with a time stamp.
         """
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S",
-                                  time.localtime(time.time()))
+        timestamp = format_timestamp()
         self.error_log.write("[%s] %s\n" % (timestamp, msg))
 
     debug = log # backwards compatibility
@@ -220,11 +266,12 @@ class Publisher:
             req = HTTPUploadRequest(stdin, env, content_type=ctype)
             req.set_upload_dir(self.config.upload_dir,
                                self.config.upload_dir_mode)
-            return req
         elif self.config.support_application_json and ctype == "application/json":
-            return HTTPJSONRequest(stdin, env, content_type=ctype)
+            req = HTTPJSONRequest(stdin, env, content_type=ctype)
         else:
-            return HTTPRequest(stdin, env, content_type=ctype)
+            req = HTTPRequest(stdin, env, content_type=ctype)
+        req.response.charset = self.config.output_encoding
+        return req
 
     def parse_request(self, request):
         """Parse the request information waiting in 'request'.
@@ -261,6 +308,16 @@ class Publisher:
         """
         return self._local.request
 
+    _structured_log_formats = {'json': format_json,
+                               'logfmt': format_logfmt}
+
+    def _defer_log(self):
+        """Return true if log_request() should wait until the response
+        has been written, so that the write time can be logged too.
+        """
+        return (self.access_log is not None and
+                self.config.access_log_format in self._structured_log_formats)
+
     def log_request(self, request):
         """Log a request in the access_log file.
         """
@@ -271,7 +328,7 @@ class Publisher:
                 user = "-"
             now = time.time()
             seconds = now - request.start_time
-            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
+            timestamp = format_timestamp(now)
 
             env = request.environ
 
@@ -286,6 +343,15 @@ class Publisher:
                 query = "?" + query
             proto = env.get('SERVER_PROTOCOL')
 
+            formatter = self._structured_log_formats.get(
+                self.config.access_log_format)
+            if formatter is not None:
+                fields = self._get_log_fields(request, user, timestamp,
+                                              request_uri + query, proto,
+                                              seconds)
+                self.access_log.write(formatter(fields))
+                return
+
             self.access_log.write('%s %s %s %d "%s %s %s" %s %r %0.2fsec\n' %
                                    (request.environ.get('REMOTE_ADDR'),
                                     str(user),
@@ -299,6 +365,41 @@ class Publisher:
                                     seconds
                                    ))
 
+    def _get_log_fields(self, request, user, timestamp, uri, proto, seconds):
+        """Return the (name, value) pairs of a structured access log
+        record.  Phase timings come from request.timings, and anything
+        in request.log_fields is appended last.
+        """
+        env = request.environ
+        response = request.response
+        try:
+            request_bytes = int(env.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            request_bytes = None
+        fields = [('time', timestamp),
+                  ('pid', os.getpid()),
+                  ('remote_addr', env.get('REMOTE_ADDR')),
+                  ('user', str(user)),
+                  ('method', request.get_method()),
+                  ('uri', uri),
+                  ('proto', proto),
+                  ('status', response.status_code),
+                  ('user_agent', env.get('HTTP_USER_AGENT', '')),
+                  ('request_bytes', request_bytes),
+                  ('response_bytes', response.get_header('content-length')),
+                  ('session_saved',
+                   request.log_fields.get('session_saved', False)),
+                  ('seconds', round(seconds, 6))]
+        for phase in ('parse', 'traverse', 'handler', 'filter', 'compress',
+                      'write'):
+            if phase in request.timings:
+                fields.append(('t_' + phase, round(request.timings[phase], 6)))
+        # never the session id: anyone reading the log could use it
+        for name, value in request.log_fields.items():
+            if name != 'session_saved':
+                fields.append((name, value))
+        return fields
+
 
     def finish_successful_request(self, request):
         """Called at the end of a successful request.  Overridden by
@@ -324,7 +425,8 @@ class Publisher:
 
         # Throw away the existing response object and start a new one
         # for the error document we're going to create here.
-        request.response = HTTPResponse()
+        request.response = HTTPResponse(
+            charset=self.config.output_encoding)
 
         # set response status code so every custom doesn't have to do it
         request.response.set_status(exc.status_code)
@@ -360,7 +462,8 @@ class Publisher:
         """
         # build new response to be safe
         original_response = request.response
-        request.response = HTTPResponse()
+        request.response = HTTPResponse(
+            charset=self.config.output_encoding)
         #self.log("caught an error (%s), reporting it." %
         #         sys.exc_info()[1])
 
@@ -394,7 +497,18 @@ class Publisher:
         self.error_log.write(plain_error_msg)
 
         if self.config.error_email:
-            self.mail_error(plain_error_msg, error_summary)
+            mailer = self.get_error_mailer()
+            if mailer is None:
+                self.mail_error(plain_error_msg, error_summary)
+            else:
+                mailer.report(fingerprint(exc_type, tb), plain_error_msg,
+                              error_summary)
+
+        metrics = self.get_metrics()
+        if metrics is not None:
+            metrics.count_exception(self._get_handler_name(),
+                                    getattr(exc_type, '__name__',
+                                            str(exc_type)))
 
         request.response.set_status(500)
         return user_error_msg
@@ -438,7 +552,144 @@ class Publisher:
         """Send an email notifying someone of a traceback."""
         sendmail('Quixote Traceback (%s)' % error_summary,
                  msg, [self.config.error_email],
-                 from_addr=(self.config.error_email, socket.gethostname()))
+                 from_addr=(self.config.error_email, socket.gethostname()),
+                 config=self.config)
+
+    def get_error_mailer(self):
+        """get_error_mailer() -> ErrorMailer | None
+
+        Return the queue that error reports are mailed from, creating
+        it on first use.  Returns None if ERROR_EMAIL_WINDOW is 0, in
+        which case reports are mailed synchronously.
+        """
+        if not self.config.error_email_window:
+            return None
+        if self._error_mailer is None:
+            self._lock.acquire()
+            try:
+                if self._error_mailer is None:
+                    self._error_mailer = ErrorMailer(
+                        self.mail_error, self.log,
+                        window=self.config.error_email_window,
+                        limit=self.config.error_email_limit or 1)
+            finally:
+                self._lock.release()
+        return self._error_mailer
+
+    def get_profiler(self):
+        """get_profiler() -> RequestProfiler | None
+
+        Return the profiler used for sampling requests, creating it on
+        first use.  Returns None if PROFILE_DIR is not set.
+        """
+        if self.config.profile_dir is None:
+            return None
+        if (self._profiler is None or
+                self._profiler.directory != self.config.profile_dir):
+            self._lock.acquire()
+            try:
+                if (self._profiler is None or
+                        self._profiler.directory != self.config.profile_dir):
+                    self._profiler = RequestProfiler(
+                        self.config.profile_dir,
+                        self.config.profile_every or 0,
+                        self.config.profile_secret,
+                        self.config.profile_keep)
+            finally:
+                self._lock.release()
+        return self._profiler
+
+    def get_metrics(self):
+        """get_metrics() -> Metrics | None
+
+        Return the metrics collector, creating it on first use.  Returns
+        None if the METRICS config variable is false.
+        """
+        if not self.config.metrics:
+            return None
+        if self._metrics is None:
+            self._lock.acquire()
+            try:
+                if self._metrics is None:
+                    self._metrics = Metrics(self.config.metrics_dir)
+            finally:
+                self._lock.release()
+        return self._metrics
+
+    def get_fragment_cache(self):
+        """get_fragment_cache() -> FragmentCache
+
+        Return the cache used by templates decorated with
+        quixote.cache.cached(), creating it on first use.
+        """
+        if self._fragment_cache is None:
+            self._lock.acquire()
+            try:
+                if self._fragment_cache is None:
+                    store = None
+                    if self.config.fragment_cache_dir:
+                        store = FileStore(self.config.fragment_cache_dir)
+                    self._fragment_cache = FragmentCache(
+                        self.config.fragment_cache_size or 0, store)
+            finally:
+                self._lock.release()
+        return self._fragment_cache
+
+    def get_response_cache(self):
+        """get_response_cache() -> ResponseCache | None
+
+        Return the cache of complete responses, creating it on first
+        use.  Returns None if RESPONSE_CACHE_SIZE is 0.
+        """
+        if not self.config.response_cache_size:
+            return None
+        if self._response_cache is None:
+            self._lock.acquire()
+            try:
+                if self._response_cache is None:
+                    store = None
+                    if self.config.response_cache_dir:
+                        store = FileStore(self.config.response_cache_dir)
+                    self._response_cache = ResponseCache(
+                        self.config.response_cache_size, store)
+            finally:
+                self._lock.release()
+        return self._response_cache
+
+    def _get_handler_name(self):
+        """Return the name of the object that the current request was
+        traversed to (see quixote.profiler.handler_name()).
+        """
+        if self.namespace_stack:
+            return handler_name(self.namespace_stack[-1])
+        else:
+            return handler_name(self.root_namespace)
+
+    def record_metrics(self, request):
+        """Called at the end of every request when METRICS is enabled.
+        Overridden by SessionPublisher to track the session table too.
+        """
+        metrics = self.get_metrics()
+        seconds = time.time() - (request.start_time or time.time())
+        metrics.observe_request(self._get_handler_name(),
+                                request.response.status_code, seconds)
+        if isinstance(request, HTTPUploadRequest):
+            try:
+                metrics.add_upload(int(request.environ.get('CONTENT_LENGTH')))
+            except (TypeError, ValueError):
+                pass
+
+    def _profile_publish(self, profiler, request, path):
+        """Run try_publish() under 'profiler' and save the profile under
+        the name of the handler that served the request.
+        """
+        output, prof = profiler.run(self.try_publish, request, path)
+        name = self._get_handler_name()
+        try:
+            profiler.dump(prof, name)
+        except (IOError, OSError), exc:
+            self.log('error saving profile for %s: %s' % (name, exc))
+        return output
 
     def get_namespace_stack(self):
         """get_namespace_stack() ->  [ module | instance | class ]
@@ -455,13 +706,32 @@ class Publisher:
 
         self.start_request(request)
 
-        # Initialize the publisher's namespace_stack
-        self.namespace_stack = []
+        # Initialize this thread's namespace_stack
+        self._local.namespace_stack = []
 
+        # A response cached by an earlier request is sent again as is
+        cache = self.get_response_cache()
+        fill_key = None
+        if cache is not None:
+            entry, fill_key = cache.lookup(request)
+            if entry is not None:
+                return self._cached_output(request, entry)
+        try:
+            output = self._publish(request, path)
+            if cache is not None and isstring(output):
+                self._store_response(cache, request, output, fill_key)
+        finally:
+            if fill_key is not None:
+                cache.release(fill_key)
+        return output
+
+    def _publish(self, request, path):
         # Traverse package to a (hopefully-) callable object
+        start = time.time()
         object = _traverse_url(self.root_namespace, path, request,
                                self.config.fix_trailing_slash,
                                self.namespace_stack)
+        request.timings['traverse'] = time.time() - start
 
         # None means no output -- traverse_url() just issued a redirect.
         if object is None:
@@ -473,6 +743,7 @@ class Publisher:
 
         # ...or a callable.
         elif callable(object) or hasattr(object, "__call__"):
+            start = time.time()
             try:
                 if callable(object):
                     output = object(request)
@@ -481,7 +752,8 @@ class Publisher:
             except SystemExit:
                 output = "SystemExit exception caught, shutting down"
                 self.log(output)
-                self.exit_now = 1
+                self._local.exit_now = 1
+            request.timings['handler'] = time.time() - start
 
             if output is None:
                 raise RuntimeError, 'callable %s returned None' % repr(object)
@@ -505,31 +777,120 @@ class Publisher:
                     "\377")
 
     _GZIP_THRESHOLD = 200 # responses smaller than this are not compressed
+    _GZIP_CACHE_SIZE = 100 # compressed bodies kept with GENERATE_ETAGS
+
+    def _gzip(self, output):
+        co = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS,
+                              zlib.DEF_MEM_LEVEL, 0)
+        chunks = [self._GZIP_HEADER,
+                  co.compress(output),
+                  co.flush(),
+                  struct.pack("<ll", binascii.crc32(output), len(output))]
+        return "".join(chunks)
 
     def compress_output(self, request, output):
         encoding = request.get_encoding(["gzip", "x-gzip"])
         n = len(output)
         if n > self._GZIP_THRESHOLD and encoding:
-            co = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS,
-                                  zlib.DEF_MEM_LEVEL, 0)
-            chunks = [self._GZIP_HEADER,
-                      co.compress(output),
-                      co.flush(),
-                      struct.pack("<ll", binascii.crc32(output), len(output))]
-            output = "".join(chunks)
+            start = time.time()
+            output = self._gzip(output)
             #self.log("gzip (original size %d, ratio %.1f)" %
             #           (n, float(n)/len(output)))
             request.response.set_header("Content-Encoding", encoding)
+            request.timings['compress'] = time.time() - start
+            metrics = self.get_metrics()
+            if metrics is not None:
+                metrics.add_compression(n, len(output))
         return output
 
+    def _store_response(self, cache, request, output, fill_key):
+        """Hand the response to 'cache', with its body encoded and, if
+        COMPRESS_PAGES is set, compressed as well.
+        """
+        response = request.response
+        body = response.encode(output)
+        if (self.config.generate_etags and response.cache_policy and
+                not response.get_header("etag")):
+            # Tag the uncompressed body now, so that hits (which may send
+            # the compressed body) carry the same ETag as this response.
+            response.set_header("ETag", '"%s"' % md5(body).hexdigest())
+        gzip_body = None
+        if self.config.compress_pages and len(body) > self._GZIP_THRESHOLD:
+            gzip_body = self._gzip(body)
+        cache.save(request, body, gzip_body, fill_key)
+
+    def _cached_output(self, request, entry):
+        """Set up the response from an entry of the response cache and
+        return its body, compressed if the client accepts it.
+        """
+        expires, status, reason, headers, cache, body, gzip_body = entry
+        response = request.response
+        response.set_status(status, reason)
+        response.headers.update(headers)
+        response.cache = cache
+        if gzip_body is not None and self.config.compress_pages:
+            encoding = request.get_encoding(["gzip", "x-gzip"])
+            if encoding:
+                response.set_header("Content-Encoding", encoding)
+                body = gzip_body
+        request.timings['traverse'] = 0.0
+        request.log_fields['cache'] = 'hit'
+        self.finish_successful_request(request)
+        return body
+
+    def _etag_output(self, request, body):
+        """Set the ETag header of the response from a hash of 'body'
+        (unless the handler set one) and return 'body', compressed if
+        COMPRESS_PAGES is set, or an empty string if the client already
+        has it.  Compressed bodies are kept by hash, so unchanged pages
+        are only compressed once.
+        """
+        response = request.response
+        etag = response.get_header("etag")
+        digest = None
+        if etag is None:
+            digest = md5(body).hexdigest()
+            etag = '"%s"' % digest
+        encoding = None
+        if (self.config.compress_pages and len(body) > self._GZIP_THRESHOLD
+                and not response.get_header("content-encoding")):
+            encoding = request.get_encoding(["gzip", "x-gzip"])
+        if encoding or response.get_header("content-encoding"):
+            # the compressed body is a different entity
+            etag = etag[:-1] + '-gzip"'
+        response.set_header("ETag", etag)
+        if request.etag_matches(etag):
+            response.set_status(304)
+            return ""
+        if not encoding:
+            return body
+        compressed = None
+        if digest is not None:
+            compressed = self._compressed.get(digest)
+        if compressed is None:
+            compressed = self.compress_output(request, body)
+            if digest is not None:
+                self._compressed.set(digest, compressed)
+        else:
+            response.set_header("Content-Encoding", encoding)
+        return compressed
+
     def filter_output(self, request, output):
         """Hook for post processing the output.  Subclasses may wish to
         override (e.g. check HTML syntax).
         """
+        if (output and
+                self.config.generate_etags and
+                not isinstance(output, Stream) and
+                request.response.status_code == 200 and
+                request.get_method() in ("GET", "HEAD")):
+            return self._etag_output(request, request.response.encode(output))
         if (output and
                 self.config.compress_pages and
-                not isinstance(output, Stream)):
-            output = self.compress_output(request, str(output))
+                not isinstance(output, Stream) and
+                not request.response.get_header("content-encoding")):
+            output = self.compress_output(request,
+                                          request.response.encode(output))
         return output
 
     def process_request(self, request, env):
@@ -541,8 +902,20 @@ class Publisher:
         """
         self._set_request(request)
         try:
+            start = time.time()
             self.parse_request(request)
-            output = self.try_publish(request, env.get('PATH_INFO', ''))
+            request.timings['parse'] = time.time() - start
+            path = env.get('PATH_INFO', '')
+            profiler = self.get_profiler()
+            if profiler is not None and profiler.should_profile(request):
+                output = self._profile_publish(profiler, request, path)
+            else:
+                output = self.try_publish(request, path)
+            if output and not isinstance(output, Stream):
+                # Encode here rather than in set_body(), so that text
+                # the charset can't represent is reported like any
+                # other error.
+                output = request.response.encode(output)
         except errors.PublishError, exc:
             # Exit the publishing loop and return a result right away.
             output = self.finish_interrupted_request(request, exc)
@@ -553,8 +926,13 @@ class Publisher:
             output = self.finish_failed_request(request)
             if self.config.debug_propagate_exceptions:
                 raise
+        start = time.time()
         output = self.filter_output(request, output)
-        self.log_request(request)
+        request.timings['filter'] = time.time() - start
+        if self.config.metrics:
+            self.record_metrics(request)
+        if not request.log_deferred:
+            self.log_request(request)
         return output
 
     def publish(self, stdin, stdout, stderr, env):
@@ -565,15 +943,28 @@ class Publisher:
         output.
         """
         request = self.create_request(stdin, env)
+        request.log_deferred = self._defer_log()
         output = self.process_request(request, env)
 
         # Output results from Response object
         if output:
             request.response.set_body(output)
+        start = time.time()
+        if self.config.nph:
+            http_version = env.get('SERVER_PROTOCOL')
+            if http_version not in ('HTTP/1.0', 'HTTP/1.1'):
+                http_version = 'HTTP/1.0'
+            send_body = request.get_method() != 'HEAD'
+        else:
+            http_version = None
+            send_body = 1
         try:
-            request.response.write(stdout)
+            request.response.write(stdout, http_version, send_body)
         except IOError, exc:
             self.log('IOError caught while writing request (%s)' % exc)
+        request.timings['write'] = time.time() - start
+        if request.log_deferred:
+            self.log_request(request)
         self._clear_request()
 
 
@@ -633,6 +1024,14 @@ class SessionPublisher(Publisher):
             self.session_mgr.maintain_session(request, request.session)
         self.session_mgr.commit_changes(request.session)
 
+    def record_metrics(self, request):
+        Publisher.record_metrics(self, request)
+        try:
+            count = len(self.session_mgr.sessions)
+        except TypeError:
+            return # session mapping doesn't know its size
+        self.get_metrics().set_sessions(count)
+
     def finish_interrupted_request(self, request, exc):
         output = Publisher.finish_interrupted_request(self, request, exc)
 
@@ -3,15 +3,28 @@ $HeadURL: svn+ssh://svn/repos/trunk/quixote/sendmail.py $
 $Id$
 
 Tools for sending mail from Quixote applications.
+
+Messages are sent through a Mailer, which keeps a small pool of SMTP
+connections to MAIL_SERVER open between messages and can send a batch
+of messages over a single connection.  If MAIL_OUTBOX is true,
+sendmail() hands messages to a background Outbox instead of waiting
+for the SMTP server.
 """
 
 # created 2001/08/27, Greg Ward (with a long and complicated back-story)
 
 __revision__ = "$Id$"
 
+import os
 import re
+import sys
+import time
+import socket
+import atexit
+import threading
+import Queue
 from types import ListType, TupleType, StringType
-from smtplib import SMTP
+from smtplib import SMTP, SMTPServerDisconnected
 
 rfc822_specials_re = re.compile(r'[\(\)\<\>\@\,\;\:\\\"\.\[\]]')
 
@@ -117,6 +130,90 @@ def _add_recip_headers(headers, field_name, addrs):
         headers.append("%s: (long recipient list suppressed) : ;" % field_name)
 
 
+def build_message(subject, msg_body, to_addrs,
+                  from_addr=None, cc_addrs=None,
+                  extra_headers=None,
+                  smtp_sender=None, smtp_recipients=None,
+                  config=None):
+    """build_message(...) -> (smtp_sender : string,
+                             smtp_recipients : [string],
+                             message : string)
+
+    Build a message the way sendmail() does, but return it instead of
+    sending it.  Takes the same arguments as sendmail().  The result
+    can be passed to Mailer.send() or, in a list, to Mailer.send_batch().
+    """
+    if config is None:
+        from quixote import get_publisher
+        config = get_publisher().config
+
+    if not isinstance(to_addrs, ListType):
+        raise TypeError("'to_addrs' must be a list")
+    if not (cc_addrs is None or isinstance(cc_addrs, ListType)):
+        raise TypeError("'cc_addrs' must be a list or None")
+
+    # Make sure we have a "From" address
+    if from_addr is None:
+        from_addr = config.mail_from
+    if from_addr is None:
+        raise RuntimeError(
+            "no from_addr supplied, and MAIL_FROM not set in config file")
+
+    # Ensure all of our addresses are really RFC822Mailbox objects.
+    from_addr = _ensure_mailbox(from_addr)
+    to_addrs = map(_ensure_mailbox, to_addrs)
+    if cc_addrs:
+        cc_addrs = map(_ensure_mailbox, cc_addrs)
+
+    # Start building the message headers.
+    headers = ["From: %s" % from_addr.format(),
+               "Subject: %s" % subject]
+    _add_recip_headers(headers, "To", to_addrs)
+
+    if cc_addrs:
+        _add_recip_headers(headers, "Cc", cc_addrs)
+
+    if extra_headers:
+        headers.extend(extra_headers)
+
+    if config.mail_debug_addr:
+        debug1 = ("[debug mode, message actually sent to %s]\n"
+                  % config.mail_debug_addr)
+        if smtp_recipients:
+            debug2 = ("[original SMTP recipients: %s]\n"
+                      % ", ".join(smtp_recipients))
+        else:
+            debug2 = ""
+
+        sep = ("-"*72) + "\n"
+        msg_body = debug1 + debug2 + sep + msg_body
+
+        smtp_recipients = [config.mail_debug_addr]
+
+    if smtp_sender is None:
+        smtp_sender = from_addr.addr_spec
+    else:
+        smtp_sender = _ensure_mailbox(smtp_sender).addr_spec
+
+    if smtp_recipients is None:
+        smtp_recipients = [addr.addr_spec for addr in to_addrs]
+        if cc_addrs:
+            smtp_recipients.extend([addr.addr_spec for addr in cc_addrs])
+    else:
+        smtp_recipients = [_ensure_mailbox(recip).addr_spec
+                           for recip in smtp_recipients]
+
+    message = "\n".join(headers) + "\n\n" + msg_body
+
+    # Sanity checks
+    assert type(smtp_sender) is StringType, \
+           "smtp_sender not a string: %r" % (smtp_sender,)
+    assert (type(smtp_recipients) is ListType and
+            map(type, smtp_recipients) == [StringType]*len(smtp_recipients)), \
+            "smtp_recipients not a list of strings: %r" % (smtp_recipients,)
+    return (smtp_sender, smtp_recipients, message)
+
+
 def sendmail(subject, msg_body, to_addrs,
              from_addr=None, cc_addrs=None,
              extra_headers=None,
@@ -196,78 +293,302 @@ def sendmail(subject, msg_body, to_addrs,
     that sendmail() would send out is diverted to the debug address.
 
     Generally raises an exception on any SMTP errors; see smtplib (in
-    the standard library documentation) for details.
+    the standard library documentation) for details.  If MAIL_OUTBOX is
+    true the message is queued and sent from a background thread
+    instead, and SMTP errors are only logged to stderr.
     """
     if config is None:
         from quixote import get_publisher
         config = get_publisher().config
+    (smtp_sender, smtp_recipients, message) = build_message(
+        subject, msg_body, to_addrs, from_addr, cc_addrs, extra_headers,
+        smtp_sender, smtp_recipients, config)
+    if config.mail_outbox:
+        get_outbox(config).put(smtp_sender, smtp_recipients, message)
+    else:
+        get_mailer(config).send(smtp_sender, smtp_recipients, message)
 
-    if not isinstance(to_addrs, ListType):
-        raise TypeError("'to_addrs' must be a list")
-    if not (cc_addrs is None or isinstance(cc_addrs, ListType)):
-        raise TypeError("'cc_addrs' must be a list or None")
-
-    # Make sure we have a "From" address
-    if from_addr is None:
-        from_addr = config.mail_from
-    if from_addr is None:
-        raise RuntimeError(
-            "no from_addr supplied, and MAIL_FROM not set in config file")
-
-    # Ensure all of our addresses are really RFC822Mailbox objects.
-    from_addr = _ensure_mailbox(from_addr)
-    to_addrs = map(_ensure_mailbox, to_addrs)
-    if cc_addrs:
-        cc_addrs = map(_ensure_mailbox, cc_addrs)
-
-    # Start building the message headers.
-    headers = ["From: %s" % from_addr.format(),
-               "Subject: %s" % subject]
-    _add_recip_headers(headers, "To", to_addrs)
-
-    if cc_addrs:
-        _add_recip_headers(headers, "Cc", cc_addrs)
-
-    if extra_headers:
-        headers.extend(extra_headers)
-
-    if config.mail_debug_addr:
-        debug1 = ("[debug mode, message actually sent to %s]\n"
-                  % config.mail_debug_addr)
-        if smtp_recipients:
-            debug2 = ("[original SMTP recipients: %s]\n"
-                      % ", ".join(smtp_recipients))
-        else:
-            debug2 = ""
+# sendmail ()
 
-        sep = ("-"*72) + "\n"
-        msg_body = debug1 + debug2 + sep + msg_body
 
-        smtp_recipients = [config.mail_debug_addr]
+class Mailer:
+    """
+    Sends messages to one SMTP server, keeping up to 'pool_size'
+    connections open between messages.  Idle connections older than
+    'idle_timeout' seconds are closed rather than reused, and a
+    connection that turns out to be dead is replaced once before giving
+    up.  Mailer instances may be shared between threads, and survive a
+    fork: connections opened before it are left to the parent.
+    """
 
-    if smtp_sender is None:
-        smtp_sender = from_addr.addr_spec
-    else:
-        smtp_sender = _ensure_mailbox(smtp_sender).addr_spec
+    def __init__(self, server, pool_size=2, idle_timeout=60, smtp_class=SMTP):
+        self.server = server
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.smtp_class = smtp_class
+        self._idle = [] # [(SMTP, last_used : float)]
+        self._pid = os.getpid() # process that opened the idle connections
+        self._lock = threading.Lock()
 
-    if smtp_recipients is None:
-        smtp_recipients = [addr.addr_spec for addr in to_addrs]
-        if cc_addrs:
-            smtp_recipients.extend([addr.addr_spec for addr in cc_addrs])
-    else:
-        smtp_recipients = [_ensure_mailbox(recip).addr_spec
-                           for recip in smtp_recipients]
+    def __repr__(self):
+        return "<%s at %x: %s>" % (self.__class__.__name__, id(self),
+                                   self.server)
+
+    def _connect(self):
+        return self.smtp_class(self.server)
+
+    def _forget_inherited(self):
+        # Called with the lock held.  Idle connections inherited through
+        # a fork are the parent's: only close our copy of their sockets,
+        # as sending QUIT would end the parent's SMTP sessions.
+        if self._pid != os.getpid():
+            for smtp, last_used in self._idle:
+                _close(smtp)
+            self._idle = []
+            self._pid = os.getpid()
+
+    def _acquire(self):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._forget_inherited()
+            while self._idle:
+                smtp, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return smtp
+                _quit(smtp)
+        finally:
+            self._lock.release()
+        return self._connect()
+
+    def _release(self, smtp):
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.pool_size:
+                self._idle.append((smtp, time.time()))
+                return
+        finally:
+            self._lock.release()
+        _quit(smtp)
+
+    def _send(self, smtp, sender, recipients, message):
+        # Send one message, replacing 'smtp' if the server hung up on it.
+        # Returns the connection that should be used from now on.
+        try:
+            smtp.sendmail(sender, recipients, message)
+            return smtp
+        except (SMTPServerDisconnected, socket.error):
+            _close(smtp)
+        smtp = self._connect()
+        try:
+            smtp.sendmail(sender, recipients, message)
+        except:
+            _close(smtp)
+            raise
+        return smtp
+
+    def _reset(self, smtp):
+        # Get a connection back into a known state after a failed message.
+        try:
+            smtp.rset()
+            return smtp
+        except Exception:
+            _close(smtp)
+            return self._connect()
+
+    def send(self, sender, recipients, message):
+        """send(sender : string, recipients : [string], message : string)
+
+        Send one message.  Raises smtplib exceptions on failure.
+        """
+        self.send_batch([(sender, recipients, message)], raise_errors=1)
 
-    message = "\n".join(headers) + "\n\n" + msg_body
+    def send_batch(self, messages, raise_errors=0):
+        """send_batch(messages : [(string, [string], string)],
+                      raise_errors : bool = false) -> [exception | None]
 
-    # Sanity checks
-    assert type(smtp_sender) is StringType, \
-           "smtp_sender not a string: %r" % (smtp_sender,)
-    assert (type(smtp_recipients) is ListType and
-            map(type, smtp_recipients) == [StringType]*len(smtp_recipients)), \
-            "smtp_recipients not a list of strings: %r" % (smtp_recipients,)
-    smtp = SMTP(config.mail_server)
-    smtp.sendmail(smtp_sender, smtp_recipients, message)
-    smtp.quit()
+        Send several messages, as returned by build_message(), over one
+        connection.  Returns a list with one entry per message: None if
+        it was sent, or the exception that prevented it.  If
+        'raise_errors' is true the first failure is raised instead.
+        """
+        results = []
+        smtp = None
+        try:
+            smtp = self._acquire()
+            for sender, recipients, message in messages:
+                try:
+                    smtp = self._send(smtp, sender, recipients, message)
+                except Exception, exc:
+                    if raise_errors:
+                        raise
+                    results.append(exc)
+                    smtp = self._reset(smtp)
+                else:
+                    results.append(None)
+        except:
+            if smtp is not None:
+                _close(smtp)
+            raise
+        self._release(smtp)
+        return results
+
+    def close(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            self._forget_inherited()
+            idle = self._idle
+            self._idle = []
+        finally:
+            self._lock.release()
+        for smtp, last_used in idle:
+            _quit(smtp)
+
+
+def _quit(smtp):
+    try:
+        smtp.quit()
+    except Exception:
+        _close(smtp)
+
+def _close(smtp):
+    try:
+        smtp.close()
+    except Exception:
+        pass
+
+
+class Outbox:
+    """
+    A queue of messages that are sent by a background thread through
+    'mailer', so that request handlers do not wait for SMTP.  Messages
+    that cannot be sent are reported to 'log' (by default, written to
+    stderr).  Whatever is still queued when the process exits is sent
+    by an exit handler.  After a fork, the child starts with an empty
+    queue and a sender thread of its own: what was queued before is
+    left to the parent.
+    """
 
-# sendmail ()
+    def __init__(self, mailer, maxsize=1000, batch_size=50, log=None):
+        self.mailer = mailer
+        self.batch_size = batch_size
+        self.log = log
+        self._queue = Queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None # process running the sender thread
+        atexit.register(self.flush)
+
+    def _forget_inherited(self):
+        # Called with the lock held.  A queue inherited through a fork
+        # holds the parent's messages, and its mutex may have been held
+        # by one of the parent's threads: start over with a new one.
+        if self._pid is not None and self._pid != os.getpid():
+            self._queue = Queue.Queue(self._queue.maxsize)
+            self._thread = None
+            self._pid = None
+
+    def put(self, sender, recipients, message):
+        """Queue a message; blocks if 'maxsize' messages are waiting."""
+        if self._pid != os.getpid():
+            self._lock.acquire()
+            try:
+                if self._pid != os.getpid():
+                    self._forget_inherited()
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(
+                        target=self._run, name="quixote-outbox")
+                    self._thread.setDaemon(1)
+                    self._thread.start()
+            finally:
+                self._lock.release()
+        self._queue.put((sender, recipients, message))
+
+    def _get_batch(self, block):
+        batch = []
+        try:
+            batch.append(self._queue.get(block))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return batch
+
+    def _send(self, batch):
+        try:
+            results = self.mailer.send_batch(batch)
+        except Exception, exc:
+            results = [exc] * len(batch)
+        for (sender, recipients, message), exc in zip(batch, results):
+            if exc is not None:
+                self._log("error sending mail to %s: %s"
+                          % (", ".join(recipients), exc))
+
+    def _log(self, msg):
+        if self.log is not None:
+            self.log(msg)
+        else:
+            sys.stderr.write("%s\n" % msg)
+
+    def _run(self):
+        while 1:
+            self._send(self._get_batch(1))
+
+    def flush(self):
+        """Send everything queued so far, in the calling thread."""
+        if self._pid is not None and self._pid != os.getpid():
+            self._lock.acquire()
+            try:
+                self._forget_inherited()
+            finally:
+                self._lock.release()
+        while 1:
+            batch = self._get_batch(0)
+            if not batch:
+                break
+            self._send(batch)
+
+
+_mailers = {}
+_outboxes = {}
+_registry_lock = threading.Lock()
+
+def get_mailer(config):
+    """get_mailer(config : Config) -> Mailer
+
+    Return the shared Mailer for config.mail_server.
+    """
+    server = config.mail_server
+    mailer = _mailers.get(server)
+    if mailer is None:
+        _registry_lock.acquire()
+        try:
+            mailer = _mailers.get(server)
+            if mailer is None:
+                pool_size = config.mail_pool_size
+                if pool_size is None:
+                    pool_size = 2
+                mailer = _mailers[server] = Mailer(
+                    server, pool_size, config.mail_idle_timeout or 0)
+        finally:
+            _registry_lock.release()
+    return mailer
+
+def get_outbox(config):
+    """get_outbox(config : Config) -> Outbox
+
+    Return the shared Outbox that sends through get_mailer(config).
+    """
+    server = config.mail_server
+    outbox = _outboxes.get(server)
+    if outbox is None:
+        mailer = get_mailer(config)
+        _registry_lock.acquire()
+        try:
+            outbox = _outboxes.get(server)
+            if outbox is None:
+                outbox = _outboxes[server] = Outbox(mailer)
+        finally:
+            _registry_lock.release()
+    return outbox
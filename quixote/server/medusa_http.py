@@ -13,7 +13,7 @@ import sys
 import asyncore, rfc822, socket, urllib
 from StringIO import StringIO
 from medusa import http_server, xmlrpc_handler
-from quixote.http_response import Stream
+from quixote.http_response import Stream, FLUSH
 from quixote.publish import Publisher
 
 
@@ -22,8 +22,13 @@ class StreamProducer:
         self.iterator = iter(stream)
 
     def more(self):
+        # medusa takes an empty string to mean the end of the stream and
+        # does its own buffering, so skip empty chunks and flush markers
         try:
-            return self.iterator.next()
+            while 1:
+                chunk = self.iterator.next()
+                if chunk and chunk is not FLUSH:
+                    return chunk
         except StopIteration:
             return ''
 
@@ -106,9 +111,10 @@ class QuixoteHandler:
             qresponse.set_body(output)
 
         # Copy headers from Quixote's HTTP response
-        for name, value in qresponse.generate_headers():
+        for name, value in qresponse.generate_headers()[1:]:
             # XXX Medusa's HTTP request is buggy, and only allows unique
-            # headers.
+            # headers.  (The first header is the CGI "Status" header,
+            # which becomes the status line instead.)
             request[name] = value
 
         request.response(qresponse.status_code)
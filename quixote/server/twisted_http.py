@@ -29,7 +29,7 @@ from twisted.spread import pb
 from twisted.python import threadable
 from twisted.internet import abstract
 
-from quixote.http_response import Stream
+from quixote.http_response import Stream, FLUSH
 
 class QuixoteTWRequest(server.Request):
 
@@ -43,7 +43,8 @@ class QuixoteTWRequest(server.Request):
         self.quixote_publish(qxrequest, environ)
         resp = qxrequest.response
         self.setResponseCode(resp.status_code)
-        for hdr, value in resp.generate_headers():
+        # skip the CGI "Status" header; setResponseCode() covers it
+        for hdr, value in resp.generate_headers()[1:]:
             self.setHeader(hdr, value)
         if resp.body is not None:
             TWProducer(resp.body, self)
@@ -177,13 +178,15 @@ class TWProducer(pb.Viewable):
             bytesInBuffer = len(buffer[-1])
             while bytesInBuffer < self.outputBufferSize:
                 try:
-                    buffer.append(self.streamIter.next())
-                    bytesInBuffer += len(buffer[-1])
+                    chunk = self.streamIter.next()
                 except StopIteration:
                     # We've exhausted the Stream, time to clean up.
                     self.stream = None
                     self.streamIter = None
                     break
+                if chunk is not FLUSH:
+                    buffer.append(chunk)
+                    bytesInBuffer += len(chunk)
             self.data = "".join(buffer)
 
         if self.data:
@@ -305,6 +305,7 @@ class SessionManager:
             session.id = self._make_session_id()
             self[session.id] = session
             self.set_session_cookie(request, session.id)
+            request.log_fields['session_saved'] = True
 
         elif session.is_dirty():
             # We have already stored this session, but it's dirty
@@ -313,6 +314,7 @@ class SessionManager:
             # applications using a persistence mechanism that requires
             # repeatedly storing the same object in the same mapping.
             self[session.id] = session
+            request.log_fields['session_saved'] = True
 
     def _set_cookie(self, request, value, **attrs):
         config = get_publisher().config
@@ -14,10 +14,6 @@ from quixote.qx_distutils import qx_build_py
 htmltext = Extension(name="quixote._c_htmltext",
                      sources=["src/_c_htmltext.c"])
 
-# faster import hook for PTL modules
-cimport = Extension(name="quixote.cimport",
-                    sources=["src/cimport.c"])
-
 kw = {'name': "Quixote",
       'version': "1.2",
       'description': "A highly Pythonic Web application framework",
@@ -43,7 +39,6 @@ if build_extensions:
     # The _c_htmltext module requires Python 2.2 features.
     if sys.hexversion >= 0x20200a1:
         kw['ext_modules'].append(htmltext)
-    kw['ext_modules'].append(cimport)
 
     kw['classifiers'] = ['Development Status :: 5 - Production/Stable',
       'Environment :: Web Environment',
@@ -1,11 +1,14 @@
-/* htmltext type and the htmlescape function  */
+/* htmltext type and the htmlescape function
+
+   An htmltext object holds either a str or a unicode object; unicode is
+   kept as it is until the response is encoded for output. */
 
 #include "Python.h"
 #include "structmember.h"
 
 typedef struct {
 	PyObject_HEAD
-	PyStringObject *s;
+	PyObject *s; /* str or unicode */
 } htmltextObject;
 
 static PyTypeObject htmltext_Type;
@@ -27,6 +30,7 @@ static PyTypeObject QuoteWrapper_Type;
 typedef struct {
 	PyObject_HEAD
 	PyObject *obj;
+	int quote_repr;
 } DictWrapperObject;
 
 static PyTypeObject DictWrapper_Type;
@@ -37,9 +41,13 @@ static PyTypeObject DictWrapper_Type;
 typedef struct {
 	PyObject_HEAD
 	int html;
+	int is_unicode;	/* output is collected in ubuf instead of buf */
 	char *buf;
 	size_t size;
 	size_t pos;
+	Py_UNICODE *ubuf;
+	size_t usize;
+	size_t upos;
 } TemplateIO_Object;
 
 static PyTypeObject TemplateIO_Type;
@@ -54,78 +62,132 @@ type_error(const char *msg)
 	return NULL;
 }
 
+/* For each byte, the number of extra bytes needed to escape it, and the
+   entity that replaces it.  Filled in by init_c_htmltext(). */
+static unsigned char escape_extra[256];
+static const char *escape_entity[256];
+
+/* Return the number of bytes needed to hold s[0:size] once escaped. */
+static size_t
+escaped_size(const char *ss, size_t size)
+{
+	const unsigned char *p = (const unsigned char *)ss;
+	const unsigned char *end = p + size;
+	size_t new_size = size;
+	while (p < end)
+		new_size += escape_extra[*p++];
+	return new_size;
+}
+
+/* Escape ss[0:size] into new_ss, which must have room for
+   escaped_size(ss, size) bytes.  Returns the number of bytes written. */
+static size_t
+escape_into(char *new_ss, const char *ss, size_t size)
+{
+	size_t i, j, run;
+	for (i=0, j=0; i < size; ) {
+		/* copy runs of bytes that need no escaping in one go */
+		for (run = i; run < size &&
+			     !escape_extra[(unsigned char)ss[run]]; run++)
+			;
+		if (run > i) {
+			memcpy(new_ss + j, ss + i, run - i);
+			j += run - i;
+			i = run;
+		}
+		if (i < size) {
+			unsigned char c = (unsigned char)ss[i++];
+			size_t n = escape_extra[c] + 1;
+			memcpy(new_ss + j, escape_entity[c], n);
+			j += n;
+		}
+	}
+	return j;
+}
+
+/* The same as escaped_size() and escape_into(), for unicode data. */
+static size_t
+escaped_usize(const Py_UNICODE *us, size_t size)
+{
+	size_t i, new_size = size;
+	for (i=0; i < size; i++) {
+		if (us[i] < 256)
+			new_size += escape_extra[us[i]];
+	}
+	return new_size;
+}
+
+static size_t
+escape_uinto(Py_UNICODE *new_us, const Py_UNICODE *us, size_t size)
+{
+	size_t i, j;
+	for (i=0, j=0; i < size; i++) {
+		Py_UNICODE c = us[i];
+		if (c < 256 && escape_extra[c]) {
+			const char *entity = escape_entity[c];
+			while (*entity)
+				new_us[j++] = (unsigned char)*entity++;
+		}
+		else {
+			new_us[j++] = c;
+		}
+	}
+	return j;
+}
+
+static PyObject *
+escape_unicode(PyObject *u)
+{
+	PyObject *new_u;
+	Py_UNICODE *us;
+	size_t size, new_size;
+	us = PyUnicode_AS_UNICODE(u);
+	size = PyUnicode_GET_SIZE(u);
+	new_size = escaped_usize(us, size);
+	if (new_size == size) {
+		Py_INCREF(u);
+		return u;
+	}
+	new_u = PyUnicode_FromUnicode(NULL, new_size);
+	if (new_u == NULL)
+		return NULL;
+	escape_uinto(PyUnicode_AS_UNICODE(new_u), us, size);
+	return new_u;
+}
+
 static PyObject *
 escape_string(PyObject *s)
 {
 	PyObject *new_s;
-	char *ss, *new_ss;
-	size_t i, j, extra_space, size, new_size;
+	char *ss;
+	size_t size, new_size;
+	if (PyUnicode_Check(s))
+		return escape_unicode(s);
 	if (!PyString_Check(s))
-		return type_error("str object required");
+		return type_error("str or unicode object required");
 	ss = PyString_AS_STRING(s);
 	size = PyString_GET_SIZE(s);
-	extra_space = 0;
-	for (i=0; i < size; i++) {
-		switch (ss[i]) {
-		case '&':
-			extra_space += 4;
-			break;
-		case '<':
-		case '>':
-			extra_space += 3;
-			break;
-		case '"':
-			extra_space += 5;
-			break;
-		}
-	}
-	if (extra_space == 0) {
+	new_size = escaped_size(ss, size);
+	if (new_size == size) {
 		Py_INCREF(s);
 		return (PyObject *)s;
 	}
-	new_size = size + extra_space;
 	new_s = PyString_FromStringAndSize(NULL, new_size);
 	if (new_s == NULL)
 		return NULL;
-	new_ss = PyString_AsString(new_s);
-	for (i=0, j=0; i < size; i++) {
-		switch (ss[i]) {
-		case '&':
-			new_ss[j++] = '&';
-			new_ss[j++] = 'a';
-			new_ss[j++] = 'm';
-			new_ss[j++] = 'p';
-			new_ss[j++] = ';';
-			break;
-		case '<':
-			new_ss[j++] = '&';
-			new_ss[j++] = 'l';
-			new_ss[j++] = 't';
-			new_ss[j++] = ';';
-			break;
-		case '>':
-			new_ss[j++] = '&';
-			new_ss[j++] = 'g';
-			new_ss[j++] = 't';
-			new_ss[j++] = ';';
-			break;
-		case '"':
-			new_ss[j++] = '&';
-			new_ss[j++] = 'q';
-			new_ss[j++] = 'u';
-			new_ss[j++] = 'o';
-			new_ss[j++] = 't';
-			new_ss[j++] = ';';
-			break;
-		default:
-			new_ss[j++] = ss[i];
-			break;
-		}
-	}
-	assert (j == new_size);
+	escape_into(PyString_AS_STRING(new_s), ss, size);
 	return (PyObject *)new_s;
 }
 
+/* Return str(o), or unicode(o) if o is unicode. */
+static PyObject *
+text_of(PyObject *o)
+{
+	if (PyUnicode_Check(o))
+		return PyObject_Unicode(o);
+	return PyObject_Str(o);
+}
+
 static PyObject *
 quote_wrapper_new(PyObject *o)
 {
@@ -178,7 +240,22 @@ quote_wrapper_str(QuoteWrapperObject *self)
 }
 
 static PyObject *
-dict_wrapper_new(PyObject *o)
+quote_wrapper_unicode(QuoteWrapperObject *self)
+{
+	/* used when the format string is unicode */
+	PyObject *qs;
+	PyObject *s = PyObject_Unicode(self->obj);
+	if (s == NULL)
+		return NULL;
+	qs = escape_string(s);
+	Py_DECREF(s);
+	return qs;
+}
+
+static PyObject *wrap_arg(PyObject *arg, int quote_repr);
+
+static PyObject *
+dict_wrapper_new(PyObject *o, int quote_repr)
 {
 	DictWrapperObject *self;
 	self = PyObject_New(DictWrapperObject, &DictWrapper_Type);
@@ -186,6 +263,7 @@ dict_wrapper_new(PyObject *o)
 		return NULL;
 	Py_INCREF(o);
 	self->obj = o;
+	self->quote_repr = quote_repr;
 	return (PyObject *)self;
 }
 
@@ -204,7 +282,7 @@ dict_wrapper_subscript(DictWrapperObject *self, PyObject *key)
 	if (v == NULL) {
 		return NULL;
 	}
-	w = quote_wrapper_new(v); 
+	w = wrap_arg(v, self->quote_repr);
 	Py_DECREF(v);
 	return w;
 }
@@ -216,12 +294,13 @@ htmltext_from_string(PyObject *s)
 	PyObject *self;
 	if (s == NULL)
 		return NULL;
-	assert (PyString_Check(s));
+	assert (PyString_Check(s) || PyUnicode_Check(s));
 	self = PyType_GenericAlloc(&htmltext_Type, 0);
 	if (self == NULL) {
+		Py_DECREF(s);
 		return NULL;
 	}
-	((htmltextObject *)self)->s = (PyStringObject *)s;
+	((htmltextObject *)self)->s = s;
 	return self;
 }
 
@@ -234,15 +313,21 @@ htmltext_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 	if (!PyArg_ParseTupleAndKeywords(args, kwds, "O:htmltext", kwlist,
 					 &s))
 		return NULL;
-	s = PyObject_Str(s);
-	if (s == NULL)
-		return NULL;
+	if (htmltextObject_Check(s)) {
+		s = htmltext_STR(s);
+		Py_INCREF(s);
+	}
+	else {
+		s = text_of(s);
+		if (s == NULL)
+			return NULL;
+	}
 	self = (htmltextObject *)type->tp_alloc(type, 0);
 	if (self == NULL) {
 		Py_DECREF(s);
 		return NULL;
 	}
-	self->s = (PyStringObject *)s;
+	self->s = s;
 	return (PyObject *)self;
 }
 
@@ -264,8 +349,16 @@ htmltext_hash(PyObject *self)
 static PyObject *
 htmltext_str(htmltextObject *self)
 {
+	if (PyUnicode_Check(self->s))
+		return PyObject_Str(self->s);
 	Py_INCREF(self->s);
-	return (PyObject *)self->s;
+	return self->s;
+}
+
+static PyObject *
+htmltext_unicode(htmltextObject *self)
+{
+	return PyObject_Unicode(self->s);
 }
 
 static PyObject *
@@ -284,92 +377,162 @@ static PyObject *
 htmltext_richcompare(PyObject *a, PyObject *b, int op)
 {
 	PyObject *sa, *sb;
-	if (PyString_Check(a)) {
+	if (PyString_Check(a) || PyUnicode_Check(a)) {
 		sa = a;
 	} else if (htmltextObject_Check(a)) {
 		sa = htmltext_STR(a);
 	} else {
 		goto fail;
 	}
-	if (PyString_Check(b)) {
+	if (PyString_Check(b) || PyUnicode_Check(b)) {
 		sb = b;
 	} else if (htmltextObject_Check(b)) {
 		sb = htmltext_STR(b);
 	} else {
 		goto fail;
 	}
-	return sa->ob_type->tp_richcompare(sa, sb, op);
+	return PyObject_RichCompare(sa, sb, op);
 
 fail:
 	Py_INCREF(Py_NotImplemented);
 	return Py_NotImplemented;
 }
 
-static long
+static Py_ssize_t
 htmltext_length(htmltextObject *self)
 {
-	return ((PyStringObject *)self->s)->ob_size;
+	return PyObject_Size(self->s);
 }
 
 
+/* Return true if the format string 'fmt' has "%(key)" specifications
+   in *use_dict and whether it has %r conversions in *has_repr. */
+static void
+analyze_format(PyObject *fmt, int *use_dict, int *has_repr)
+{
+	int is_unicode = PyUnicode_Check(fmt);
+	char *s = NULL;
+	Py_UNICODE *u = NULL;
+	size_t i, n;
+	Py_UNICODE c;
+#define FORMAT_CHAR(i) (is_unicode ? u[i] : (unsigned char)s[i])
+	if (is_unicode) {
+		u = PyUnicode_AS_UNICODE(fmt);
+		n = PyUnicode_GET_SIZE(fmt);
+	}
+	else {
+		s = PyString_AS_STRING(fmt);
+		n = PyString_GET_SIZE(fmt);
+	}
+	*use_dict = *has_repr = 0;
+	for (i=0; i < n; i++) {
+		if (FORMAT_CHAR(i) != '%')
+			continue;
+		if (++i < n && FORMAT_CHAR(i) == '(') {
+			/* skip the key; it may contain parentheses */
+			int depth = 1;
+			*use_dict = 1;
+			for (i++; i < n && depth > 0; i++) {
+				c = FORMAT_CHAR(i);
+				if (c == '(')
+					depth++;
+				else if (c == ')')
+					depth--;
+			}
+		}
+		/* skip flags, width, precision and length modifier */
+		while (i < n && (c = FORMAT_CHAR(i)) < 128 && c != 0 &&
+		       strchr("-+ #0123456789.*hlL", (int)c) != NULL)
+			i++;
+		if (i < n && FORMAT_CHAR(i) == 'r')
+			*has_repr = 1;
+	}
+#undef FORMAT_CHAR
+}
+
+/* Return true if 'arg' can be passed to PyString_Format() as it is. */
+#define needs_no_wrapper(arg) \
+	((htmltextObject_Check(arg) && PyString_Check(htmltext_STR(arg))) || \
+	 PyInt_Check(arg) || PyFloat_Check(arg) || PyLong_Check(arg))
+
 static PyObject *
-wrap_arg(PyObject *arg)
+wrap_arg(PyObject *arg, int quote_repr)
 {
-	PyObject *warg;
 	if (htmltextObject_Check(arg)) {
-		/* don't bother with wrapper object */
-		warg = arg;
-		Py_INCREF(arg);
-	} else {
-		warg = quote_wrapper_new(arg); 
+		/* don't bother with wrapper object, but pass unicode along
+		   as such so that the result becomes unicode too (str() of
+		   the htmltext would try to encode it) */
+		if (PyUnicode_Check(htmltext_STR(arg)))
+			arg = htmltext_STR(arg);
+	}
+	else if (PyInt_Check(arg) || PyFloat_Check(arg) || PyLong_Check(arg)) {
+		/* no need for wrapper */
+	}
+	else if (!quote_repr &&
+		 (PyString_CheckExact(arg) || PyUnicode_Check(arg))) {
+		/* escape strings right away rather than allocating a
+		   wrapper that does it later; but repr() must be escaped
+		   after the fact, so that is left to the wrapper */
+		return escape_string(arg);
+	}
+	else {
+		return quote_wrapper_new(arg);
 	}
-	return warg;
+	Py_INCREF(arg);
+	return arg;
 }
 
 static PyObject *
 htmltext_format(htmltextObject *self, PyObject *args)
 {
 	/* wrap the format arguments with QuoteWrapperObject */
-	int do_dict = 0;
+	int use_dict, quote_repr;
 	PyObject *rv, *wargs;
-	if (args->ob_type->tp_as_mapping && !PyTuple_Check(args) &&
-	    !PyString_Check(args)) {
-		char *fmt = PyString_AS_STRING(htmltext_STR(self));
-		size_t i, n = PyString_GET_SIZE(htmltext_STR(self));
-		char last = 0;
-		/* second check necessary since '%s' % {} => '{}' */
-		for (i=0; i < n; i++) {
-			if (last == '%' && fmt[i] == '(') {
-				do_dict = 1;
-				break;
-			}
-			last = fmt[i];
-		}
-	}
-	if (do_dict) {
-		wargs = dict_wrapper_new(args);
+	analyze_format(self->s, &use_dict, &quote_repr);
+	/* second check necessary since '%s' % {} => '{}' */
+	if (use_dict && args->ob_type->tp_as_mapping &&
+	    !PyTuple_Check(args) && !PyString_Check(args) &&
+	    !PyUnicode_Check(args)) {
+		wargs = dict_wrapper_new(args, quote_repr);
 		if (wargs == NULL)
 			return NULL;
 	}
 	else if (PyTuple_Check(args)) {
 		long i, n = PyTuple_GET_SIZE(args);
-		wargs = PyTuple_New(n);
 		for (i=0; i < n; i++) {
-			PyObject *wvalue = wrap_arg(PyTuple_GET_ITEM(args, i));
-			if (wvalue == NULL) {
-				Py_DECREF(wargs);
+			if (!needs_no_wrapper(PyTuple_GET_ITEM(args, i)))
+				break;
+		}
+		if (i == n) {
+			/* common case of only numbers and htmltext */
+			wargs = args;
+			Py_INCREF(wargs);
+		}
+		else {
+			wargs = PyTuple_New(n);
+			if (wargs == NULL)
 				return NULL;
+			for (i=0; i < n; i++) {
+				PyObject *wvalue = wrap_arg(
+					PyTuple_GET_ITEM(args, i), quote_repr);
+				if (wvalue == NULL) {
+					Py_DECREF(wargs);
+					return NULL;
+				}
+				PyTuple_SET_ITEM(wargs, i, wvalue);
 			}
-			PyTuple_SetItem(wargs, i, wvalue);
 		}
 	}
 	else {
-		wargs = wrap_arg(args);
+		wargs = wrap_arg(args, quote_repr);
 		if (wargs == NULL) {
 			return NULL;
 		}
 	}
-	rv = PyString_Format((PyObject *)self->s, wargs);
+	if (PyUnicode_Check(self->s))
+		rv = PyUnicode_Format(self->s, wargs);
+	else
+		rv = PyString_Format(self->s, wargs);
 	Py_DECREF(wargs);
 	return htmltext_from_string(rv);
 }
@@ -377,14 +540,14 @@ htmltext_format(htmltextObject *self, PyObject *args)
 static PyObject *
 htmltext_add(PyObject *v, PyObject *w)
 {
-	PyObject *qv, *qw;
+	PyObject *qv, *qw, *rv;
 	if (htmltextObject_Check(v) && htmltextObject_Check(w)) {
 		qv = htmltext_STR(v);
 		qw = htmltext_STR(w);
 		Py_INCREF(qv);
 		Py_INCREF(qw);
 	}
-	else if (PyString_Check(w)) {
+	else if (PyString_Check(w) || PyUnicode_Check(w)) {
 		assert (htmltextObject_Check(v));
 		qv = htmltext_STR(v);
 		qw = escape_string(w);
@@ -392,7 +555,7 @@ htmltext_add(PyObject *v, PyObject *w)
 			return NULL;
 		Py_INCREF(qv);
 	}
-	else if (PyString_Check(v)) {
+	else if (PyString_Check(v) || PyUnicode_Check(v)) {
 		assert (htmltextObject_Check(w));
 		qv = escape_string(v);
 		if (qv == NULL)
@@ -404,8 +567,15 @@ htmltext_add(PyObject *v, PyObject *w)
 		Py_INCREF(Py_NotImplemented);
 		return Py_NotImplemented;
 	}
-	PyString_ConcatAndDel(&qv, qw);
-	return htmltext_from_string(qv);
+	if (PyString_CheckExact(qv) && PyString_CheckExact(qw)) {
+		PyString_ConcatAndDel(&qv, qw);
+		return htmltext_from_string(qv);
+	}
+	/* str + unicode gives unicode */
+	rv = PyNumber_Add(qv, qw);
+	Py_DECREF(qv);
+	Py_DECREF(qw);
+	return htmltext_from_string(rv);
 }
 
 static PyObject *
@@ -439,9 +609,11 @@ htmltext_join(PyObject *self, PyObject *args)
 			Py_INCREF(qvalue);
 			Py_DECREF(value);
 		}
-		else if (PyString_Check(value)) {
+		else if (PyString_Check(value) || PyUnicode_Check(value)) {
 			qvalue = escape_string(value);
 			Py_DECREF(value);
+			if (qvalue == NULL)
+				goto error;
 		}
 		else {
 			Py_DECREF(value);
@@ -452,7 +624,10 @@ htmltext_join(PyObject *self, PyObject *args)
 			goto error;
 		}
 	}
-	rv = _PyString_Join(htmltext_STR(self), qargs);
+	if (PyUnicode_Check(htmltext_STR(self)))
+		rv = PyUnicode_Join(htmltext_STR(self), qargs);
+	else
+		rv = _PyString_Join(htmltext_STR(self), qargs);
 	Py_DECREF(qargs);
 	return htmltext_from_string(rv);
 
@@ -465,7 +640,7 @@ static PyObject *
 quote_arg(PyObject *s)
 {
 	PyObject *ss;
-	if (PyString_Check(s)) {
+	if (PyString_Check(s) || PyUnicode_Check(s)) {
 		ss = escape_string(s);
 		if (ss == NULL)
 			return NULL;
@@ -553,32 +728,52 @@ template_io_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 {
 	TemplateIO_Object *self;
 	int html = 0;
-	static char *kwlist[] = {"html", 0};
-	if (!PyArg_ParseTupleAndKeywords(args, kwds, "|i:TemplateIO",
-					 kwlist, &html))
+	long size = 0;
+	static char *kwlist[] = {"html", "size", 0};
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "|il:TemplateIO",
+					 kwlist, &html, &size))
 		return NULL;
 	self = (TemplateIO_Object *)type->tp_alloc(type, 0);
 	if (self == NULL) {
 		return NULL;
 	}
 	self->html = html != 0;
+	self->is_unicode = 0;
 	self->buf = NULL;
 	self->size = 0;
 	self->pos = 0;
+	self->ubuf = NULL;
+	self->usize = 0;
+	self->upos = 0;
+	if (size > 0) {
+		/* preallocate, so that output up to the size hint is never
+		   copied */
+		self->buf = PyMem_Malloc(size);
+		if (self->buf == NULL) {
+			Py_DECREF(self);
+			return PyErr_NoMemory();
+		}
+		self->size = size;
+	}
 	return (PyObject *)self;
 }
 
 static void
 template_io_dealloc(TemplateIO_Object *self)
 {
-	if (self->size > 0)
+	if (self->buf != NULL)
 		PyMem_Free(self->buf);
+	if (self->ubuf != NULL)
+		PyMem_Free(self->ubuf);
 	self->ob_type->tp_free((PyObject *)self);
 }
 
+/* Return the output collected so far, as a str or a unicode object. */
 static PyObject *
 template_io_str(TemplateIO_Object *self)
 {
+	if (self->is_unicode)
+		return PyUnicode_FromUnicode(self->ubuf, self->upos);
 	return PyString_FromStringAndSize(self->buf, self->pos);
 }
 
@@ -610,10 +805,11 @@ template_io_repr(TemplateIO_Object *self)
 }
 
 
-static PyObject *
-template_io_do_concat(TemplateIO_Object *self, char *s, size_t size)
+/* Make room for 'size' more bytes in the buffer.  Returns -1 and sets
+   an exception on failure. */
+static int
+template_io_reserve(TemplateIO_Object *self, size_t size)
 {
-	/* note this adds a reference to self */
 	if (self->pos + size > self->size) {
 		size_t new_size;
 		char *new_buf;
@@ -622,69 +818,169 @@ template_io_do_concat(TemplateIO_Object *self, char *s, size_t size)
 		else
 			new_size = size * 2;
 		new_buf = PyMem_Realloc(self->buf, new_size);
-		if (new_buf == NULL)
-			return NULL;
+		if (new_buf == NULL) {
+			PyErr_NoMemory();
+			return -1;
+		}
 		self->buf = new_buf;
 		self->size = new_size;
 	}
 	assert (self->pos + size <= self->size);
-	memcpy(self->buf + self->pos, s, size);
-	self->pos += size;
+	return 0;
+}
+
+/* The same, for 'size' more characters in the unicode buffer. */
+static int
+template_io_ureserve(TemplateIO_Object *self, size_t size)
+{
+	if (self->upos + size > self->usize) {
+		size_t new_size;
+		Py_UNICODE *new_buf;
+		if (self->usize > size)
+			new_size = self->usize * 2;
+		else
+			new_size = size * 2;
+		new_buf = PyMem_Realloc(self->ubuf,
+					new_size * sizeof(Py_UNICODE));
+		if (new_buf == NULL) {
+			PyErr_NoMemory();
+			return -1;
+		}
+		self->ubuf = new_buf;
+		self->usize = new_size;
+	}
+	assert (self->upos + size <= self->usize);
+	return 0;
+}
+
+/* Switch to collecting unicode, the first time unicode is added.  The
+   bytes collected so far are decoded with the default encoding, like
+   ''.join() does when given a mix of str and unicode. */
+static int
+template_io_to_unicode(TemplateIO_Object *self)
+{
+	PyObject *u = PyUnicode_Decode(self->buf, self->pos, NULL, "strict");
+	if (u == NULL)
+		return -1;
+	if (template_io_ureserve(self, PyUnicode_GET_SIZE(u)) < 0) {
+		Py_DECREF(u);
+		return -1;
+	}
+	memcpy(self->ubuf, PyUnicode_AS_UNICODE(u),
+	       PyUnicode_GET_SIZE(u) * sizeof(Py_UNICODE));
+	self->upos = PyUnicode_GET_SIZE(u);
+	Py_DECREF(u);
+	if (self->buf != NULL)
+		PyMem_Free(self->buf);
+	self->buf = NULL;
+	self->size = self->pos = 0;
+	self->is_unicode = 1;
+	return 0;
+}
+
+/* Append 's' (a str or unicode object) to the output, escaping it if
+   'escape' is true.  Returns a new reference to self. */
+static PyObject *
+template_io_append(TemplateIO_Object *self, PyObject *s, int escape)
+{
+	if (PyUnicode_Check(s)) {
+		Py_UNICODE *us = PyUnicode_AS_UNICODE(s);
+		size_t size = PyUnicode_GET_SIZE(s);
+		if (!self->is_unicode && template_io_to_unicode(self) < 0)
+			return NULL;
+		if (escape) {
+			if (template_io_ureserve(self,
+					escaped_usize(us, size)) < 0)
+				return NULL;
+			self->upos += escape_uinto(self->ubuf + self->upos,
+						   us, size);
+		}
+		else {
+			if (template_io_ureserve(self, size) < 0)
+				return NULL;
+			memcpy(self->ubuf + self->upos, us,
+			       size * sizeof(Py_UNICODE));
+			self->upos += size;
+		}
+	}
+	else if (self->is_unicode) {
+		PyObject *rv, *u = PyUnicode_FromObject(s);
+		if (u == NULL)
+			return NULL;
+		rv = template_io_append(self, u, escape);
+		Py_DECREF(u);
+		return rv;
+	}
+	else {
+		char *ss = PyString_AS_STRING(s);
+		size_t size = PyString_GET_SIZE(s);
+		if (escape) {
+			/* escape straight into the buffer, without an
+			   intermediate string */
+			if (template_io_reserve(self,
+					escaped_size(ss, size)) < 0)
+				return NULL;
+			self->pos += escape_into(self->buf + self->pos,
+						 ss, size);
+		}
+		else {
+			if (template_io_reserve(self, size) < 0)
+				return NULL;
+			memcpy(self->buf + self->pos, ss, size);
+			self->pos += size;
+		}
+	}
 	Py_INCREF(self);
 	return (PyObject *)self;
 }
-	
 
 static PyObject *
 template_io_iadd(TemplateIO_Object *self, PyObject *other)
 {
 	PyObject *rv;
-	PyObject *s = NULL;
+	PyObject *s;
 	if (!TemplateIO_Check(self))
 		return type_error("TemplateIO object required");
 	if (other == Py_None) {
 		Py_INCREF(self);
 		return (PyObject *)self;
 	}
-	else if (TemplateIO_Check(other)) {
-		TemplateIO_Object *o = (TemplateIO_Object *)other;
-		if (self->html && !o->html) {
-			PyObject *ss = PyString_FromStringAndSize(o->buf,
-								  o->pos);
-			if (ss == NULL)
-				return NULL;
-			s = escape_string(ss);
-			Py_DECREF(ss);
-			goto concat_str;
-		}
-		rv = template_io_do_concat(self, o->buf, o->pos);
-	}
 	else if (htmltextObject_Check(other)) {
-		PyStringObject *s = ((htmltextObject *)other)->s;
-		rv = template_io_do_concat(self,
-					   PyString_AS_STRING(s),
-					   PyString_GET_SIZE(s));
+		return template_io_append(self, htmltext_STR(other), 0);
 	}
-	else {
-		if (self->html) {
-			PyObject *ss = PyObject_Str(other);
-			if (ss == NULL)
-				return NULL;
-			s = escape_string(ss);
-			Py_DECREF(ss);
-		} else {
-			s = PyObject_Str(other);
-		}
-concat_str:
+	else if (PyString_CheckExact(other) || PyUnicode_CheckExact(other)) {
+		return template_io_append(self, other, self->html);
+	}
+	else if (TemplateIO_Check(other)) {
+		TemplateIO_Object *o = (TemplateIO_Object *)other;
+		s = template_io_str(o);
 		if (s == NULL)
 			return NULL;
-		rv = template_io_do_concat(self, PyString_AS_STRING(s),
-					   PyString_GET_SIZE(s));
-		Py_XDECREF(s);
+		rv = template_io_append(self, s, self->html && !o->html);
+		Py_DECREF(s);
+		return rv;
 	}
+	s = text_of(other);
+	if (s == NULL)
+		return NULL;
+	rv = template_io_append(self, s, self->html);
+	Py_DECREF(s);
 	return rv;
 }
 
+/* The same as "self += other", as a method.  Compiled PTL can bind it
+   to a local once and call it for each line of output. */
+static PyObject *
+template_io_append_method(TemplateIO_Object *self, PyObject *other)
+{
+	PyObject *rv = template_io_iadd(self, other);
+	if (rv == NULL)
+		return NULL;
+	Py_DECREF(rv);
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
 static PyMethodDef htmltext_methods[] = {
 	{"join", (PyCFunction)htmltext_join, METH_O, ""},
 	{"startswith", (PyCFunction)htmltext_startswith, METH_O, ""},
@@ -693,6 +989,7 @@ static PyMethodDef htmltext_methods[] = {
 	{"lower", (PyCFunction)htmltext_lower, METH_NOARGS, ""},
 	{"upper", (PyCFunction)htmltext_upper, METH_NOARGS, ""},
 	{"capitalize", (PyCFunction)htmltext_capitalize, METH_NOARGS, ""},
+	{"__unicode__", (PyCFunction)htmltext_unicode, METH_NOARGS, ""},
 	{NULL, NULL}
 };
 
@@ -702,7 +999,7 @@ static PyMemberDef htmltext_members[] = {
 };
 
 static PySequenceMethods htmltext_as_sequence = {
-	(inquiry)htmltext_length,	/*sq_length*/
+	(lenfunc)htmltext_length,	/*sq_length*/
 	0,				/*sq_concat*/
 	(intargfunc)htmltext_repeat,	/*sq_repeat*/
 	0,				/*sq_item*/
@@ -782,6 +1079,11 @@ static PyTypeObject htmltext_Type = {
 	0,			/*tp_is_gc*/
 };
 
+static PyMethodDef quote_wrapper_methods[] = {
+	{"__unicode__", (PyCFunction)quote_wrapper_unicode, METH_NOARGS, ""},
+	{NULL, NULL}
+};
+
 static PyNumberMethods quote_wrapper_as_number = {
 	0, /*nb_add*/
 	0, /*nb_subtract*/
@@ -825,6 +1127,18 @@ static PyTypeObject QuoteWrapper_Type = {
 	0,			/*tp_hash*/
 	0,			/*tp_call*/
 	(unaryfunc)quote_wrapper_str,  /*tp_str*/
+	PyObject_GenericGetAttr,/*tp_getattro*/
+	0,			/*tp_setattro*/
+	0,			/*tp_as_buffer*/
+	Py_TPFLAGS_DEFAULT,	/*tp_flags*/
+	0,			/*tp_doc*/
+	0,			/*tp_traverse*/
+	0,			/*tp_clear*/
+	0,			/*tp_richcompare*/
+	0,			/*tp_weaklistoffset*/
+	0,			/*tp_iter*/
+	0,			/*tp_iternext*/
+	quote_wrapper_methods,	/*tp_methods*/
 };
 
 static PyMappingMethods dict_wrapper_as_mapping = {
@@ -880,6 +1194,7 @@ static PyNumberMethods template_io_as_number = {
 
 static PyMethodDef template_io_methods[] = {
 	{"getvalue", (PyCFunction)template_io_getvalue, METH_NOARGS, ""},
+	{"append", (PyCFunction)template_io_append_method, METH_O, ""},
 	{NULL, NULL}
 };
 
@@ -939,7 +1254,7 @@ html_escape(PyObject *self, PyObject *o)
 	}
 	else {
 		PyObject *rv;
-		PyObject *s = PyObject_Str(o);
+		PyObject *s = text_of(o);
 		if (s == NULL)
 			return NULL;
 		rv = escape_string(s);
@@ -952,17 +1267,198 @@ static PyObject *
 py_escape_string(PyObject *self, PyObject *o)
 {
 	PyObject *rv;
-	if (!PyString_Check(o))
+	if (!PyString_Check(o) && !PyUnicode_Check(o))
 		return type_error("string required");
 	rv = escape_string(o);
 	return rv;
 }
 
+/* htmltag() and href() build their output in a TemplateIO buffer */
+
+static PyObject *valueless_attr; /* the ValuelessAttr marker */
+static PyObject *a_tag; /* "a", for href() */
+
+static TemplateIO_Object *
+template_io_alloc(void)
+{
+	/* PyType_GenericAlloc zeroes the object, which leaves an empty
+	   byte buffer */
+	return (TemplateIO_Object *)PyType_GenericAlloc(&TemplateIO_Type, 0);
+}
+
+/* Append ASCII text, which never needs escaping. */
+static int
+template_io_write(TemplateIO_Object *self, const char *s, size_t size)
+{
+	if (self->is_unicode) {
+		size_t i;
+		if (template_io_ureserve(self, size) < 0)
+			return -1;
+		for (i=0; i < size; i++)
+			self->ubuf[self->upos++] = (unsigned char)s[i];
+	}
+	else {
+		if (template_io_reserve(self, size) < 0)
+			return -1;
+		memcpy(self->buf + self->pos, s, size);
+		self->pos += size;
+	}
+	return 0;
+}
+
+/* Append str(o) (or unicode(o), if o is unicode), escaped if 'escape'
+   is true. */
+static int
+template_io_write_text(TemplateIO_Object *self, PyObject *o, int escape)
+{
+	PyObject *s, *rv;
+	if (PyString_CheckExact(o) || PyUnicode_CheckExact(o)) {
+		s = o;
+		Py_INCREF(s);
+	}
+	else {
+		s = text_of(o);
+		if (s == NULL)
+			return -1;
+	}
+	rv = template_io_append(self, s, escape);
+	Py_DECREF(s);
+	if (rv == NULL)
+		return -1;
+	Py_DECREF(rv);
+	return 0;
+}
+
+static int
+write_tag(TemplateIO_Object *out, PyObject *tag, int xml_end,
+	  PyObject *attrs)
+{
+	PyObject *key, *value;
+	Py_ssize_t pos = 0;
+	if (template_io_write(out, "<", 1) < 0 ||
+	    template_io_write_text(out, tag, 0) < 0)
+		return -1;
+	while (PyDict_Next(attrs, &pos, &key, &value)) {
+		if (value == valueless_attr)
+			value = key;
+		if (value == Py_None)
+			continue;
+		if (template_io_write(out, " ", 1) < 0 ||
+		    template_io_write_text(out, key, 0) < 0 ||
+		    template_io_write(out, "=\"", 2) < 0 ||
+		    template_io_write_text(out, value, 1) < 0 ||
+		    template_io_write(out, "\"", 1) < 0)
+			return -1;
+	}
+	if (xml_end)
+		return template_io_write(out, " />", 3);
+	return template_io_write(out, ">", 1);
+}
+
+/* Return the attributes of a tag given the keyword arguments of
+   htmltag() or href(): "xml_end" and "css_class" are stored in
+   *xml_end and *css_class, and css_class becomes the "class"
+   attribute. */
+static PyObject *
+tag_attrs(PyObject *kwargs, PyObject **xml_end, PyObject **css_class)
+{
+	PyObject *attrs, *key, *value;
+	Py_ssize_t pos = 0;
+	attrs = PyDict_New();
+	if (attrs == NULL)
+		return NULL;
+	while (kwargs != NULL && PyDict_Next(kwargs, &pos, &key, &value)) {
+		if (PyString_Check(key) &&
+		    strcmp(PyString_AS_STRING(key), "xml_end") == 0)
+			*xml_end = value;
+		else if (PyString_Check(key) &&
+			 strcmp(PyString_AS_STRING(key), "css_class") == 0)
+			*css_class = value;
+		else if (PyDict_SetItem(attrs, key, value) < 0)
+			goto error;
+	}
+	if (*css_class != Py_None &&
+	    PyDict_SetItemString(attrs, "class", *css_class) < 0)
+		goto error;
+	return attrs;
+error:
+	Py_DECREF(attrs);
+	return NULL;
+}
+
+static PyObject *
+html_tag(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	PyObject *tag, *xml_end = NULL, *css_class = Py_None;
+	PyObject *attrs, *rv = NULL;
+	TemplateIO_Object *out = NULL;
+	int end;
+	if (!PyArg_ParseTuple(args, "O|OO:htmltag", &tag, &xml_end,
+			      &css_class))
+		return NULL;
+	attrs = tag_attrs(kwargs, &xml_end, &css_class);
+	if (attrs == NULL)
+		return NULL;
+	end = xml_end != NULL ? PyObject_IsTrue(xml_end) : 0;
+	if (end < 0)
+		goto done;
+	out = template_io_alloc();
+	if (out == NULL || write_tag(out, tag, end, attrs) < 0)
+		goto done;
+	rv = htmltext_from_string(template_io_str(out));
+done:
+	Py_DECREF(attrs);
+	Py_XDECREF(out);
+	return rv;
+}
+
+static PyObject *
+html_href(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	PyObject *url, *text, *title = Py_None, *attrs, *rv = NULL;
+	PyObject *xml_end = NULL, *css_class = Py_None;
+	TemplateIO_Object *out = NULL;
+	int end;
+	if (!PyArg_ParseTuple(args, "OO|O:href", &url, &text, &title))
+		return NULL;
+	if (kwargs != NULL && PyDict_GetItemString(kwargs, "title") != NULL)
+		title = PyDict_GetItemString(kwargs, "title");
+	attrs = tag_attrs(kwargs, &xml_end, &css_class);
+	if (attrs == NULL)
+		return NULL;
+	if (PyDict_SetItemString(attrs, "href", url) < 0 ||
+	    PyDict_SetItemString(attrs, "title", title) < 0)
+		goto done;
+	end = xml_end != NULL ? PyObject_IsTrue(xml_end) : 0;
+	if (end < 0)
+		goto done;
+	out = template_io_alloc();
+	if (out == NULL || write_tag(out, a_tag, end, attrs) < 0)
+		goto done;
+	if (htmltextObject_Check(text)) {
+		if (template_io_write_text(out, htmltext_STR(text), 0) < 0)
+			goto done;
+	}
+	else if (template_io_write_text(out, text, 1) < 0)
+		goto done;
+	if (template_io_write(out, "</a>", 4) < 0)
+		goto done;
+	rv = htmltext_from_string(template_io_str(out));
+done:
+	Py_DECREF(attrs);
+	Py_XDECREF(out);
+	return rv;
+}
+
 /* List of functions defined in the module */
 
 static PyMethodDef htmltext_module_methods[] = {
 	{"htmlescape",		(PyCFunction)html_escape, METH_O},
 	{"_escape_string",	(PyCFunction)py_escape_string, METH_O},
+	{"htmltag",		(PyCFunction)html_tag,
+	 METH_VARARGS | METH_KEYWORDS},
+	{"href",		(PyCFunction)html_href,
+	 METH_VARARGS | METH_KEYWORDS},
 	{NULL,			NULL}
 };
 
@@ -973,10 +1469,21 @@ init_c_htmltext(void)
 {
 	PyObject *m;
 
+	escape_extra['&'] = 4;
+	escape_entity['&'] = "&amp;";
+	escape_extra['<'] = 3;
+	escape_entity['<'] = "&lt;";
+	escape_extra['>'] = 3;
+	escape_entity['>'] = "&gt;";
+	escape_extra['"'] = 5;
+	escape_entity['"'] = "&quot;";
+
 	/* Initialize the type of the new type object here; doing it here
 	 * is required for portability to Windows without requiring C++. */
 	htmltext_Type.ob_type = &PyType_Type;
 	QuoteWrapper_Type.ob_type = &PyType_Type;
+	if (PyType_Ready(&QuoteWrapper_Type) < 0)
+		return;
 	TemplateIO_Type.ob_type = &PyType_Type;
 
 	/* Create the module and add the functions */
@@ -988,4 +1495,11 @@ init_c_htmltext(void)
 	Py_INCREF((PyObject *)&TemplateIO_Type);
 	PyModule_AddObject(m, "htmltext", (PyObject *)&htmltext_Type);
 	PyModule_AddObject(m, "TemplateIO", (PyObject *)&TemplateIO_Type);
+
+	valueless_attr = Py_BuildValue("[s]", "valueless_attr");
+	if (valueless_attr == NULL)
+		return;
+	Py_INCREF(valueless_attr);
+	PyModule_AddObject(m, "ValuelessAttr", valueless_attr);
+	a_tag = PyString_InternFromString("a");
 }
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from cStringIO import StringIO
+
+from base import BaseTestCase
+
+from quixote import ptl_compile
+from quixote.cache import MemoryStore, FileStore, FragmentCache, \
+     ResponseCache, cached, invalidate
+from quixote.html import htmltext, TemplateIO
+from quixote.http_request import HTTPRequest
+from quixote.publish import Publisher
+
+
+TEMPLATE = '''
+from quixote.cache import cached
+
+calls = []
+
+@cached(tags=['items'], cache=cache)
+def item [html] (name):
+    calls.append(name)
+    '<li>'
+    name
+    '</li>'
+
+@cached(key=lambda name, request=None: name, cache=cache)
+def label [plain] (name, request=None):
+    calls.append(name)
+    '<' + name + '>'
+'''
+
+
+class MemoryStoreTestCase(BaseTestCase):
+
+    def test_lru(self):
+        store = MemoryStore(2)
+        store.set('a', 1)
+        store.set('b', 2)
+        self.assertEqual(store.get('a'), 1)
+        store.set('c', 3)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get('b'), None)
+        self.assertEqual(store.get('a'), 1)
+        store.delete('a')
+        self.assertEqual(store.get('a'), None)
+
+
+class FragmentCacheTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.cache = FragmentCache(10)
+
+    def test_types(self):
+        cache = self.cache
+        cache.set('html', htmltext(u'<b>\xe9</b>'))
+        cache.set('plain', '<b>')
+        value = cache.get('html')
+        self.assertTrue(isinstance(value, htmltext))
+        self.assertEqual(value.s, u'<b>\xe9</b>')
+        self.assertEqual(type(cache.get('plain')), str)
+        # a cached plain string is still escaped in an html template
+        r = TemplateIO(html=1)
+        r += cache.get('plain')
+        r += cache.get('html')
+        self.assertEqual(r.getvalue().s, u'&lt;b&gt;<b>\xe9</b>')
+        self.assertRaises(TypeError, cache.set, 'x', 1)
+
+    def test_ttl(self):
+        self.cache.set('a', 'x', ttl=0.01)
+        self.cache.set('b', 'y')
+        self.assertEqual(self.cache.get('a'), 'x')
+        time.sleep(0.02)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 'y')
+
+    def test_tags(self):
+        cache = self.cache
+        cache.set('a', 'x', tags=['t'])
+        cache.set('b', 'y', tags=['u'])
+        cache.invalidate('t')
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 'y')
+        cache.set('a', 'z', tags=['t'])
+        self.assertEqual(cache.get('a'), 'z')
+
+
+class FileStoreTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shared(self):
+        one = FragmentCache(10, FileStore(self.dir))
+        two = FragmentCache(10, FileStore(self.dir))
+        one.set('a', htmltext('<b>'), tags=['t'])
+        value = two.get('a')
+        self.assertTrue(isinstance(value, htmltext))
+        self.assertEqual(str(value), '<b>')
+        # invalidating in one process reaches entries held by the other
+        one.invalidate('t')
+        self.assertEqual(two.get('a'), None)
+        self.assertEqual(one.get('a'), None)
+
+    def files(self):
+        names = os.listdir(self.dir)
+        names.sort()
+        return [name.split('-')[0] for name in names]
+
+    def test_stale_removed(self):
+        cache = FragmentCache(10, FileStore(self.dir))
+        cache.set('a', 'x', ttl=0.01)
+        cache.set('b', 'y', tags=['t'])
+        self.assertEqual(self.files(), ['item', 'item'])
+        time.sleep(0.02)
+        cache.invalidate('t')
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(self.files(), ['tag'])
+
+    def test_prune(self):
+        store = FileStore(self.dir)
+        store.set('a', 'x')
+        store.invalidate('t')
+        open(os.path.join(self.dir, 'left.tmp'), 'w').close()
+        self.assertEqual(store.prune(60), 0)
+        self.assertEqual(len(self.files()), 3)
+        past = time.time() - 120
+        for name in os.listdir(self.dir):
+            os.utime(os.path.join(self.dir, name), (past, past))
+        self.assertEqual(store.prune(60), 2)
+        self.assertEqual(self.files(), ['tag'])
+        self.assertEqual(store.get('a'), None)
+
+
+class DecoratorTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.cache = FragmentCache(10)
+        code = ptl_compile.compile_template(StringIO(TEMPLATE), '<test>')
+        self.namespace = {'cache': self.cache}
+        exec code in self.namespace
+
+    def test_template(self):
+        item = self.namespace['item']
+        calls = self.namespace['calls']
+        self.assertEqual(item.__name__, 'item')
+        first = item('a&b')
+        self.assertTrue(isinstance(first, htmltext))
+        self.assertEqual(str(first), '<li>a&amp;b</li>')
+        self.assertEqual(str(item('a&b')), str(first))
+        self.assertTrue(isinstance(item('a&b'), htmltext))
+        item('c')
+        self.assertEqual(calls, ['a&b', 'c'])
+        invalidate('items', self.cache)
+        item('c')
+        self.assertEqual(calls, ['a&b', 'c', 'c'])
+
+    def test_key(self):
+        label = self.namespace['label']
+        calls = self.namespace['calls']
+        self.assertEqual(label('x', request=1), '<x>')
+        self.assertEqual(label('x', request=2), '<x>')
+        self.assertEqual(calls, ['x'])
+
+    def test_version(self):
+        calls = []
+        versions = ['1']
+        def render(name):
+            calls.append(name)
+            return name
+        render = cached(version=lambda: versions[0],
+                        cache=self.cache)(render)
+        render('a')
+        render('a')
+        versions[0] = '2'
+        render('a')
+        self.assertEqual(calls, ['a', 'a'])
+
+    def test_invalidated_while_rendering(self):
+        calls = []
+        def render(name):
+            calls.append(name)
+            invalidate('t', self.cache)
+            return name
+        render = cached(tags=['t'], cache=self.cache)(render)
+        render('a')
+        render('a')
+        self.assertEqual(calls, ['a', 'a'])
+
+    def test_default_key(self):
+        render = cached(cache=self.cache)(lambda *args, **kwargs: 'x')
+        self.assertEqual(render('a', 1, (2.0, None), b=u'c'), 'x')
+        self.assertRaises(TypeError, render, object())
+        self.assertRaises(TypeError, render, 'a', request=HTTPRequest(
+            StringIO(), {}))
+        self.assertRaises(TypeError, render, ['a'])
+
+    def test_no_key(self):
+        calls = []
+        def render(name):
+            calls.append(name)
+            return name
+        render = cached(key=lambda name: None, cache=self.cache)(render)
+        render('a')
+        render('a')
+        self.assertEqual(calls, ['a', 'a'])
+
+
+class UITest(object):
+    _q_exports = ['', 'lang', 'private', 'cookie', 'slow']
+
+    def __init__(self):
+        self.calls = 0
+
+    def _q_index(self, request):
+        self.calls += 1
+        request.response.set_cache_policy(60)
+        request.response.set_header('X-Calls', str(self.calls))
+        return 'x' * 300
+
+    def lang(self, request):
+        self.calls += 1
+        request.response.set_cache_policy(60, vary_headers=['Accept-Language'])
+        return request.get_header('Accept-Language')
+
+    def private(self, request):
+        self.calls += 1
+        return 'private'
+
+    def cookie(self, request):
+        self.calls += 1
+        request.response.set_cache_policy(60)
+        request.response.set_cookie('a', 'b')
+        return 'cookie'
+
+    def slow(self, request):
+        # cacheable the first time only
+        self.calls += 1
+        request.response.set_cache_policy(0.01)
+        if self.calls > 1:
+            time.sleep(0.2)
+            request.response.set_cookie('a', 'b')
+        return 'slow'
+
+
+class ResponseCacheTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.ui = UITest()
+        self.pub = Publisher(self.ui)
+
+    def publish(self, path, **headers):
+        env = {'SCRIPT_NAME': '', 'PATH_INFO': path, 'REQUEST_METHOD': 'GET',
+               'SERVER_NAME': 'example.com', 'SERVER_PROTOCOL': 'HTTP/1.0'}
+        env.update(headers)
+        out = StringIO()
+        self.pub.error_log = StringIO()
+        self.pub.publish(StringIO(), out, StringIO(), env)
+        return out.getvalue().split('\r\n\r\n', 1)
+
+    def test_hit(self):
+        head, body = self.publish('/')
+        self.assertEqual(self.publish('/'), [head, body])
+        self.assertEqual(self.ui.calls, 1)
+        self.assertTrue('X-Calls: 1\r\n' in head)
+        self.publish('/', REQUEST_METHOD='POST')
+        self.assertEqual(self.ui.calls, 2)
+
+    def test_vary(self):
+        self.assertEqual(self.publish('/lang', HTTP_ACCEPT_LANGUAGE='fr')[1],
+                         'fr')
+        self.assertEqual(self.publish('/lang', HTTP_ACCEPT_LANGUAGE='de')[1],
+                         'de')
+        self.assertEqual(self.publish('/lang', HTTP_ACCEPT_LANGUAGE='fr')[1],
+                         'fr')
+        self.assertEqual(self.ui.calls, 2)
+
+    def test_not_cached(self):
+        self.publish('/private')
+        self.publish('/private')
+        self.publish('/cookie')
+        self.publish('/cookie')
+        self.assertEqual(self.ui.calls, 4)
+
+    def test_disabled(self):
+        self.pub.configure(RESPONSE_CACHE_SIZE=0)
+        self.publish('/')
+        self.publish('/')
+        self.assertEqual(self.ui.calls, 2)
+
+    def test_gzip(self):
+        self.pub.configure(COMPRESS_PAGES=1)
+        self.publish('/')
+        head, body = self.publish('/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(self.ui.calls, 1)
+        self.assertTrue('Content-Encoding: gzip\r\n' in head)
+        self.assertTrue(len(body) < 300)
+        head, body = self.publish('/')
+        self.assertFalse('Content-Encoding' in head)
+        self.assertEqual(body, 'x' * 300)
+
+    def test_stampede(self):
+        cache = ResponseCache()
+        env = {'SCRIPT_NAME': '', 'PATH_INFO': '/', 'REQUEST_METHOD': 'GET'}
+        request = HTTPRequest(StringIO(), env)
+        request.response.set_cache_policy(60)
+        cache.save(request, 'first')
+        cache._delete(cache._key(request, cache._url_key(request),
+                                 request.response.cache_policy))
+        entry, key = cache.lookup(request)
+        self.assertEqual(entry, None)
+        self.assertNotEqual(key, None)
+        results = []
+        def wait():
+            results.append(cache.lookup(HTTPRequest(StringIO(), env)))
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(results, [])
+        cache.save(request, 'second', key=key)
+        cache.release(key)
+        thread.join()
+        entry, key = results[0]
+        self.assertEqual(key, None)
+        self.assertEqual(entry[5], 'second')
+
+    def test_not_stored_concurrent(self):
+        # Requests waiting for a response that then isn't stored render
+        # their own instead of taking turns.
+        self.publish('/slow')
+        time.sleep(0.02)
+        threads = [threading.Thread(target=self.publish, args=('/slow',))
+                   for i in range(5)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.ui.calls, 6)
+        self.assertTrue(time.time() - start < 0.6)
+        cache = self.pub.get_response_cache()
+        self.assertEqual(cache._filling, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import sys
+import time
+import unittest
+
+from base import BaseTestCase
+
+from quixote.errormail import ErrorMailer, fingerprint
+
+
+def fail(n):
+    if n:
+        raise ValueError(n)
+    raise KeyError(n)
+
+def get_fingerprint(n):
+    try:
+        fail(n)
+    except:
+        exc_type, exc_value, tb = sys.exc_info()
+        return fingerprint(exc_type, tb)
+
+
+class ErrorMailerTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.sent = []
+
+    def send(self, msg, summary):
+        self.sent.append((msg, summary))
+
+    def wait_for(self, n):
+        for i in range(300):
+            if len(self.sent) >= n:
+                break
+            time.sleep(0.01)
+
+    def test_fingerprint(self):
+        self.assertEqual(get_fingerprint(1), get_fingerprint(2))
+        self.assertNotEqual(get_fingerprint(1), get_fingerprint(0))
+
+    def test_repeats_collapsed(self):
+        mailer = ErrorMailer(self.send, window=0.3, limit=10)
+        mailer.report('a', 'traceback', 'ValueError')
+        self.wait_for(1)
+        self.assertEqual(self.sent, [('traceback', 'ValueError')])
+        for i in range(3):
+            mailer.report('a', 'traceback', 'ValueError')
+        self.wait_for(2)
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self.sent[1][1], 'ValueError [3 times]')
+        self.assertTrue(self.sent[1][0].startswith(
+            'This error occurred 3 times'))
+
+    def test_rate_limit(self):
+        mailer = ErrorMailer(self.send, window=60, limit=2)
+        for key in 'abcd':
+            mailer.report(key, 'traceback', key)
+        self.wait_for(2)
+        time.sleep(0.05)
+        self.assertEqual(len(self.sent), 2)
+        mailer.flush()
+        self.assertEqual(len(self.sent), 2)
+
+    def test_send_failure_logged(self):
+        logged = []
+        def send(msg, summary):
+            raise IOError('no SMTP server')
+        mailer = ErrorMailer(send, logged.append, window=60)
+        mailer.report('a', 'traceback', 'ValueError')
+        mailer.flush()
+        for i in range(300):
+            if logged:
+                break
+            time.sleep(0.01)
+        self.assertTrue('no SMTP server' in logged[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
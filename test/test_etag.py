@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import unittest
+from cStringIO import StringIO
+from rfc822 import formatdate
+
+from base import BaseTestCase
+
+from quixote.http_request import HTTPRequest
+from quixote.publish import Publisher
+
+
+class UITest(object):
+    _q_exports = ['', 'versioned', 'dated', 'cached']
+
+    def __init__(self):
+        self.calls = 0
+
+    def _q_index(self, request):
+        self.calls += 1
+        return 'x' * 300
+
+    def cached(self, request):
+        self.calls += 1
+        request.response.set_cache_policy(60)
+        return 'z' * 300
+
+    def versioned(self, request):
+        if request.not_modified(etag='v1'):
+            return ''
+        self.calls += 1
+        return 'y' * 300
+
+    def dated(self, request):
+        if request.not_modified(last_modified=1000000000):
+            return ''
+        self.calls += 1
+        return 'dated'
+
+
+class ETagTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.ui = UITest()
+        self.pub = Publisher(self.ui)
+        self.pub.configure(GENERATE_ETAGS=1)
+
+    def publish(self, path, **headers):
+        env = {'SCRIPT_NAME': '', 'PATH_INFO': path, 'REQUEST_METHOD': 'GET',
+               'SERVER_NAME': 'example.com', 'SERVER_PROTOCOL': 'HTTP/1.1'}
+        env.update(headers)
+        out = StringIO()
+        self.pub.error_log = StringIO()
+        self.pub.publish(StringIO(), out, StringIO(), env)
+        head, body = out.getvalue().split('\r\n\r\n', 1)
+        headers = {}
+        for line in head.split('\r\n'):
+            name, value = line.split(': ', 1)
+            headers[name] = value
+        return headers, body
+
+    def test_generated(self):
+        headers, body = self.publish('/')
+        etag = headers['Etag']
+        self.assertEqual(headers['Status'], '200 OK')
+        self.assertEqual(body, 'x' * 300)
+        self.assertEqual(self.publish('/')[0]['Etag'], etag)
+        headers, body = self.publish('/', HTTP_IF_NONE_MATCH='"a", ' + etag)
+        self.assertEqual(headers['Status'], '304 Not Modified')
+        self.assertEqual(body, '')
+        self.assertFalse(headers.has_key('Content-Length'))
+        headers, body = self.publish('/', HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(body, 'x' * 300)
+        headers, body = self.publish('/', REQUEST_METHOD='POST',
+                                     HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(headers['Status'], '200 OK')
+
+    def test_disabled(self):
+        self.pub.configure(GENERATE_ETAGS=0)
+        self.assertFalse(self.publish('/')[0].has_key('Etag'))
+
+    def test_gzip(self):
+        self.pub.configure(COMPRESS_PAGES=1)
+        plain_etag = self.publish('/')[0]['Etag']
+        headers, body = self.publish('/', HTTP_ACCEPT_ENCODING='gzip')
+        etag = headers['Etag']
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(etag, plain_etag[:-1] + '-gzip"')
+        # the compressed body is kept and sent again as is
+        self.assertEqual(self.publish('/', HTTP_ACCEPT_ENCODING='gzip')[1],
+                         body)
+        self.assertEqual(len(self.pub._compressed), 1)
+        headers, body = self.publish('/', HTTP_ACCEPT_ENCODING='gzip',
+                                     HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(headers['Status'], '304 Not Modified')
+        headers, body = self.publish('/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(headers['Status'], '200 OK')
+
+    def test_response_cache(self):
+        self.pub.configure(COMPRESS_PAGES=1)
+        miss = self.publish('/cached', HTTP_ACCEPT_ENCODING='gzip')[0]
+        hit = self.publish('/cached', HTTP_ACCEPT_ENCODING='gzip')[0]
+        self.assertEqual(self.ui.calls, 1)
+        self.assertEqual(hit['Content-Encoding'], 'gzip')
+        self.assertEqual(hit['Etag'], miss['Etag'])
+        plain = self.publish('/cached')[0]
+        self.assertEqual(plain['Etag'][:-1] + '-gzip"', miss['Etag'])
+        headers, body = self.publish('/cached', HTTP_ACCEPT_ENCODING='gzip',
+                                     HTTP_IF_NONE_MATCH=miss['Etag'])
+        self.assertEqual(headers['Status'], '304 Not Modified')
+        self.assertEqual(body, '')
+        self.assertEqual(self.ui.calls, 1)
+
+    def test_not_modified(self):
+        headers, body = self.publish('/versioned')
+        self.assertEqual(headers['Etag'], '"v1"')
+        headers, body = self.publish('/versioned', HTTP_IF_NONE_MATCH='"v1"')
+        self.assertEqual(headers['Status'], '304 Not Modified')
+        self.assertEqual(body, '')
+        self.assertEqual(self.ui.calls, 1)
+
+    def test_last_modified(self):
+        headers, body = self.publish('/dated')
+        self.assertEqual(headers['Last-Modified'], formatdate(1000000000))
+        headers, body = self.publish(
+            '/dated', HTTP_IF_MODIFIED_SINCE=headers['Last-Modified'])
+        self.assertEqual(headers['Status'], '304 Not Modified')
+        headers, body = self.publish(
+            '/dated', HTTP_IF_MODIFIED_SINCE=formatdate(999999999))
+        self.assertEqual(body, 'dated')
+        self.assertEqual(self.ui.calls, 2)
+
+
+class ETagMatchTestCase(BaseTestCase):
+
+    def request(self, header):
+        return HTTPRequest(StringIO(), {'HTTP_IF_NONE_MATCH': header})
+
+    def test_matches(self):
+        self.assertTrue(self.request('"a", "b"').etag_matches('"b"'))
+        self.assertTrue(self.request('W/"a"').etag_matches('"a"'))
+        self.assertTrue(self.request('*').etag_matches('"a"'))
+        self.assertFalse(self.request('"ab"').etag_matches('"a"'))
+        self.assertFalse(HTTPRequest(StringIO(), {}).etag_matches('"a"'))
+
+
+if __name__ == '__main__':
+    unittest.main()
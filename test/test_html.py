@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import unittest
+
+from base import BaseTestCase
+
+from quixote import _py_htmltext
+
+
+class EscapeTestCase(BaseTestCase):
+
+    module = _py_htmltext
+
+    def test_escape_string(self):
+        escape = self.module._escape_string
+        self.assertEqual(escape('a&b<c>d"e'), 'a&amp;b&lt;c&gt;d&quot;e')
+        self.assertEqual(escape('&amp;'), '&amp;amp;')
+        long_text = 'x' * 300 + '<&>'
+        self.assertEqual(escape(long_text), 'x' * 300 + '&lt;&amp;&gt;')
+        self.assertRaises(TypeError, escape, 1)
+
+    def test_unchanged(self):
+        escape = self.module._escape_string
+        for s in ['', 'plain', 'y' * 1000]:
+            self.assertTrue(escape(s) is s)
+
+    def test_htmlescape(self):
+        htmlescape = self.module.htmlescape
+        self.assertEqual(str(htmlescape('<a>')), '&lt;a&gt;')
+        self.assertEqual(str(htmlescape(1)), '1')
+        value = self.module.htmltext('<b>')
+        self.assertTrue(htmlescape(value) is value)
+
+
+class FormatTestCase(BaseTestCase):
+
+    module = _py_htmltext
+
+    def setUp(self):
+        self.htmltext = self.module.htmltext
+
+    def format(self, fmt, args):
+        return str(self.htmltext(fmt) % args)
+
+    def test_args(self):
+        htmltext = self.htmltext
+        self.assertEqual(self.format('<%s>', 'a&b'), '<a&amp;b>')
+        self.assertEqual(self.format('%s %d %.1f', (htmltext('<i>'), 2, 1.5)),
+                         '<i> 2 1.5')
+        self.assertEqual(self.format('%s|%s', ('<', ['<'])),
+                         "&lt;|['&lt;']")
+        self.assertEqual(self.format('%(a)s %(b)s', {'a': '<', 'b': 1}),
+                         '&lt; 1')
+        self.assertEqual(self.format('%s%%', 5), '5%')
+
+    def test_repr(self):
+        # the quotes repr() adds must be escaped too
+        self.assertEqual(self.format('%r', ("a'b",)), '&quot;a\'b&quot;')
+        self.assertEqual(self.format('%s %r', ('"', '<')),
+                         "&quot; '&lt;'")
+        self.assertEqual(self.format('%(a)r', {'a': "'"}),
+                         '&quot;\'&quot;')
+
+    def test_cache(self):
+        if self.module is not _py_htmltext:
+            return
+        self.module._format_cache.clear()
+        self.format('<%s %s>', ('a', 'b'))
+        self.assertEqual(self.module._format_cache['<%s %s>'], (0, 0, 0))
+        self.format('%(x)r', {'x': 1})
+        self.assertEqual(self.module._format_cache['%(x)r'], (1, 1, 1))
+
+
+class TemplateIOTestCase(BaseTestCase):
+
+    module = _py_htmltext
+
+    def setUp(self):
+        self.htmltext = self.module.htmltext
+        self.TemplateIO = self.module.TemplateIO
+
+    def test_plain(self):
+        r = self.TemplateIO()
+        r += 'a<'
+        r += None
+        r += 1
+        r += self.htmltext('&')
+        self.assertEqual(r.getvalue(), 'a<1&')
+        self.assertEqual(type(r.getvalue()), str)
+
+    def test_html(self):
+        r = self.TemplateIO(html=1)
+        r += self.htmltext('<b>')
+        r += 'a&b "c"'
+        r += 1.5
+        r += self.htmltext('</b>')
+        value = r.getvalue()
+        self.assertTrue(isinstance(value, self.htmltext))
+        self.assertEqual(str(value), '<b>a&amp;b &quot;c&quot;1.5</b>')
+        # getvalue() can be called again, and more output added
+        self.assertEqual(str(r.getvalue()), str(value))
+        r += '>'
+        self.assertEqual(str(r), str(value) + '&gt;')
+
+    def test_nested(self):
+        plain = self.TemplateIO()
+        plain += '<i>'
+        html = self.TemplateIO(html=1)
+        html += '<'
+        outer = self.TemplateIO(html=1)
+        outer += plain
+        outer += html
+        self.assertEqual(str(outer.getvalue()), '&lt;i&gt;&lt;')
+
+    def test_append(self):
+        r = self.TemplateIO(html=1)
+        self.assertEqual(r.append('<'), None)
+        r.append(None)
+        r.append(self.htmltext('<b>'))
+        r += 1
+        self.assertEqual(str(r.getvalue()), '&lt;<b>1')
+
+    def test_size_hint(self):
+        r = self.TemplateIO(html=1, size=10)
+        for i in range(1000):
+            r += '<%d>' % i
+        value = str(r.getvalue())
+        self.assertTrue(value.startswith('&lt;0&gt;&lt;1&gt;'))
+        self.assertTrue(value.endswith('&lt;999&gt;'))
+
+
+class Text(object):
+
+    def __unicode__(self):
+        return u'\xe9<'
+
+
+class UnicodeTestCase(BaseTestCase):
+
+    module = _py_htmltext
+
+    def setUp(self):
+        self.htmltext = self.module.htmltext
+        self.htmlescape = self.module.htmlescape
+
+    def assertText(self, value, expected):
+        self.assertTrue(isinstance(value, self.htmltext))
+        self.assertEqual(type(value.s), unicode)
+        self.assertEqual(value.s, expected)
+
+    def test_escape(self):
+        self.assertText(self.htmlescape(u'<\u4e2d>'), u'&lt;\u4e2d&gt;')
+        self.assertEqual(self.module._escape_string(u'"\xe9"'),
+                         u'&quot;\xe9&quot;')
+        self.assertText(self.htmltext(u'\xe9'), u'\xe9')
+        self.assertEqual(unicode(self.htmltext(u'\xe9')), u'\xe9')
+        self.assertEqual(len(self.htmltext(u'\xe9')), 1)
+
+    def test_format(self):
+        htmltext = self.htmltext
+        self.assertText(htmltext(u'<p>%s</p>') % u'\xe9&', u'<p>\xe9&amp;</p>')
+        self.assertText(htmltext('<p>%s</p>') % u'\xe9', u'<p>\xe9</p>')
+        self.assertText(htmltext('%s %s') % (htmltext(u'<\xe9>'), 1),
+                        u'<\xe9> 1')
+        self.assertText(htmltext('%(a)s') % {'a': u'\xe9<'}, u'\xe9&lt;')
+        self.assertText(htmltext(u'%s') % Text(), u'\xe9&lt;')
+        # %r makes the other arguments go through the repr-quoting path
+        self.assertText(htmltext('%s %r') % (htmltext(u'\xe9'), 1),
+                        u'\xe9 1')
+        self.assertText(htmltext('%(a)s %(b)r') % {'a': htmltext(u'<\xe9>'),
+                                                   'b': 'x'},
+                        u"<\xe9> 'x'")
+
+    def test_concat(self):
+        htmltext = self.htmltext
+        self.assertText(htmltext('<b>') + u'\xe9<', u'<b>\xe9&lt;')
+        self.assertText(u'\xe9<' + htmltext('<b>'), u'\xe9&lt;<b>')
+        self.assertText(htmltext(u', ').join(['a&', u'\xe9']), u'a&amp;, \xe9')
+        self.assertText(htmltext(', ').join([htmltext(u'\xe9'), 'a']),
+                        u'\xe9, a')
+        self.assertTrue(htmltext(u'\xe9') == u'\xe9')
+
+    def test_template_io(self):
+        r = self.module.TemplateIO(html=1)
+        r += 'a<'
+        r += u'\xe9'
+        r += self.htmltext(u'<b>')
+        r += '>'
+        self.assertText(r.getvalue(), u'a&lt;\xe9<b>&gt;')
+        r = self.module.TemplateIO()
+        r += 'a'
+        r += u'\u4e2d<'
+        self.assertEqual(r.getvalue(), u'a\u4e2d<')
+        r = self.module.TemplateIO()
+        r += '\xe9'
+        try:
+            r += u'x'
+            r.getvalue()
+        except UnicodeDecodeError:
+            pass
+        else:
+            self.fail('expected UnicodeDecodeError')
+
+
+class HtmltagTestCase(BaseTestCase):
+
+    module = _py_htmltext
+
+    def setUp(self):
+        self.htmltag = self.module.htmltag
+        self.htmltext = self.module.htmltext
+
+    def assertTag(self, value, expected):
+        self.assertTrue(isinstance(value, self.htmltext))
+        self.assertEqual(str(value), expected)
+
+    def test_htmltag(self):
+        htmltag = self.htmltag
+        self.assertTag(htmltag('br', xml_end=1), '<br />')
+        self.assertTag(htmltag('input', 0, None, value='a"<b>'),
+                       '<input value="a&quot;&lt;b&gt;">')
+        self.assertTag(htmltag('td', css_class='x&y', width=None),
+                       '<td class="x&amp;y">')
+        self.assertTag(htmltag('input', checked=self.module.ValuelessAttr),
+                       '<input checked="checked">')
+        self.assertTag(htmltag('p', id=self.htmltext('<a>'), size=3),
+                       str(htmltag('p', size=3, id='<a>')))
+        value = htmltag('p', title=u'é<')
+        self.assertEqual(unicode(value), u'<p title="é&lt;">')
+
+    def test_href(self):
+        href = self.module.href
+        self.assertTag(href('/a?b=1&c=2', 'x<y'),
+                       '<a href="/a?b=1&amp;c=2">x&lt;y</a>')
+        self.assertTag(href('/', self.htmltext('<b>x</b>'), title='t'),
+                       str(self.htmltag('a', href='/', title='t')) +
+                       '<b>x</b></a>')
+        value = href('/', 'x', 'Title', css_class='c')
+        self.assertTrue('title="Title"' in str(value))
+        self.assertTrue('class="c"' in str(value))
+        self.assertEqual(unicode(href('/', u'中')), u'<a href="/">中</a>')
+
+    def test_href_keywords(self):
+        href = self.module.href
+        self.assertTag(href('/', 'x', css_class='k'),
+                       str(_py_htmltext.href('/', 'x', css_class='k')))
+        self.assertTrue('class="k"' in str(href('/', 'x', css_class='k')))
+        self.assertTag(href('/', 'x', xml_end=1),
+                       '<a href="/" />x</a>')
+        self.assertTag(href('/', 'x', xml_end=1),
+                       str(_py_htmltext.href('/', 'x', xml_end=1)))
+
+
+try:
+    from quixote import _c_htmltext
+except ImportError:
+    _c_htmltext = None
+
+if _c_htmltext:
+    class CEscapeTestCase(EscapeTestCase):
+        module = _c_htmltext
+
+    class CFormatTestCase(FormatTestCase):
+        module = _c_htmltext
+
+    class CTemplateIOTestCase(TemplateIOTestCase):
+        module = _c_htmltext
+
+    class CUnicodeTestCase(UnicodeTestCase):
+        module = _c_htmltext
+
+    class CHtmltagTestCase(HtmltagTestCase):
+        module = _c_htmltext
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import time
+import unittest
+
+from rfc822 import formatdate
+
+from base import BaseTestCase
+
+from quixote.html import htmltext
+from quixote.http_response import HTTPResponse, Stream, FLUSH
+
+
+class CountingFile(object):
+
+    def __init__(self):
+        self.writes = []
+        self.flushes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        self.flushes.append(len(self.writes))
+
+    def getvalue(self):
+        return "".join(self.writes)
+
+
+class GenerateHeadersTestCase(BaseTestCase):
+
+    def test_headers(self):
+        response = HTTPResponse()
+        response.set_body('hello')
+        response.set_header('x-frame-OPTIONS', 'DENY')
+        response.cache = 10
+        headers = response.generate_headers()
+        self.assertEqual(headers[0], ('Status', '200 OK'))
+        names = dict(headers)
+        self.assertEqual(names['Content-Length'], 5)
+        self.assertEqual(names['X-Frame-Options'], 'DENY')
+        self.assertEqual(names['Date'][-3:], 'GMT')
+        self.assertNotEqual(names['Date'], names['Expires'])
+
+    def test_custom_reason(self):
+        response = HTTPResponse()
+        response.set_status(200, 'Fine')
+        self.assertEqual(response.generate_headers()[0], ('Status', '200 Fine'))
+        response.set_status(499)
+        self.assertEqual(response.generate_headers()[0],
+                         ('Status', '499 Bad Request'))
+
+    def test_charset(self):
+        response = HTTPResponse()
+        response.charset = 'utf-8'
+        response.set_body(htmltext(u'<p>\u4e2d</p>'))
+        self.assertEqual(response.body, '<p>\xe4\xb8\xad</p>')
+        self.assertEqual(response.get_header('content-length'), 10)
+        self.assertEqual(response.get_header('content-type'),
+                         'text/html; charset=utf-8')
+        response = HTTPResponse(body=u'\xe9')
+        self.assertEqual(response.body, '\xe9')
+
+    def test_content_type_charset(self):
+        response = HTTPResponse()
+        response.set_header('content-type', 'text/html; charset=UTF-8')
+        response.set_body(u'\u4e2d')
+        self.assertEqual(response.body, '\xe4\xb8\xad')
+        # HTML gets character references for what the charset lacks
+        response = HTTPResponse()
+        response.set_body(u'<p>\u4e2d</p>')
+        self.assertEqual(response.body, '<p>&#20013;</p>')
+        response = HTTPResponse()
+        response.set_header('content-type', 'text/plain')
+        self.assertRaises(UnicodeEncodeError, response.set_body, u'\u4e2d')
+
+    def test_header_block(self):
+        response = HTTPResponse()
+        response.set_body('hello')
+        response.set_header('Date', formatdate(0))
+        response.cache = None
+        block = response.generate_header_block()
+        self.assertTrue(block.startswith('Status: 200 OK\r\n'))
+        self.assertTrue(block.endswith('\r\n\r\n'))
+        lines = block.split('\r\n')[1:-2]
+        lines.sort()
+        self.assertEqual(lines,
+                         ['Content-Length: 5',
+                          'Content-Type: text/html; charset=iso-8859-1',
+                          'Date: Thu, 01 Jan 1970 00:00:00 GMT'])
+
+    def test_header_names_bounded(self):
+        from quixote import http_response
+        for i in range(http_response._MAX_HEADER_NAMES + 10):
+            response = HTTPResponse()
+            response.set_header('x-item-%d' % i, 'a')
+            names = dict(response.generate_headers())
+            self.assertEqual(names['X-Item-%d' % i], 'a')
+        self.assertEqual(len(http_response._header_names),
+                         http_response._MAX_HEADER_NAMES)
+
+
+class WriteTestCase(BaseTestCase):
+
+    def test_small_body_single_write(self):
+        response = HTTPResponse(body='hello')
+        out = CountingFile()
+        response.write(out)
+        self.assertEqual(len(out.writes), 1)
+        self.assertTrue(out.getvalue().endswith('\r\n\r\nhello'))
+
+    def test_large_body_not_copied(self):
+        body = 'x' * 100000
+        response = HTTPResponse(body=body)
+        out = CountingFile()
+        response.write(out)
+        self.assertEqual(len(out.writes), 2)
+        self.assertTrue(out.writes[1] is response.body)
+
+    def test_stream_coalesced(self):
+        response = HTTPResponse()
+        response.buffer_size = 100
+        response.set_body(Stream(['x' * 30] * 10))
+        out = CountingFile()
+        response.write(out)
+        self.assertTrue(len(out.writes) < 5)
+        self.assertTrue(out.getvalue().endswith('\r\n\r\n' + 'x' * 300))
+
+    def test_stream_unbuffered(self):
+        response = HTTPResponse()
+        response.buffered = 0
+        response.set_body(Stream(['a', 'b', 'c']))
+        out = CountingFile()
+        response.write(out)
+        self.assertEqual(out.writes[1:], ['a', 'b', 'c'])
+
+
+class NPHTestCase(BaseTestCase):
+
+    def test_status_line(self):
+        response = HTTPResponse(body='hello')
+        out = CountingFile()
+        response.write(out, 'HTTP/1.1')
+        data = out.getvalue()
+        self.assertTrue(data.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertFalse('Status:' in data)
+        self.assertTrue('Content-Length: 5\r\n' in data)
+        self.assertTrue(data.endswith('\r\n\r\nhello'))
+
+    def test_chunked_stream(self):
+        response = HTTPResponse()
+        response.buffered = 0
+        response.set_body(Stream(['hello', '', 'x' * 20]))
+        out = CountingFile()
+        response.write(out, 'HTTP/1.1')
+        head, body = out.getvalue().split('\r\n\r\n', 1)
+        self.assertTrue('Transfer-Encoding: chunked' in head)
+        self.assertEqual(body, '5\r\nhello\r\n14\r\n%s\r\n0\r\n\r\n' % ('x' * 20))
+
+    def test_stream_http10(self):
+        response = HTTPResponse()
+        response.set_body(Stream(['hello']))
+        out = CountingFile()
+        response.write(out, 'HTTP/1.0')
+        data = out.getvalue()
+        self.assertFalse('Transfer-Encoding' in data)
+        self.assertTrue(data.endswith('\r\n\r\nhello'))
+
+    def test_stream_with_length(self):
+        response = HTTPResponse()
+        response.set_body(Stream(['hello'], length=5))
+        out = CountingFile()
+        response.write(out, 'HTTP/1.1')
+        data = out.getvalue()
+        self.assertFalse('Transfer-Encoding' in data)
+        self.assertTrue('Content-Length: 5\r\n' in data)
+
+    def test_no_body(self):
+        response = HTTPResponse(body='hello')
+        out = CountingFile()
+        response.write(out, 'HTTP/1.1', send_body=0)
+        self.assertTrue('Content-Length: 5\r\n' in out.getvalue())
+        self.assertTrue(out.getvalue().endswith('\r\n\r\n'))
+        response = HTTPResponse(status=304, body='hello')
+        out = CountingFile()
+        response.write(out, 'HTTP/1.1')
+        self.assertTrue(out.getvalue().startswith('HTTP/1.1 304 Not Modified'))
+        self.assertTrue(out.getvalue().endswith('\r\n\r\n'))
+        self.assertFalse('Content-Length' in out.getvalue())
+
+    def test_no_content_length(self):
+        for status in (101, 204, 304):
+            response = HTTPResponse(body='hello')
+            response.set_status(status)
+            self.assertFalse('Content-Length' in
+                             response.generate_header_block('HTTP/1.1'))
+            self.assertFalse('Content-Length' in
+                             response.generate_header_block())
+
+
+class FlushPolicyTestCase(BaseTestCase):
+
+    def write(self, stream, http_version=None):
+        response = HTTPResponse()
+        response.buffer_size = 100
+        response.set_body(stream)
+        out = CountingFile()
+        response.write(out, http_version)
+        return out
+
+    def test_no_policy(self):
+        out = self.write(Stream(['x' * 30] * 10))
+        self.assertEqual(out.flushes, [])
+
+    def test_flush_marker(self):
+        out = self.write(Stream([FLUSH, 'a', 'b', FLUSH, 'c']))
+        # the headers go out alone, then 'ab' before the second flush
+        self.assertEqual(out.flushes, [1, 2])
+        self.assertEqual(out.writes[1:], ['ab', 'c'])
+
+    def test_flush_bytes(self):
+        out = self.write(Stream(['x' * 10] * 10, flush_bytes=25))
+        self.assertEqual(out.flushes, [1, 2, 3])
+        self.assertEqual([len(w) for w in out.writes[1:]], [30, 30, 10])
+
+    def test_flush_interval(self):
+        def slow():
+            yield 'a'
+            time.sleep(0.02)
+            yield 'b'
+            yield 'c'
+        out = self.write(Stream(slow(), flush_interval=0.01))
+        self.assertEqual(out.flushes, [1])
+        self.assertEqual(out.writes[1:], ['c'])
+
+    def test_chunked_flush(self):
+        out = self.write(Stream(['hello', FLUSH, '', 'world']), 'HTTP/1.1')
+        head, body = out.getvalue().split('\r\n\r\n', 1)
+        self.assertEqual(body, '5\r\nhello\r\n5\r\nworld\r\n0\r\n\r\n')
+        self.assertEqual(out.flushes, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import time
+import unittest
+
+from cStringIO import StringIO
+
+from base import BaseTestCase
+
+from json import loads
+
+from quixote.publish import Publisher, SessionPublisher
+from quixote.logger import BufferedLog, format_timestamp, format_logfmt
+
+
+class FakeFile(object):
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+
+class FormatTimestampTestCase(BaseTestCase):
+
+    def test_matches_strftime(self):
+        now = time.time()
+        self.assertEqual(format_timestamp(now),
+                         time.strftime('%Y-%m-%d %H:%M:%S',
+                                       time.localtime(now)))
+
+    def test_reused_within_second(self):
+        now = int(time.time())
+        self.assertTrue(format_timestamp(now + 0.1) is
+                        format_timestamp(now + 0.9))
+
+
+class BufferedLogTestCase(BaseTestCase):
+
+    def test_lines_are_batched(self):
+        out = FakeFile()
+        log = BufferedLog(out, flush_size=1024, flush_interval=60)
+        log.write("a\n")
+        log.write("b\n")
+        self.assertEqual(out.getvalue(), "")
+        log.close()
+        self.assertEqual(out.chunks, ["a\nb\n"])
+        self.assertTrue(out.closed)
+
+    def test_flush_on_interval(self):
+        out = FakeFile()
+        log = BufferedLog(out, flush_size=1024, flush_interval=0.01)
+        log.write("a\n")
+        for i in range(200):
+            if out.getvalue():
+                break
+            time.sleep(0.01)
+        self.assertEqual(out.getvalue(), "a\n")
+        log.close()
+
+    def test_drop_when_full(self):
+        out = FakeFile()
+        log = BufferedLog(out, flush_size=4, flush_interval=60, max_size=4,
+                          policy='drop')
+        # hold the lock so the flusher cannot drain the buffer
+        log.write("")
+        log._cond.acquire()
+        try:
+            log._lines.append("xxxx")
+            log._size = 4
+        finally:
+            log._cond.release()
+        log.write("lost\n")
+        self.assertEqual(log.dropped, 1)
+        log.close()
+        self.assertTrue("lost" not in out.getvalue())
+
+    def inherited(self, out):
+        # a log as seen from a child process forked while it held a line
+        log = BufferedLog(out, flush_size=1024, flush_interval=60)
+        log._lines.append("parent\n")
+        log._size = 7
+        log._pid = -1
+        return log
+
+    def test_fork(self):
+        out = FakeFile()
+        log = self.inherited(out)
+        log.write("child\n")
+        log.close()
+        self.assertEqual(out.getvalue(), "child\n")
+        out = FakeFile()
+        log = self.inherited(out)
+        log.flush()
+        self.assertEqual(out.getvalue(), "")
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, BufferedLog, StringIO(), policy='spin')
+
+
+class UITest(object):
+    _q_exports = ['', 'login']
+
+    def _q_index(self, req):
+        req.log_fields['cache'] = 'miss'
+        return "hello, world"
+
+    def login(self, req):
+        req.session.set_user('joe')
+        return "welcome"
+
+
+class StructuredLogTestCase(BaseTestCase):
+
+    def publish(self, fmt, path='/', publisher=Publisher, **headers):
+        pub = publisher(UITest())
+        pub.configure(ACCESS_LOG_FORMAT=fmt)
+        pub.access_log = StringIO()
+        env = {'SCRIPT_NAME': '', 'PATH_INFO': path, 'REQUEST_METHOD': 'GET',
+               'SERVER_PROTOCOL': 'HTTP/1.0', 'REMOTE_ADDR': '127.0.0.1'}
+        env.update(headers)
+        pub.publish(StringIO(), StringIO(), StringIO(), env)
+        self.pub = pub
+        return pub.access_log.getvalue()
+
+    def test_json(self):
+        record = loads(self.publish('json'))
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['uri'], '/')
+        self.assertEqual(record['response_bytes'], 12)
+        self.assertEqual(record['cache'], 'miss')
+        for phase in ('t_parse', 't_traverse', 't_handler', 't_filter',
+                      't_write'):
+            self.assertTrue(phase in record, phase)
+
+    def test_session(self):
+        record = loads(self.publish('json', publisher=SessionPublisher))
+        self.assertEqual(record['session_saved'], False)
+        record = loads(self.publish('json', '/login',
+                                    publisher=SessionPublisher))
+        self.assertEqual(record['session_saved'], True)
+        session_id = self.pub.session_mgr.keys()[0]
+        self.assertFalse(session_id in self.pub.access_log.getvalue())
+
+    def test_json_bad_bytes(self):
+        record = loads(self.publish('json', HTTP_USER_AGENT='bot\xff'))
+        self.assertEqual(record['status'], 200)
+        self.assertTrue(u'bot\ufffd' in record.values())
+
+    def test_logfmt(self):
+        line = self.publish('logfmt')
+        self.assertTrue(line.startswith('time="'))
+        self.assertTrue(' status=200 ' in line)
+        self.assertTrue(line.endswith(' cache=miss\n'))
+
+    def test_logfmt_quoting(self):
+        self.assertEqual(format_logfmt([('a', 'x y'), ('b', 'q"'),
+                                        ('c', None), ('d', True)]),
+                         'a="x y" b="q\\"" c= d=true\n')
+        self.assertEqual(format_logfmt([('a', 'x\ny\r\t\x1b\\')]),
+                         'a="x\\ny\\r\\t\\x1b\\\\"\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
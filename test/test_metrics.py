@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cStringIO import StringIO
+
+from base import BaseTestCase
+
+from quixote.publish import Publisher, SessionPublisher
+from quixote.metrics import Metrics, MetricsExporter, MmapStore
+
+
+class UITest(object):
+    _q_exports = ['', 'boom', '_q_metrics']
+
+    _q_metrics = MetricsExporter()
+
+    def _q_index(self, req):
+        return "hello, world"
+
+    def boom(self, req):
+        raise KeyError('boom')
+
+
+class MetricsTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def publish(self, pub, path):
+        env = {'SCRIPT_NAME': '', 'PATH_INFO': path, 'REQUEST_METHOD': 'GET',
+               'SERVER_PROTOCOL': 'HTTP/1.0'}
+        out = StringIO()
+        pub.error_log = StringIO()
+        pub.publish(StringIO(), out, StringIO(), env)
+        return out.getvalue().split('\r\n\r\n', 1)[1]
+
+    def test_histogram(self):
+        metrics = Metrics()
+        metrics.observe_request('h', 200, 0.003)
+        metrics.observe_request('h', 200, 0.2)
+        metrics.observe_request('h', 404, 60)
+        text = metrics.render()
+        self.assertTrue('quixote_request_seconds_bucket{handler="h",le="0.005"} 1\n'
+                        in text)
+        self.assertTrue('quixote_request_seconds_bucket{handler="h",le="0.25"} 2\n'
+                        in text)
+        self.assertTrue('quixote_request_seconds_bucket{handler="h",le="+Inf"} 3\n'
+                        in text)
+        self.assertTrue('quixote_request_seconds_count{handler="h"} 3\n' in text)
+        self.assertTrue('quixote_requests_total{handler="h",status="404"} 1\n'
+                        in text)
+
+    def test_endpoint(self):
+        pub = SessionPublisher(UITest())
+        pub.configure(METRICS=1)
+        self.publish(pub, '/')
+        self.publish(pub, '/boom')
+        text = self.publish(pub, '/_q_metrics')
+        prefix = UITest.__module__ + '.UITest'
+        self.assertTrue('quixote_requests_total{handler="%s._q_index",'
+                        'status="200"} 1\n' % prefix in text)
+        self.assertTrue('quixote_exceptions_total{handler="%s.boom",'
+                        'type="KeyError"} 1\n' % prefix in text)
+        self.assertTrue('quixote_sessions 0\n' in text)
+
+    def test_disabled(self):
+        pub = Publisher(UITest())
+        self.publish(pub, '/_q_metrics')
+        self.assertEqual(pub.get_metrics(), None)
+
+    def test_shared_files(self):
+        first = Metrics(self.dir)
+        first.observe_request('h', 200, 0.1)
+        first.add_upload(100)
+        # pretend the file was written by another worker
+        os.rename(first.store.filename, os.path.join(self.dir, 'metrics-1.db'))
+        second = Metrics(self.dir)
+        second.add_upload(50)
+        text = second.render()
+        self.assertTrue('quixote_upload_bytes_total 150\n' in text)
+        self.assertTrue('quixote_requests_total{handler="h",status="200"} 1\n'
+                        in text)
+
+    def test_dead_process(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        dead = MmapStore(self.dir)
+        dead.inc('requests', 3)
+        dead.set('quixote_sessions', 5)
+        os.rename(dead.filename,
+                  os.path.join(self.dir, 'metrics-%d.db' % pid))
+        store = MmapStore(self.dir)
+        store.inc('requests')
+        for i in range(2):
+            counters, gauges = store.collect()
+            self.assertEqual(counters['requests'], 4)
+            self.assertFalse(gauges.has_key('quixote_sessions'))
+        names = os.listdir(self.dir)
+        names.sort()
+        self.assertEqual(names, [os.path.basename(store.filename),
+                                 'metrics-retired', 'metrics.lock'])
+
+    def test_mmap_reopen(self):
+        store = MmapStore(self.dir)
+        for i in range(5000):
+            store.inc('key-%d' % i)
+        store.inc('key-1', 2)
+        store = MmapStore(self.dir)
+        store.inc('key-1')
+        counters, gauges = store.collect()
+        self.assertEqual(counters['key-1'], 4)
+        self.assertEqual(len(counters), 5000)
+
+
+if __name__ == '__main__':
+    unittest.main()
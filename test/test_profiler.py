@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cStringIO import StringIO
+
+from base import BaseTestCase
+
+from quixote.config import ConfigError
+from quixote.publish import Publisher
+from quixote.profiler import RequestProfiler, make_token, check_token, \
+     handler_name, load_stats, report
+
+
+class UITest(object):
+    _q_exports = ['', 'other']
+
+    def _q_index(self, req):
+        return "hello, world"
+
+    def other(self, req):
+        return "other"
+
+
+class ProfilerTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def publish(self, pub, path, **headers):
+        env = {'SCRIPT_NAME': '', 'PATH_INFO': path, 'REQUEST_METHOD': 'GET',
+               'SERVER_PROTOCOL': 'HTTP/1.0'}
+        for name, value in headers.items():
+            env['HTTP_' + name.upper()] = value
+        out = StringIO()
+        pub.publish(StringIO(), out, StringIO(), env)
+        return out.getvalue()
+
+    def test_token(self):
+        token = make_token('sekrit', 60)
+        self.assertTrue(check_token('sekrit', token))
+        self.assertFalse(check_token('other', token))
+        self.assertFalse(check_token('sekrit', token, now=2**40))
+        self.assertFalse(check_token('sekrit', 'garbage'))
+
+    def test_handler_name(self):
+        self.assertEqual(handler_name(UITest().other),
+                         UITest.__module__ + '.UITest.other')
+
+    def test_sampling(self):
+        pub = Publisher(UITest())
+        pub.configure(PROFILE_DIR=self.dir, PROFILE_EVERY=2, PROFILE_KEEP=1)
+        for i in range(6):
+            self.assertTrue(self.publish(pub, '/').endswith('hello, world'))
+        name = handler_name(UITest()._q_index)
+        dumps = os.listdir(os.path.join(self.dir, name))
+        self.assertEqual(len(dumps), 1)
+        stats = load_stats(self.dir)
+        self.assertEqual(stats.keys(), [name])
+        out = StringIO()
+        report(self.dir, file=out)
+        self.assertTrue(name in out.getvalue())
+
+    def test_keep(self):
+        pub = Publisher(UITest())
+        self.assertRaises(ConfigError, pub.configure, PROFILE_KEEP=0)
+        self.assertRaises(ConfigError, pub.configure, PROFILE_KEEP=None)
+        for name in ('1.000000-1.prof', '2.000000-1.prof'):
+            open(os.path.join(self.dir, name), 'w').close()
+        RequestProfiler(self.dir, keep=1)._prune(self.dir)
+        self.assertEqual(os.listdir(self.dir), ['2.000000-1.prof'])
+        RequestProfiler(self.dir, keep=0)._prune(self.dir)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_signed_header(self):
+        pub = Publisher(UITest())
+        pub.configure(PROFILE_DIR=self.dir, PROFILE_SECRET='sekrit')
+        self.publish(pub, '/other')
+        self.assertEqual(os.listdir(self.dir), [])
+        self.publish(pub, '/other',
+                     x_quixote_profile=make_token('sekrit'))
+        self.assertEqual(os.listdir(self.dir),
+                         [handler_name(UITest().other)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from base import BaseTestCase
+
+from quixote import ptl_compile
+from quixote.html import htmltext
+
+
+TEMPLATE = '''
+def page [html] (title, items):
+    '<html>'
+    '<head><title>'
+    title
+    '</title></head>\\n'
+    '<body>'
+    for item in items:
+        '<li class="%s">' % 'item'
+        item
+        '</li>'
+        '\\n'
+    '</body></html>'
+
+def text [plain] (name):
+    'Hello, '
+    name
+    '!'
+    '\\n'
+
+def nested [html] ():
+    def inner [html] ():
+        '<b>'
+        '</b>'
+    inner()
+    u'<\\xe9>'
+    '<i>'
+'''
+
+
+def compile(source, fold=1, fast_append=0):
+    saved = ptl_compile.TemplateTransformer.fold_constants
+    ptl_compile.TemplateTransformer.fold_constants = fold
+    try:
+        code = ptl_compile.compile_template(StringIO(source), '<test>',
+                                            fast_append=fast_append)
+    finally:
+        ptl_compile.TemplateTransformer.fold_constants = saved
+    namespace = {}
+    exec code in namespace
+    return namespace
+
+
+class ConstantFoldingTestCase(BaseTestCase):
+
+    def compile(self, source, fold=1):
+        return compile(source, fold)
+
+
+    def test_same_output(self):
+        folded = self.compile(TEMPLATE)
+        plain = self.compile(TEMPLATE, fold=0)
+        for name, args in [('page', ('a&b', ['<x>', 'y'])),
+                           ('text', ('<world>',)),
+                           ('nested', ())]:
+            value = folded[name](*args)
+            self.assertEqual(type(value), type(plain[name](*args)))
+            self.assertEqual(value, plain[name](*args))
+        self.assertEqual(str(folded['page']('t', ['<x>'])),
+                         '<html><head><title>t</title></head>\n<body>'
+                         '<li class="item">&lt;x&gt;</li>\n</body></html>')
+        self.assertEqual(folded['text']('you'), 'Hello, you!\n')
+        self.assertEqual(folded['nested'](), htmltext(u'<b></b><\xe9><i>'))
+
+    def test_constants(self):
+        namespace = self.compile(TEMPLATE)
+        constants = [value for name, value in namespace.items()
+                     if name.startswith(ptl_compile.MARKUP_CONSTANT_PREFIX)]
+        for value in constants:
+            self.assertTrue(isinstance(value, htmltext))
+        texts = [value.s for value in constants]
+        self.assertTrue('<html><head><title>' in texts)
+        self.assertTrue('</li>\n' in texts)
+        self.assertTrue('<b></b>' in texts)
+        # a str and a unicode literal are never merged
+        self.assertTrue(u'<\xe9>' in texts)
+        self.assertFalse(u'<\xe9><i>' in texts)
+        # the literals are built once, not on every call
+        code = namespace['page'].func_code
+        self.assertFalse(ptl_compile.MARKUP_MANGLED_CLASS in code.co_names)
+
+
+FAST_TEMPLATE = TEMPLATE + '''
+class Item:
+    def __str__(self):
+        return '<item>'
+
+def values [html] (x):
+    x
+    None
+    1.5
+    u'\xe9&'
+    Item()
+    r = TemplateIO()
+    r += '<plain>'
+    r
+    r = TemplateIO(html=1)
+    r += '<html>'
+    r
+
+def assign [plain] ():
+    x = 'not output'
+    y = 1
+    y += 2
+    y
+'''
+
+
+class FastAppendTestCase(BaseTestCase):
+
+    calls = [('page', ('a&b', ['<x>', 'y'])),
+             ('text', ('<world>',)),
+             ('nested', ()),
+             ('values', ('"q"',)),
+             ('values', (htmltext('<b>'),)),
+             ('assign', ())]
+
+    def test_same_output(self):
+        expected = compile(FAST_TEMPLATE, fold=0)
+        for fold in (0, 1):
+            namespace = compile(FAST_TEMPLATE, fold, fast_append=1)
+            for name, args in self.calls:
+                value = namespace[name](*args)
+                self.assertEqual(type(value), type(expected[name](*args)))
+                self.assertEqual(value, expected[name](*args))
+        self.assertEqual(namespace['assign'](), '3')
+        self.assertEqual(namespace['values']('<'),
+                         htmltext(u'&lt;1.5\xe9&&lt;item&gt;'
+                                  u'&lt;plain&gt;<html>'))
+
+    def test_code(self):
+        namespace = compile(FAST_TEMPLATE, fast_append=1)
+        code = namespace['page'].func_code
+        self.assertTrue(ptl_compile.IO_APPEND in code.co_varnames)
+        namespace = compile(FAST_TEMPLATE)
+        code = namespace['page'].func_code
+        self.assertFalse(ptl_compile.IO_APPEND in code.co_varnames)
+
+
+class CompileFilesTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        self.files = []
+        for name in ['a', 'b', os.path.join('sub', 'c')]:
+            self.files.append(self.write(name + '.ptl', TEMPLATE))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        filename = os.path.join(self.dir, name)
+        open(filename, 'w').write(text)
+        return filename
+
+    def compile(self, **kwargs):
+        kwargs.setdefault('quiet', 1)
+        return ptl_compile.compile_files(
+            ptl_compile.find_templates(self.dir), **kwargs)
+
+    def ptlc_stat(self, filename):
+        stat = os.stat(os.path.splitext(filename)[0] + '.ptlc')
+        return stat.st_ino, stat.st_mtime
+
+    def test_compile(self):
+        self.assertEqual(ptl_compile.find_templates(self.dir), self.files)
+        self.assertTrue(self.compile(jobs=2))
+        stats = map(self.ptlc_stat, self.files)
+        # nothing is rewritten while the sources are unchanged
+        self.assertTrue(self.compile())
+        self.assertEqual(map(self.ptlc_stat, self.files), stats)
+        self.assertTrue(self.compile(force=1))
+        self.assertNotEqual(map(self.ptlc_stat, self.files), stats)
+
+    def test_content_hash(self):
+        self.assertTrue(self.compile())
+        filename = self.files[0]
+        ptlc = os.path.splitext(filename)[0] + '.ptlc'
+        # a new mtime with the same content only updates the header
+        os.utime(filename, (0, 0))
+        self.assertTrue(ptl_compile.is_current(
+            filename, *ptl_compile.read_header(open(ptlc, 'rb'))))
+        self.assertTrue(self.compile())
+        header = ptl_compile.read_header(open(ptlc, 'rb'))
+        self.assertEqual(header[0], 0)
+        # new content makes it stale, whatever the mtime
+        self.write('a.ptl', TEMPLATE + '\n\n')
+        os.utime(filename, (1, 1))
+        self.assertFalse(ptl_compile.is_current(filename, *header))
+        self.assertTrue(self.compile())
+        self.assertEqual(ptl_compile.read_header(open(ptlc, 'rb')),
+                         (1, ptl_compile.source_digest(open(filename).read())))
+
+    def test_failure(self):
+        self.write('bad.ptl', 'def broken [html] (:\n')
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertFalse(self.compile(jobs=2))
+            self.assertFalse(self.compile())
+            self.assertEqual(ptl_compile.main(['-q', self.dir]), 1)
+            self.assertTrue('bad.ptl SyntaxError' in sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+        names = os.listdir(self.dir)
+        names.sort()
+        self.assertEqual(names, ['a.ptl', 'a.ptlc', 'b.ptl', 'b.ptlc',
+                                 'bad.ptl', 'sub'])
+        os.unlink(os.path.join(self.dir, 'bad.ptl'))
+        self.assertEqual(ptl_compile.main(['-q', '-j', '2', self.dir]), 0)
+
+    def test_umask(self):
+        umask = os.umask(002)
+        try:
+            self.assertTrue(self.compile())
+        finally:
+            os.umask(umask)
+        ptlc = os.path.splitext(self.files[0])[0] + '.ptlc'
+        self.assertEqual(os.stat(ptlc).st_mode & 0777, 0664)
+
+    def test_import(self):
+        from quixote import ptl_import
+        self.assertTrue(self.compile())
+        ptlc = os.path.splitext(self.files[0])[0] + '.ptlc'
+        module = ptl_import._load_ptlc('_test_ptl_a', ptlc)
+        self.assertEqual(module.text('x'), 'Hello, x!\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
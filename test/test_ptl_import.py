@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from base import BaseTestCase
+
+from quixote import ptl_compile, ptl_import
+
+
+TEMPLATE = '''
+def hello [html] (name):
+    '<p>Hello, '
+    name
+    '</p>'
+'''
+
+
+class ImportTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        self.finder = ptl_import.PTLFinder()
+        self.saved_path = sys.path[:]
+        sys.path[:0] = self.dirs
+        sys.meta_path.append(self.finder)
+        self.modules = sys.modules.keys()
+
+    def tearDown(self):
+        sys.meta_path.remove(self.finder)
+        sys.path[:] = self.saved_path
+        for name in sys.modules.keys():
+            if name not in self.modules:
+                del sys.modules[name]
+                ptl_import.loaded.pop(name, None)
+        for dir in self.dirs:
+            shutil.rmtree(dir)
+
+    def write(self, name, text, dir=0):
+        filename = os.path.join(self.dirs[dir], name)
+        open(filename, 'w').write(text)
+        # make sure the directory looks changed to the finder
+        os.utime(os.path.dirname(filename), None)
+        self.finder.invalidate_caches()
+        return filename
+
+
+class FinderTestCase(ImportTestCase):
+
+    def test_import(self):
+        self.write('ptlmod.ptl', TEMPLATE)
+        import ptlmod
+        self.assertEqual(str(ptlmod.hello('<you>')),
+                         '<p>Hello, &lt;you&gt;</p>')
+        self.assertTrue(isinstance(ptlmod.__loader__, ptl_import.PTLLoader))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.dirs[0], 'ptlmod.ptlc')))
+        # the second time, the .ptlc file is used
+        del sys.modules['ptlmod']
+        import ptlmod
+        self.assertTrue(ptlmod.__file__.endswith('.ptlc'))
+
+    def test_recompile_atomic(self):
+        self.write('ptlatomic.ptl', TEMPLATE)
+        import ptlatomic
+        ptlc = os.path.join(self.dirs[0], 'ptlatomic.ptlc')
+        inode = os.stat(ptlc).st_ino
+        filename = self.write('ptlatomic.ptl',
+                              TEMPLATE.replace('Hello', 'Bye'))
+        os.utime(filename, (1, 1))
+        del sys.modules['ptlatomic']
+        import ptlatomic
+        self.assertEqual(str(ptlatomic.hello('x')), '<p>Bye, x</p>')
+        # the .ptlc file was replaced, not rewritten in place
+        self.assertNotEqual(os.stat(ptlc).st_ino, inode)
+        names = os.listdir(self.dirs[0])
+        names.sort()
+        self.assertEqual(names, ['ptlatomic.ptl', 'ptlatomic.ptlc'])
+
+    def test_unwritable(self):
+        def fail(filename, write):
+            raise OSError(13, 'Permission denied')
+        self.write('ptlro.ptl', TEMPLATE)
+        write_atomic = ptl_import._write_atomic
+        ptl_import._write_atomic = fail
+        try:
+            import ptlro
+        finally:
+            ptl_import._write_atomic = write_atomic
+        self.assertEqual(str(ptlro.hello('x')), '<p>Hello, x</p>')
+        self.assertFalse(os.path.exists(
+            os.path.join(self.dirs[0], 'ptlro.ptlc')))
+
+    def test_package(self):
+        os.mkdir(os.path.join(self.dirs[0], 'ptlpkg'))
+        self.write(os.path.join('ptlpkg', '__init__.ptl'), TEMPLATE)
+        self.write(os.path.join('ptlpkg', 'sub.ptl'), TEMPLATE)
+        from ptlpkg import sub
+        import ptlpkg
+        self.assertEqual(ptlpkg.__path__,
+                         [os.path.join(self.dirs[0], 'ptlpkg')])
+        self.assertEqual(str(sub.hello('x')), '<p>Hello, x</p>')
+
+    def test_precedence(self):
+        # a Python module in the same directory wins
+        self.write('ptlboth.ptl', TEMPLATE)
+        self.write('ptlboth.py', 'kind = "python"\n')
+        import ptlboth
+        self.assertEqual(ptlboth.kind, 'python')
+        # so does any module in an earlier directory
+        self.write('ptllater.py', 'kind = "python"\n', dir=1)
+        self.write('ptllater.ptl', TEMPLATE)
+        import ptllater
+        self.assertTrue(hasattr(ptllater, 'hello'))
+        self.assertEqual(self.finder.find_module('os'), None)
+
+    def test_zip_entry(self):
+        # a module in a zip file earlier on the path wins, too
+        filename = os.path.join(self.dirs[1], 'mods.zip')
+        archive = zipfile.ZipFile(filename, 'w')
+        archive.writestr('ptlzip.py', 'kind = "zip"\n')
+        archive.close()
+        sys.path.insert(0, filename)
+        self.write('ptlzip.ptl', TEMPLATE)
+        self.write('ptlzip2.ptl', TEMPLATE)
+        self.assertEqual(self.finder.find_module('ptlzip'), None)
+        import ptlzip
+        self.assertEqual(ptlzip.kind, 'zip')
+        import ptlzip2
+        self.assertTrue(hasattr(ptlzip2, 'hello'))
+
+    def test_listing_cache(self):
+        self.assertEqual(self.finder.find_module('ptlnew'), None)
+        listing = self.finder.listings[self.dirs[0]]
+        self.assertEqual(self.finder.find_module('ptlnew'), None)
+        self.assertTrue(self.finder.listings[self.dirs[0]] is listing)
+        # a new file changes the directory's mtime
+        filename = os.path.join(self.dirs[0], 'ptlnew.ptl')
+        open(filename, 'w').write(TEMPLATE)
+        os.utime(self.dirs[0], (listing[0] + 10, listing[0] + 10))
+        loader = self.finder.find_module('ptlnew')
+        self.assertEqual(loader.filename, filename)
+
+    def test_failure(self):
+        self.write('ptlbad.ptl', 'def f [html] ():\n    1/0\nf()\n')
+        self.assertRaises(ZeroDivisionError, __import__, 'ptlbad')
+        self.assertFalse('ptlbad' in sys.modules)
+
+
+class ArchiveTestCase(ImportTestCase):
+
+    def build(self):
+        filenames = ptl_compile.find_templates(self.dirs[0])
+        self.assertTrue(ptl_compile.compile_files(filenames, quiet=1))
+        archive = os.path.join(self.dirs[1], 'app.ptla')
+        ptl_compile.write_archive(archive, filenames)
+        for filename in filenames:
+            os.unlink(os.path.splitext(filename)[0] + '.ptlc')
+        self.finder.archive = ptl_import.PTLArchive(archive)
+
+    def test_archive(self):
+        self.write('ptlarc.ptl', TEMPLATE)
+        os.mkdir(os.path.join(self.dirs[0], 'ptlarcpkg'))
+        self.write(os.path.join('ptlarcpkg', '__init__.ptl'), 'x = 1\n')
+        self.build()
+        import ptlarc, ptlarcpkg
+        self.assertEqual(ptlarc.__file__,
+                         os.path.join(self.dirs[0], 'ptlarc.ptl'))
+        self.assertEqual(str(ptlarc.hello('&')), '<p>Hello, &amp;</p>')
+        self.assertEqual(ptlarcpkg.x, 1)
+        self.assertEqual(ptlarcpkg.__path__,
+                         [os.path.join(self.dirs[0], 'ptlarcpkg')])
+        # code from the archive doesn't need a .ptlc file
+        self.assertFalse(os.path.exists(
+            os.path.join(self.dirs[0], 'ptlarc.ptlc')))
+
+    def test_stale(self):
+        filename = self.write('ptlstale.ptl', TEMPLATE)
+        self.build()
+        archive = self.finder.archive
+        self.assertNotEqual(archive.get_code(filename), None)
+        self.write('ptlstale.ptl', TEMPLATE.replace('Hello', 'Bye'))
+        os.utime(filename, (1, 1))
+        self.assertEqual(archive.get_code(filename), None)
+        import ptlstale
+        self.assertEqual(str(ptlstale.hello('x')), '<p>Bye, x</p>')
+        self.assertTrue(ptlstale.__file__.endswith('.ptl'))
+
+    def test_bad_magic(self):
+        filename = self.write('bad.ptla', 'PTLC')
+        self.assertRaises(ValueError, ptl_import.PTLArchive, filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
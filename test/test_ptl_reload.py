@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import sys
+import time
+import unittest
+
+from base import BaseTestCase
+
+from quixote import ptl_reload
+from test_ptl_import import ImportTestCase
+
+
+PAGES = '''
+def header [html] (title):
+    '<h1>%s</h1>' % title
+'''
+
+VIEWS = '''
+from ptlpages import header
+
+def page [html] ():
+    header('Page')
+    'body'
+'''
+
+
+class ReloadTestCase(ImportTestCase):
+
+    def setUp(self):
+        ImportTestCase.setUp(self)
+        self.messages = []
+        self.reloader = ptl_reload.PTLReloader(interval=0.05,
+                                               log=self.messages.append)
+
+    def tearDown(self):
+        self.reloader.stop()
+        ImportTestCase.tearDown(self)
+
+    def edit(self, name, text):
+        filename = self.write(name, text)
+        # make sure the mtime changes, whatever its resolution
+        mtime = os.stat(filename).st_mtime + 10
+        os.utime(filename, (mtime, mtime))
+
+    def test_reload(self):
+        self.write('ptlpages.ptl', PAGES)
+        self.write('ptlviews.ptl', VIEWS)
+        import ptlpages, ptlviews
+        self.assertEqual(self.reloader.check(), [])
+        self.assertEqual(str(ptlviews.page()), '<h1>Page</h1>body')
+        self.edit('ptlpages.ptl', PAGES.replace('h1', 'h2'))
+        self.assertEqual(self.reloader.changed(), ['ptlpages'])
+        self.assertEqual(self.reloader.check(), ['ptlpages', 'ptlviews'])
+        # the same module objects are updated in place
+        self.assertTrue(sys.modules['ptlpages'] is ptlpages)
+        self.assertEqual(str(ptlpages.header('x')), '<h2>x</h2>')
+        self.assertEqual(str(ptlviews.page()), '<h2>Page</h2>body')
+        self.assertEqual(self.reloader.check(), [])
+
+    def test_error(self):
+        self.write('ptlbroken.ptl', PAGES)
+        import ptlbroken
+        self.edit('ptlbroken.ptl', 'def header [html] (:\n')
+        self.assertEqual(self.reloader.check(), [])
+        self.assertTrue('SyntaxError' in self.messages[-1])
+        # the old code is still there, and isn't retried
+        self.assertEqual(str(ptlbroken.header('x')), '<h1>x</h1>')
+        self.assertEqual(self.reloader.check(), [])
+        self.edit('ptlbroken.ptl', PAGES)
+        self.assertEqual(self.reloader.check(), ['ptlbroken'])
+
+    def test_run_error(self):
+        self.write('ptlfailing.ptl', PAGES)
+        import ptlfailing
+        self.edit('ptlfailing.ptl',
+                  PAGES.replace('h1', 'h2') + 'extra = 1\n1/0\n')
+        self.assertEqual(self.reloader.check(), [])
+        self.assertTrue('ZeroDivisionError' in self.messages[-1])
+        self.assertTrue(sys.modules['ptlfailing'] is ptlfailing)
+        self.assertEqual(str(ptlfailing.header('x')), '<h1>x</h1>')
+        self.assertFalse(hasattr(ptlfailing, 'extra'))
+
+    def test_thread(self):
+        self.write('ptlwatched.ptl', PAGES)
+        import ptlwatched
+        self.reloader.start()
+        self.edit('ptlwatched.ptl', PAGES.replace('h1', 'h3'))
+        deadline = time.time() + 5
+        while (time.time() < deadline and
+               self.messages != ['reloaded ptlwatched']):
+            time.sleep(0.01)
+        self.assertEqual(str(ptlwatched.header('x')), '<h3>x</h3>')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import time
+import random
+import threading
+import unittest
+from cStringIO import StringIO
+
+from base import BaseTestCase
+
+from quixote import errors
+from quixote.publish import Publisher, set_publisher, get_request
+
+
+class Section(object):
+    _q_exports = ['', 'denied']
+
+    def __init__(self, name):
+        self.name = name
+
+    def _q_index(self, request):
+        time.sleep(random.random() * 0.002)
+        assert get_request() is request
+        return '%s %s' % (self.name, request.get_form_var('n'))
+
+    def denied(self, request):
+        time.sleep(random.random() * 0.002)
+        raise errors.AccessError()
+
+    def _q_exception_handler(self, request, exc):
+        return 'denied by %s' % self.name
+
+
+class Missing(object):
+    _q_exports = ['']
+
+    def _q_index(self, request):
+        raise errors.TraversalError()
+
+    def _q_exception_handler(self, request, exc):
+        return u'<p>\u4e2d</p>'
+
+
+class UITest(object):
+    _q_exports = ['a', 'b', 'exit', 'missing', 'boom', 'plain', 'utf8']
+
+    def __init__(self):
+        self.a = Section('a')
+        self.b = Section('b')
+
+    def exit(self, request):
+        raise SystemExit
+
+    def boom(self, request):
+        raise KeyError('boom')
+
+    def utf8(self, request):
+        request.response.set_header('content-type',
+                                    'text/html; charset=utf-8')
+        return u'\u4e2d'
+
+    def plain(self, request):
+        request.response.set_header('content-type', 'text/plain')
+        return u'\u4e2d'
+
+    missing = Missing()
+
+
+class ThreadSafetyTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.pub = Publisher(UITest())
+        self.pub.configure(METRICS=1)
+        self.pub.error_log = StringIO()
+
+    def publish(self, path, query=''):
+        env = {'SCRIPT_NAME': '', 'PATH_INFO': path, 'REQUEST_METHOD': 'GET',
+               'QUERY_STRING': query, 'SERVER_NAME': 'example.com',
+               'SERVER_PROTOCOL': 'HTTP/1.0'}
+        out = StringIO()
+        self.pub.publish(StringIO(), out, StringIO(), env)
+        return out.getvalue().split('\r\n\r\n', 1)[1]
+
+    def test_concurrent(self):
+        errors = []
+        def worker(id):
+            set_publisher(self.pub)
+            try:
+                for i in range(50):
+                    section = random.choice('ab')
+                    n = '%d-%d' % (id, i)
+                    body = self.publish('/%s/' % section, 'n=' + n)
+                    if body != '%s %s' % (section, n):
+                        errors.append((section, n, body))
+                    body = self.publish('/%s/denied' % section)
+                    if body != 'denied by %s' % section:
+                        errors.append((section, 'denied', body))
+            except Exception, exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        text = self.pub.get_metrics().render()
+        count = 0
+        for line in text.splitlines():
+            if line.startswith('quixote_requests_total{'):
+                count += int(float(line.split()[-1]))
+        self.assertEqual(count, 8 * 50 * 2)
+
+    def test_per_thread_state(self):
+        index = self.pub.root_namespace.a._q_index
+        self.publish('/a/')
+        self.assertEqual(self.pub.namespace_stack[-1], index)
+        stacks = []
+        def other():
+            set_publisher(self.pub)
+            self.publish('/exit')
+            stacks.append((self.pub.namespace_stack, self.pub.exit_now))
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+        self.assertEqual(stacks[0][1], 1)
+        self.assertEqual(self.pub.exit_now, 0)
+        self.assertEqual(self.pub.namespace_stack[-1], index)
+
+    def test_assignment_per_thread(self):
+        # assigning the attributes, as subclasses may, changes them for
+        # the current thread only
+        self.pub.exit_now = 1
+        self.pub.namespace_stack = []
+        seen = []
+        def other():
+            seen.append((self.pub.exit_now, self.pub.namespace_stack))
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [(0, [self.pub.root_namespace])])
+        self.assertEqual(self.pub.exit_now, 1)
+        self.assertEqual(self.pub.namespace_stack, [])
+        self.assertFalse('exit_now' in self.pub.__dict__)
+
+    def test_thread_safe(self):
+        self.assertTrue(Publisher.is_thread_safe)
+
+
+class UnicodeErrorPublisher(Publisher):
+
+    def _generate_internal_error(self, request):
+        return u'<p>\u4e2d</p>'
+
+
+class ErrorPageTestCase(BaseTestCase):
+
+    def publish(self, pub, path):
+        env = {'SCRIPT_NAME': '', 'PATH_INFO': path, 'REQUEST_METHOD': 'GET',
+               'SERVER_NAME': 'example.com', 'SERVER_PROTOCOL': 'HTTP/1.0'}
+        out = StringIO()
+        pub.error_log = StringIO()
+        pub.publish(StringIO(), out, StringIO(), env)
+        return out.getvalue().split('\r\n\r\n', 1)
+
+    def test_output_encoding(self):
+        pub = Publisher(UITest())
+        pub.configure(OUTPUT_ENCODING='utf-8')
+        head, body = self.publish(pub, '/missing/')
+        self.assertTrue(head.startswith('Status: 404'))
+        self.assertTrue('charset=utf-8' in head)
+        self.assertEqual(body, '<p>\xe4\xb8\xad</p>')
+        pub = UnicodeErrorPublisher(UITest())
+        pub.configure(OUTPUT_ENCODING='utf-8')
+        head, body = self.publish(pub, '/boom')
+        self.assertTrue(head.startswith('Status: 500'))
+        self.assertTrue('\xe4\xb8\xad' in body)
+
+    def test_content_type_charset(self):
+        head, body = self.publish(Publisher(UITest()), '/utf8')
+        self.assertTrue(head.startswith('Status: 200'))
+        self.assertEqual(body, '\xe4\xb8\xad')
+
+    def test_unencodable(self):
+        # text the charset can't represent gets an error page
+        for size in (0, 1000):
+            pub = Publisher(UITest())
+            pub.configure(RESPONSE_CACHE_SIZE=size)
+            head, body = self.publish(pub, '/plain')
+            self.assertTrue(head.startswith('Status: 500'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import time
+import smtpd
+import asyncore
+import threading
+import unittest
+
+from base import BaseTestCase
+
+from quixote.config import Config
+from quixote.sendmail import Mailer, Outbox, build_message, sendmail
+
+
+class StubSMTPServer(smtpd.SMTPServer):
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.messages = []
+        self.connections = 0
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def address(self):
+        return '%s:%d' % self.socket.getsockname()
+
+
+class SendmailTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.server = StubSMTPServer()
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.setDaemon(1)
+        self.thread.start()
+        self.config = Config()
+        self.config.mail_server = self.server.address()
+        self.config.mail_from = 'app@example.com'
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.01, count=1)
+
+    def tearDown(self):
+        self.running = False
+        self.thread.join()
+        asyncore.close_all()
+
+    def wait_for(self, n):
+        for i in range(300):
+            if len(self.server.messages) >= n:
+                break
+            time.sleep(0.01)
+
+    def message(self, to):
+        return build_message('hi', 'body', [to], config=self.config)
+
+    def test_build_message(self):
+        sender, recipients, message = self.message('joe@example.com')
+        self.assertEqual(sender, 'app@example.com')
+        self.assertEqual(recipients, ['joe@example.com'])
+        self.assertTrue(message.startswith('From: app@example.com\n'))
+
+    def test_connection_reused(self):
+        mailer = Mailer(self.server.address())
+        mailer.send(*self.message('a@example.com'))
+        mailer.send(*self.message('b@example.com'))
+        self.assertEqual(mailer.send_batch([self.message('c@example.com'),
+                                            self.message('d@example.com')]),
+                         [None, None])
+        self.wait_for(4)
+        self.assertEqual(len(self.server.messages), 4)
+        self.assertEqual(self.server.connections, 1)
+        mailer.close()
+
+    def test_reconnect(self):
+        mailer = Mailer(self.server.address())
+        mailer.send(*self.message('a@example.com'))
+        # the server hangs up on idle connections
+        smtp, last_used = mailer._idle[0]
+        smtp.sock.close()
+        mailer.send(*self.message('b@example.com'))
+        self.wait_for(2)
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 2)
+        mailer.close()
+
+    def test_fork(self):
+        mailer = Mailer(self.server.address())
+        mailer.send(*self.message('a@example.com'))
+        smtp, last_used = mailer._idle[0]
+        quits = []
+        smtp.quit = lambda: quits.append(smtp)
+        # as seen from a child process
+        mailer._pid = -1
+        mailer.send(*self.message('b@example.com'))
+        self.wait_for(2)
+        self.assertEqual(quits, [])
+        self.assertEqual(smtp.sock, None)
+        self.assertEqual(self.server.connections, 2)
+        mailer._pid = -1
+        mailer.close()
+        self.assertEqual(quits, [])
+        self.assertEqual(mailer._idle, [])
+
+    def test_outbox(self):
+        self.config.mail_outbox = 1
+        sendmail('hi', 'body', ['a@example.com'], config=self.config)
+        self.wait_for(1)
+        self.assertEqual(self.server.messages[0][1], ['a@example.com'])
+
+    def test_outbox_flush(self):
+        outbox = Outbox(Mailer(self.server.address()))
+        outbox._pid = os.getpid() # no background thread
+        outbox._queue.put(self.message('a@example.com'))
+        outbox._queue.put(self.message('b@example.com'))
+        outbox.flush()
+        self.wait_for(2)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_outbox_fork(self):
+        outbox = Outbox(Mailer(self.server.address()))
+        outbox._pid = os.getpid() # no background thread
+        outbox._queue.put(self.message('a@example.com'))
+        queue = outbox._queue
+        # as seen from a child process: the parent's message is not sent
+        outbox._pid = -1
+        outbox.flush()
+        self.assertFalse(outbox._queue is queue)
+        outbox.put(*self.message('b@example.com'))
+        self.wait_for(1)
+        time.sleep(0.05)
+        self.assertEqual([m[1] for m in self.server.messages],
+                         [['b@example.com']])
+        self.assertEqual(queue.qsize(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()